@@ -0,0 +1,149 @@
+from .video import ChunkWriter, AAC_CHANNEL_LAYOUTS
+import io
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+import av
+import torchaudio
+
+def is_audio_encoder_available(codec_name):
+    try:
+        av.codec.Codec(codec_name, "w")
+        return True
+    except Exception:
+        return False
+
+# the formats an audio action can use to send its audio to the client, mp3 depends
+# on the ffmpeg that pyav was built with
+AUDIO_FORMATS = ["wav", "ogg", "flac", "opus"] + (["mp3"] if is_audio_encoder_available("libmp3lame") else [])
+AUDIO_FORMAT_TYPES = {
+    "wav": "audio/wav",
+    "ogg": "audio/ogg",
+    "flac": "audio/flac",
+    "opus": "audio/ogg",
+    "mp3": "audio/mpeg",
+}
+
+# the channel layouts the flac encoder supports by the amount of channels, which are not
+# all the ones of aac
+FLAC_CHANNEL_LAYOUTS = {
+    1: "mono",
+    2: "stereo",
+    3: "3.0",
+    4: "quad",
+    5: "5.0",
+    6: "5.1",
+    7: "6.1",
+    8: "7.1",
+}
+
+# the formats that are encoded with pyav, container format, codec, sample format, sample rate
+# and the channel layouts the encoder supports, the rest are saved with torchaudio
+AV_AUDIO_FORMATS = {
+    # opus only works at 48khz, the audio is resampled by the encoder
+    "opus": ("ogg", "libopus", "flt", 48000, {1: "mono", 2: "stereo"}),
+    "flac": ("flac", "flac", "s16", None, FLAC_CHANNEL_LAYOUTS),
+    "mp3": ("mp3", "libmp3lame", "fltp", None, {1: "mono", 2: "stereo"}),
+}
+
+# how many samples are given to the encoder at once
+AUDIO_ENCODE_CHUNK_SAMPLES = 64 * 1024
+
+# the size of the chunks a streamed audio is sent in
+AUDIO_STREAM_CHUNK_SIZE = 256 * 1024
+
+# the audio actions encode and send in these threads, sending waits while the client is over its
+# budget so they are kept apart from the image encoding pool which they would otherwise block
+AUDIO_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="aihub-audio")
+
+def get_audio_encoding_inputs():
+    """
+    The optional inputs of the nodes that let the workflow choose how the audio is encoded,
+    besides the format that comes first to keep the order of the inputs of older workflows
+    """
+    return {
+        "bitrate": ("INT", {"default": 128, "min": 8, "max": 512, "tooltip": "The bitrate in kbps for the opus and mp3 formats"}),
+        "compression_level": ("INT", {"default": 5, "min": 0, "max": 12, "tooltip": "The compression level for the flac format, higher is smaller but slower"}),
+        "streaming": ("BOOLEAN", {"default": False, "tooltip": "If true, the audio is sent in chunks while it is being encoded, the client receives many files with a chunk_index and the last one has chunk_final set"}),
+    }
+
+def get_audio_file_name(name, format="wav"):
+    """
+    The default file name of an audio with the extension of its format
+    """
+    file_name = name
+    if not file_name.lower().endswith(f".{format}"):
+        file_name += f".{format}"
+    # replace spaces with underscores
+    return file_name.replace(" ", "_")
+
+def audio_save_to(waveform, sample_rate, file, format="wav", bitrate=128, compression_level=5):
+    """
+    Encodes a waveform (C, T) into a file object, the formats encoded with pyav do not need
+    to seek so the file object can be a ChunkWriter
+    """
+    if format not in AV_AUDIO_FORMATS:
+        if hasattr(file, "seek"):
+            torchaudio.save(file, waveform, sample_rate, format=format.upper())
+        else:
+            # torchaudio needs to seek to write the header
+            buffer = io.BytesIO()
+            torchaudio.save(buffer, waveform, sample_rate, format=format.upper())
+            file.write(buffer.getbuffer())
+        return
+
+    container_format, codec_name, sample_format, codec_rate, layouts = AV_AUDIO_FORMATS[format]
+    samples = waveform.float().contiguous().cpu().numpy()
+    channels = samples.shape[0]
+    # the frames take the layout of the stream when the encoder supports the amount of channels,
+    # so they are not remixed from one layout to another with the same channels
+    frame_layout = layouts.get(channels, AAC_CHANNEL_LAYOUTS.get(channels, channels))
+
+    with av.open(file, mode="w", format=container_format) as output:
+        stream = output.add_stream(codec_name, rate=codec_rate or sample_rate)
+        stream.format = sample_format
+        # the channels the encoder cannot take are downmixed by the encoder
+        stream.layout = layouts.get(channels, "stereo")
+        if format == "flac":
+            stream.options = {"compression_level": str(compression_level)}
+        else:
+            stream.bit_rate = bitrate * 1000
+
+        for start in range(0, samples.shape[1], AUDIO_ENCODE_CHUNK_SAMPLES):
+            end = min(start + AUDIO_ENCODE_CHUNK_SAMPLES, samples.shape[1])
+            frame = av.AudioFrame.from_ndarray(samples[:, start:end], format="fltp", layout=frame_layout)
+            frame.sample_rate = sample_rate
+            # the pts is counted in input samples, the encoder resamples to the rate of the
+            # stream (eg. 48khz for opus) and rescales the timestamps with this time base
+            frame.time_base = Fraction(1, sample_rate)
+            frame.pts = start
+            for packet in stream.encode(frame):
+                output.mux(packet)
+
+        for packet in stream.encode(None):
+            output.mux(packet)
+
+def send_audio(send_binary_data, waveform, sample_rate, action_data, format, bitrate, compression_level, streaming):
+    """
+    Encodes an audio and sends it with send_binary_data(binary_data, data_type, action), when streaming
+    the audio is sent in chunks as it is encoded instead of all at once at the end
+
+    This is meant to run outside of the execution thread, see AIHubServer.submit_for_current_client
+    """
+    mime_type = AUDIO_FORMAT_TYPES[format]
+    if not streaming:
+        buffer = io.BytesIO()
+        audio_save_to(waveform, sample_rate, buffer, format=format, bitrate=bitrate, compression_level=compression_level)
+        send_binary_data(buffer.getbuffer(), mime_type, action_data)
+        return
+
+    def on_chunk(chunk, chunk_index, final):
+        send_binary_data(chunk, mime_type, {
+            **action_data,
+            "streaming": True,
+            "chunk_index": chunk_index,
+            "chunk_final": final,
+        })
+
+    writer = ChunkWriter(on_chunk, AUDIO_STREAM_CHUNK_SIZE)
+    audio_save_to(waveform, sample_rate, writer, format=format, bitrate=bitrate, compression_level=compression_level)
+    writer.close()
@@ -0,0 +1,86 @@
+"""
+Measures how many frames per second video_save_to encodes for typical video shapes
+
+It must be run with the python of ComfyUI from the ComfyUI directory, eg.
+
+    python custom_nodes/ComfyUI-aihub-workflow-exposer/benchmarks/video_save_benchmark.py
+
+Options:
+    --device cuda       create the frames on the gpu, as they come from a vae decode
+    --threads 1         number of libx264 threads, by default the same as the server uses
+    --repeat 3          how many times each case is measured, the best time is reported
+"""
+import argparse
+import importlib.util
+import io
+import os
+import sys
+import time
+from fractions import Fraction
+from types import SimpleNamespace
+
+import torch
+
+# ComfyUI itself must be importable for video.py to load
+sys.path.insert(0, os.getcwd())
+
+VIDEO_MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "video.py")
+
+# (frames, height, width) of common outputs
+CASES = [
+    (81, 480, 832),
+    (81, 720, 1280),
+    (49, 1088, 1920),
+]
+
+def load_video_module():
+    spec = importlib.util.spec_from_file_location("aihub_video", VIDEO_MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class FakeVideo:
+    """
+    The minimum of a comfyui video that video_save_to uses
+    """
+    def __init__(self, images, frame_rate):
+        self.components = SimpleNamespace(images=images, frame_rate=Fraction(frame_rate), audio=None)
+
+    def get_components(self):
+        return self.components
+
+def measure(video_module, video, color_conversion, threads, repeat):
+    best = None
+    size = 0
+    for _ in range(repeat):
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        video_module.video_save_to(video, buffer, color_conversion=color_conversion, threads=threads)
+        elapsed = time.perf_counter() - start
+        size = buffer.tell()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+def main():
+    parser = argparse.ArgumentParser(description="video_save_to benchmark")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    video_module = load_video_module()
+    threads = args.threads if args.threads is not None else video_module.AIHUB_VIDEO_ENCODE_THREADS
+    print(f"device {args.device}, {threads} encoder threads")
+
+    for frames, height, width in CASES:
+        # random frames are the worst case for the encoder, real videos encode faster
+        generator = torch.Generator(device="cpu").manual_seed(0)
+        images = torch.rand((frames, height, width, 3), generator=generator).to(args.device)
+        video = FakeVideo(images, 16)
+
+        for color_conversion in ["swscale", "tensor"]:
+            elapsed, size = measure(video_module, video, color_conversion, threads, args.repeat)
+            print(f"{frames}x{width}x{height} {color_conversion:>8}: {frames / elapsed:8.1f} frames/s, {elapsed:6.2f}s, {size / (1024 * 1024):6.1f}MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+import hashlib
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from os import path, listdir, makedirs, link, remove, replace, stat, utime
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+PARTIAL_PATTERN = re.compile(r'^([0-9a-f]{64})\.partial$')
+
+# the blobs are given to the workflows from this subdirectory with the extension of the file
+# they were uploaded as, so the path given to a workflow depends only on the content of the file
+CONTENT_DIRECTORY = "content"
+CONTENT_PATTERN = re.compile(r'^([0-9a-f]{64})(\.[0-9A-Za-z]{1,16})?$')
+
+# how much is read at once to hash a file
+HASH_READ_SIZE = 1024 * 1024
+
+def hash_file(file_path):
+    """
+    Provides the sha256 of a file as lowercase hex
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while True:
+            data = f.read(HASH_READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+# the suffix of the temporary paths files are linked or copied to before they are moved into place
+LINK_SUFFIX = ".link"
+
+def link_or_copy_temporary(source, destination):
+    """
+    Hardlinks a file to a new temporary path beside destination, or copies it when hardlinks
+    are not possible (eg. a different filesystem), and provides that path; the caller moves it
+    into place, so the copy can be made without holding any lock
+    """
+    temporary = f"{destination}.{uuid.uuid4().hex}{LINK_SUFFIX}"
+    try:
+        link(source, temporary)
+    except OSError:
+        try:
+            shutil.copyfile(source, temporary)
+        except BaseException:
+            if path.exists(temporary):
+                remove(temporary)
+            raise
+    return temporary
+
+def link_or_copy(source, destination):
+    """
+    Hardlinks a file to a new path, or copies it when hardlinks are not possible
+    (eg. a different filesystem), an existing destination is replaced
+    """
+    replace(link_or_copy_temporary(source, destination), destination)
+
+def remove_temporary_links(directory):
+    """
+    Removes what link_or_copy_temporary left in a directory when the server stopped in between
+    """
+    for name in listdir(directory):
+        if name.endswith(LINK_SUFFIX):
+            try:
+                remove(path.join(directory, name))
+            except OSError as e:
+                print(f"Error removing temporary file {name}: {e}")
+
+class BlobStore:
+    """
+    The uploaded files by their sha256, shared by all the websocket sessions so a client
+    that reconnects does not need to upload the same files again
+
+    The sessions get hardlinks to the blobs, so a blob that is evicted stays on disk until
+    the last session that uses it is gone; the blobs that were used least recently are
+    evicted once the store is over its quota
+
+    The workflows get the blobs through content paths, hardlinks named after the hash with the
+    extension of the uploaded file, so the same file has the same path for every session and
+    comfyui can reuse the outputs of the nodes that use it; a blob is pinned while a run uses
+    it, the pinned blobs are not evicted
+
+    The partial files of the chunked uploads that come with a hash are kept here too so they
+    can be resumed from another session, they count towards the quota once their upload is
+    left unfinished, they are evicted before any blob and removed after partial_max_age seconds
+
+    The directory is read the first time the store is used, not when it is created, and all
+    the methods but unpin and get_metrics do blocking file operations, they are meant to run
+    outside of the server loop; the files are linked or copied without holding the lock, so
+    copying a large blob does not block the methods that only update the indexes
+    """
+
+    def __init__(self, directory, max_bytes, partial_max_age=24 * 60 * 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.partial_max_age = partial_max_age
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        # hash -> size, the least recently used first
+        self.blobs = OrderedDict()
+        # (st_dev, st_ino) -> hash, the sessions get hardlinks so their files are found by inode
+        self.inodes = {}
+        # hash -> set of content paths
+        self.content_paths = {}
+        # hash -> how many runs use the blob
+        self.pins = {}
+        # hash -> (size, mtime) of the partial files of the uploads that were left unfinished
+        self.partials = {}
+        # the blobs and the partials
+        self.total_bytes = 0
+        # the hashes that are being uploaded in chunks right now
+        self.uploading = set()
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        with self.load_lock:
+            if not self.loaded:
+                self.load()
+                self.loaded = True
+
+    def load(self):
+        """
+        Reads the blobs and the partial files that are already in the directory, eg. from before a restart
+        """
+        if not path.exists(self.directory):
+            makedirs(self.directory, exist_ok=True)
+        remove_temporary_links(self.directory)
+        found = []
+        partials = {}
+        for name in listdir(self.directory):
+            if HASH_PATTERN.match(name):
+                info = stat(path.join(self.directory, name))
+                found.append((info.st_mtime, name, info.st_size, (info.st_dev, info.st_ino)))
+            else:
+                match = PARTIAL_PATTERN.match(name)
+                if match is not None:
+                    info = stat(path.join(self.directory, name))
+                    partials[match.group(1)] = (info.st_size, info.st_mtime)
+        content_directory = path.join(self.directory, CONTENT_DIRECTORY)
+        content_names = []
+        if path.isdir(content_directory):
+            remove_temporary_links(content_directory)
+            content_names = listdir(content_directory)
+        with self.lock:
+            for _, name, size, inode in sorted(found):
+                self.blobs[name] = size
+                self.inodes[inode] = name
+                self.total_bytes += size
+            for name in content_names:
+                match = CONTENT_PATTERN.match(name)
+                content_path = path.join(content_directory, name)
+                if match is not None and match.group(1) in self.blobs:
+                    self.content_paths.setdefault(match.group(1), set()).add(content_path)
+                else:
+                    # the blob was evicted while the server was not running
+                    try:
+                        remove(content_path)
+                    except OSError as e:
+                        print(f"Error removing content path {content_path}: {e}")
+            for file_hash, (size, mtime) in partials.items():
+                # an upload that started meanwhile is counted once it is released
+                if file_hash not in self.uploading:
+                    self.partials[file_hash] = (size, mtime)
+                    self.total_bytes += size
+            self.evict()
+
+    def get_blob_path(self, file_hash):
+        return path.join(self.directory, file_hash)
+
+    def get_partial_path(self, file_hash):
+        return path.join(self.directory, file_hash + ".partial")
+
+    def pin(self, file_hash):
+        # the lock must be held
+        self.pins[file_hash] = self.pins.get(file_hash, 0) + 1
+        self.blobs.move_to_end(file_hash)
+
+    def link_into(self, file_hash, destination):
+        """
+        Makes the blob available at destination, provides False if the store does not have it
+        """
+        self.ensure_loaded()
+        with self.lock:
+            if file_hash not in self.blobs:
+                return False
+            # pinned so it is not evicted while it is linked or copied
+            self.pin(file_hash)
+        try:
+            blob_path = self.get_blob_path(file_hash)
+            link_or_copy(blob_path, destination)
+            # the modification time keeps the order of use across restarts
+            utime(blob_path)
+        finally:
+            self.unpin(file_hash)
+        return True
+
+    def add(self, file_hash, source, verified=False):
+        """
+        Adds a file to the store, the file must have the given hash, provides False if it does not;
+        the hash is not checked again if the caller verified it already
+        """
+        if not verified and hash_file(source) != file_hash:
+            return False
+        self.ensure_loaded()
+        with self.lock:
+            if file_hash in self.blobs:
+                self.blobs.move_to_end(file_hash)
+                return True
+
+        blob_path = self.get_blob_path(file_hash)
+        temporary = link_or_copy_temporary(source, blob_path)
+        with self.lock:
+            if file_hash in self.blobs:
+                # another session added it meanwhile
+                added = False
+            else:
+                replace(temporary, blob_path)
+                info = stat(blob_path)
+                self.blobs[file_hash] = info.st_size
+                self.inodes[(info.st_dev, info.st_ino)] = file_hash
+                self.total_bytes += info.st_size
+                added = True
+            self.blobs.move_to_end(file_hash)
+            self.evict()
+        if not added:
+            remove(temporary)
+        return True
+
+    def evict(self):
+        # the lock must be held, the unfinished uploads go first since they cannot be used yet, then
+        # the blobs, the blob that was just used and the uploads in progress are never evicted
+        if self.total_bytes > self.max_bytes:
+            released = sorted(
+                (mtime, file_hash) for file_hash, (_, mtime) in self.partials.items() if file_hash not in self.uploading
+            )
+            for _, file_hash in released:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.remove_partial(file_hash)
+        for file_hash in list(self.blobs.keys())[:-1]:
+            if self.total_bytes <= self.max_bytes:
+                break
+            if file_hash not in self.pins:
+                self.remove_blob(file_hash)
+
+    def remove_blob(self, file_hash):
+        # the lock must be held
+        self.total_bytes -= self.blobs.pop(file_hash)
+        for inode in [inode for inode, inode_hash in self.inodes.items() if inode_hash == file_hash]:
+            del self.inodes[inode]
+        for blob_path in [self.get_blob_path(file_hash)] + sorted(self.content_paths.pop(file_hash, [])):
+            try:
+                remove(blob_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Error evicting blob {file_hash}: {e}")
+
+    def pin_content_path(self, file_path):
+        """
+        If file_path is a blob linked into a session, provides its hash and its content path, and
+        pins the blob until unpin is called; provides None if the file is not a blob
+
+        Files are never modified in place, they are replaced, so a file with the inode of a blob
+        has its content
+        """
+        self.ensure_loaded()
+        info = stat(file_path)
+        with self.lock:
+            file_hash = self.inodes.get((info.st_dev, info.st_ino))
+            if file_hash is None or file_hash not in self.blobs:
+                return None
+            self.pin(file_hash)
+            extension = path.splitext(file_path)[1]
+            if not CONTENT_PATTERN.match(file_hash + extension):
+                extension = ""
+            content_path = path.join(self.directory, CONTENT_DIRECTORY, file_hash + extension)
+            known = content_path in self.content_paths.get(file_hash, ())
+
+        if not known or not path.isfile(content_path):
+            # the blob is pinned, it is not evicted while its content path is made
+            try:
+                makedirs(path.dirname(content_path), exist_ok=True)
+                link_or_copy(self.get_blob_path(file_hash), content_path)
+            except BaseException:
+                self.unpin(file_hash)
+                raise
+            with self.lock:
+                self.content_paths.setdefault(file_hash, set()).add(content_path)
+        return file_hash, content_path
+
+    def unpin(self, file_hash):
+        """
+        Lets a blob be evicted again once no run uses it, this does not touch the disk
+        """
+        with self.lock:
+            count = self.pins.get(file_hash, 0) - 1
+            if count > 0:
+                self.pins[file_hash] = count
+            else:
+                self.pins.pop(file_hash, None)
+
+    def remove_partial(self, file_hash):
+        # the lock must be held
+        size, _ = self.partials.pop(file_hash)
+        self.total_bytes -= size
+        try:
+            remove(self.get_partial_path(file_hash))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error removing partial upload {file_hash}: {e}")
+
+    def claim_partial(self, file_hash):
+        """
+        Provides the partial file where a chunked upload of the given hash is kept, so it can be
+        resumed from another session, or None if another session is uploading it right now
+        """
+        self.ensure_loaded()
+        with self.lock:
+            if file_hash in self.uploading:
+                return None
+            self.uploading.add(file_hash)
+            return self.get_partial_path(file_hash)
+
+    def release_partial(self, file_hash):
+        """
+        Ends the claim of a partial file, what is left of it is counted until it is resumed,
+        evicted or too old
+        """
+        with self.lock:
+            self.uploading.discard(file_hash)
+            previous = self.partials.pop(file_hash, None)
+            if previous is not None:
+                self.total_bytes -= previous[0]
+            try:
+                info = stat(self.get_partial_path(file_hash))
+            except FileNotFoundError:
+                # the upload was completed or discarded
+                return
+            self.partials[file_hash] = (info.st_size, info.st_mtime)
+            self.total_bytes += info.st_size
+            self.evict()
+
+    def collect_partials(self):
+        """
+        Removes the partial files of the uploads that were left unfinished more than
+        partial_max_age seconds ago
+        """
+        if not self.enabled():
+            return
+        self.ensure_loaded()
+        oldest = time.time() - self.partial_max_age
+        with self.lock:
+            for file_hash, (_, mtime) in list(self.partials.items()):
+                if file_hash not in self.uploading and mtime < oldest:
+                    self.remove_partial(file_hash)
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "loaded": self.loaded,
+                "blobs": len(self.blobs),
+                "partials": len(self.partials),
+                "partial_bytes": sum(size for size, _ in self.partials.values()),
+                "uploading": len(self.uploading),
+                "pinned": len(self.pins),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,409 @@
+import json
+import threading
+from os import path, listdir, stat
+from time import monotonic
+
+def get_file_signature(full_path):
+    """
+    The signature of a file is what we use to know if it changed since the last
+    time we read it, it is None if the file does not exist
+    """
+    try:
+        file_stat = stat(full_path)
+    except OSError:
+        return None
+    return (file_stat.st_mtime_ns, file_stat.st_size)
+
+def build_workflow_summary(workflow, workflow_locale_patch=None):
+    """
+    Builds the aihub summary for a workflow, optionally applying a locale patch
+    to the translatable properties of the nodes
+    """
+    # we build the basic data structure for the workflow summary
+    workflow_summary = {"expose":{}, "conditions": []}
+
+    # we will iterate through the nodes to find the AIHubWorkflowController node
+    # and the AIHubExpose nodes, and extract their parameters
+    for nodeId, node in workflow.items():
+
+        # check if it is a AIHubWorkflowController or AIHubExpose node
+        # those are the only nodes we care about for the summary
+        if node.get("class_type") == "AIHubWorkflowController" or node.get("class_type", "").startswith("AIHubExpose") or node.get("class_type") == "AIHubAddRunCondition":
+            # the basic data structure for the node summary
+            data = node.get("inputs", {})
+            data_patch = {}
+            if workflow_locale_patch is not None:
+                # make a shallow copy of data which is a dictionary
+                data = data.copy()
+                # apply the locale patch to the data
+                data_patch = workflow_locale_patch.get(nodeId, {})
+                for key, value in data_patch.items():
+                    if key in ["description", "name", "tooltip", "label", "options_label", "category", "metadata_fields_label", "error"]:
+                        data[key] = value
+
+            # if it is a controller node, we copy all the data to the workflow summary
+            if node.get("class_type") == "AIHubWorkflowController":
+                # put every property of data into workflow_summary
+                for key in data:
+                    workflow_summary[key] = data[key]
+
+            elif node.get("class_type") == "AIHubAddRunCondition":
+                # add a new condition in the conditions list
+                workflow_summary["conditions"].append(data)
+
+            # if it is an AIHubExpose node, we add it to the expose list
+            else:
+                # add a new expose in the expose list
+                id = data.get("id", None)
+
+                # store the expose data
+                workflow_summary["expose"][id] = {
+                    "type": node.get("class_type"),
+                    "data": data,
+                }
+
+    return workflow_summary
+
+def compile_binding_plan(workflow, workflow_summary):
+    """
+    Compiles the binding plan of a workflow, that is, for every expose id the keys
+    of the nodes that receive the value given by the client, so that a request can be
+    applied without scanning all the nodes of the workflow for every expose
+    """
+    bindings = {}
+    for key, node in workflow.items():
+        if node.get("class_type", "").startswith("AIHubExpose"):
+            expose_id = node.get("inputs", {}).get("id", None)
+            if expose_id not in bindings:
+                bindings[expose_id] = []
+            bindings[expose_id].append(key)
+
+    return {
+        # the expose ids that a request must provide, in the order of the summary
+        "exposes": list(workflow_summary["expose"].keys()),
+        # expose id -> list of node keys
+        "bindings": bindings,
+    }
+
+def get_workflow_controller_id(workflow):
+    """
+    Provides the id given in the AIHubWorkflowController node of a workflow
+    or None if the workflow is not a valid AIHub workflow
+    """
+    if workflow is None or not isinstance(workflow, dict):
+        return None
+    for node in workflow.values():
+        if isinstance(node, dict) and node.get("class_type", None) == "AIHubWorkflowController":
+            return node.get("inputs", {}).get("id", None)
+    return None
+
+def resolve_locale_file(locale_dir, locale, id):
+    """
+    Provides the path of the locale file for the given id, falling back to the
+    base language if the specific region does not exist, eg. fi_fi -> fi
+    """
+    locale = locale.lower().replace("-", "_")
+    potential_locale_file = path.join(locale_dir, locale, id + ".json")
+    if "_" in locale and not path.exists(potential_locale_file):
+        potential_locale_file = path.join(locale_dir, locale.split("_")[0], id + ".json")
+    return potential_locale_file
+
+class JsonDirectoryCatalog:
+    """
+    Keeps the parsed json files of a directory in memory, a file is only read again
+    when its mtime or size changed since the last time it was seen, or when it is
+    reloaded explicitly because the server itself wrote it
+
+    In cold mode the directory is only scanned once, the files then only change
+    through reload_file or invalidate; otherwise it is scanned at most once every
+    rescan_interval seconds, 0 scans it every time the catalog is used
+    """
+
+    def __init__(self, directory, kind, cold=False, rescan_interval=0):
+        self.directory = directory
+        self.kind = kind
+        self.cold = cold
+        self.rescan_interval = rescan_interval
+        self.lock = threading.RLock()
+
+        # file name -> entry, where the entry contains the signature and the parsed data
+        self.entries = {}
+        self.loaded = False
+        # the monotonic time of the last scan of the directory
+        self.scanned_at = None
+
+        # increases every time the contents of the catalog change
+        self.version = 0
+
+    def build_entry(self, file_name, data):
+        """
+        Creates the entry for a parsed file, subclasses add whatever they want
+        to precompute from the file here
+        """
+        return {"file": file_name, "data": data}
+
+    def on_changed(self):
+        """
+        Called with the lock held every time the entries changed
+        """
+        pass
+
+    def read_file(self, file_name):
+        with open(path.join(self.directory, file_name), "r", encoding="utf-8") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                print(f"Warning: error decoding JSON from {self.kind} file {file_name}, ignoring it")
+                return None
+
+    def load_file(self, file_name, signature):
+        try:
+            data = self.read_file(file_name)
+        except OSError as e:
+            # the file was removed or is not readable, it will be tried again in the next refresh
+            print(f"Error reading {self.kind} file {file_name}: {e}")
+            return False
+        if not isinstance(data, dict):
+            # the entry is kept with its signature so the file is not read again until it changes,
+            # but it is left out of the catalog
+            if data is not None:
+                print(f"Warning: {self.kind} file {file_name} does not contain a JSON object, ignoring it")
+            data = None
+        entry = self.build_entry(file_name, data)
+        entry["signature"] = signature
+        self.entries[file_name] = entry
+        return True
+
+    def refresh(self):
+        """
+        Synchronizes the catalog with the directory, only the files that changed are parsed
+        """
+        with self.lock:
+            files = []
+            if path.exists(self.directory):
+                files = sorted(f for f in listdir(self.directory) if f.endswith(".json"))
+
+            changed = False
+            for file_name in files:
+                signature = get_file_signature(path.join(self.directory, file_name))
+                if signature is None:
+                    continue
+                entry = self.entries.get(file_name)
+                if entry is not None and entry["signature"] == signature:
+                    continue
+                if self.load_file(file_name, signature):
+                    changed = True
+
+            # files that are gone from the directory
+            existing_files = set(files)
+            for file_name in list(self.entries.keys()):
+                if file_name not in existing_files:
+                    del self.entries[file_name]
+                    changed = True
+
+            if changed or not self.loaded:
+                print(f"Loaded {self.kind} catalog from directory: {self.directory}")
+                self.version += 1
+                self.on_changed()
+            self.loaded = True
+            self.scanned_at = monotonic()
+
+    def ensure_fresh(self):
+        """
+        Makes sure the catalog represents the directory, in cold mode this
+        only happens the first time, otherwise the directory is not scanned again
+        until rescan_interval seconds passed since the last scan
+        """
+        if self.loaded:
+            if self.cold:
+                return
+            if self.rescan_interval > 0 and monotonic() - self.scanned_at < self.rescan_interval:
+                return
+        self.refresh()
+
+    def reload_file(self, file_name):
+        """
+        Forces a file to be read again, this is used when the server writes
+        the file itself so we do not depend on the mtime resolution of the filesystem
+        """
+        with self.lock:
+            if not self.loaded:
+                self.refresh()
+                return
+            signature = get_file_signature(path.join(self.directory, file_name))
+            if signature is None:
+                if file_name in self.entries:
+                    del self.entries[file_name]
+            elif not self.load_file(file_name, signature):
+                return
+            self.version += 1
+            self.on_changed()
+
+    def invalidate(self):
+        """
+        Forgets everything that was read, the next access reads the directory again
+        """
+        with self.lock:
+            self.entries = {}
+            self.loaded = False
+            self.version += 1
+            self.on_changed()
+
+    def values(self):
+        """
+        Provides the parsed data of all the valid files in the catalog
+        """
+        with self.lock:
+            self.ensure_fresh()
+            return [entry["data"] for entry in self.entries.values() if entry["data"] is not None]
+
+class WorkflowCatalog(JsonDirectoryCatalog):
+    """
+    The workflow catalog keeps the workflows indexed by their controller id
+    and their aihub summaries precomputed, so that listing the workflows to a client
+    and finding the workflow for a run do not need to parse or scan anything
+    """
+
+    def __init__(self, directory, locale_directory, cold=False, rescan_interval=0):
+        self.locale_directory = locale_directory
+
+        # workflow id -> entry
+        self.by_id = {}
+        # workflow id -> default summary, this is the object given to the clients
+        self.summaries = {}
+        # (workflow id, locale) -> cached localized summary with the signatures it was built from
+        self.locale_summaries = {}
+
+        super().__init__(directory, "workflow", cold=cold, rescan_interval=rescan_interval)
+
+    def build_entry(self, file_name, data):
+        entry = super().build_entry(file_name, data)
+        workflow_id = get_workflow_controller_id(data)
+        entry["id"] = workflow_id
+        entry["summary"] = build_workflow_summary(data) if workflow_id is not None else None
+        entry["plan"] = compile_binding_plan(data, entry["summary"]) if workflow_id is not None else None
+        return entry
+
+    def on_changed(self):
+        by_id = {}
+        summaries = {}
+        for entry in self.entries.values():
+            if entry["summary"] is None:
+                continue
+            workflow_id = entry["summary"].get("id")
+
+            # check for duplicate workflow ids
+            if workflow_id in by_id:
+                print("Warning: duplicate workflow id found, overwriting previous workflow with id " + str(workflow_id))
+
+            by_id[workflow_id] = entry
+            summaries[workflow_id] = entry["summary"]
+
+        self.by_id = by_id
+        self.summaries = summaries
+
+        # drop the localized summaries of workflows that do not exist anymore
+        # the rest are validated against their signatures when requested
+        for key in list(self.locale_summaries.keys()):
+            if key[0] not in by_id:
+                del self.locale_summaries[key]
+
+    def invalidate(self):
+        with self.lock:
+            self.locale_summaries = {}
+            super().invalidate()
+
+    def clear_locale_cache(self):
+        """
+        Forgets the localized summaries, used when a locale file is written
+        """
+        with self.lock:
+            self.locale_summaries = {}
+
+    def valid_workflows(self):
+        with self.lock:
+            self.ensure_fresh()
+            return [entry["data"] for entry in self.entries.values() if entry["summary"] is not None]
+
+    def get_entry(self, workflow_id):
+        """
+        Provides the entry of a workflow by its id, only the file of that workflow is checked
+        for changes; the directory is only scanned, as often as ensure_fresh allows, when the
+        id is not known since the workflow may have been added after the last scan
+        """
+        with self.lock:
+            if not self.loaded:
+                self.refresh()
+            entry = self.by_id.get(workflow_id, None)
+            if self.cold:
+                return entry
+            if entry is None:
+                self.ensure_fresh()
+                return self.by_id.get(workflow_id, None)
+            if get_file_signature(path.join(self.directory, entry["file"])) != entry["signature"]:
+                # the workflow may be gone or have another id now
+                self.reload_file(entry["file"])
+                entry = self.by_id.get(workflow_id, None)
+            return entry
+
+    def get_workflow(self, workflow_id):
+        entry = self.get_entry(workflow_id)
+        return entry["data"] if entry is not None else None
+
+    def get_plan(self, workflow_id):
+        entry = self.get_entry(workflow_id)
+        return entry["plan"] if entry is not None else None
+
+    def get_summary(self, workflow_id):
+        entry = self.get_entry(workflow_id)
+        return entry["summary"] if entry is not None else None
+
+    def get_localized_summary(self, entry, locale):
+        """
+        Provides the summary of a workflow with the locale patch applied, the result
+        is kept until either the workflow or the locale file changes
+        """
+        workflow_id = entry["summary"].get("id")
+        key = (workflow_id, locale)
+        cached = self.locale_summaries.get(key)
+        if cached is not None and cached["entry"] is entry and self.cold:
+            return cached["summary"]
+
+        locale_file = resolve_locale_file(self.locale_directory, locale, str(workflow_id))
+        locale_signature = get_file_signature(locale_file)
+        if cached is not None and cached["entry"] is entry and cached["locale_file"] == locale_file and cached["locale_signature"] == locale_signature:
+            return cached["summary"]
+
+        workflow_locale_patch = None
+        if locale_signature is not None:
+            with open(locale_file, "r", encoding="utf-8") as f:
+                try:
+                    workflow_locale_patch = json.load(f)
+                except json.JSONDecodeError:
+                    print(f"Error decoding JSON from workflow locale file: {locale_file}")
+
+        summary = entry["summary"]
+        if workflow_locale_patch is not None:
+            summary = build_workflow_summary(entry["data"], workflow_locale_patch)
+
+        self.locale_summaries[key] = {
+            "entry": entry,
+            "locale_file": locale_file,
+            "locale_signature": locale_signature,
+            "summary": summary,
+        }
+        return summary
+
+    def get_summaries(self, locale=None):
+        """
+        Provides all the workflow summaries by workflow id for the given locale
+        """
+        with self.lock:
+            self.ensure_fresh()
+            if locale is None or locale == "default":
+                return self.summaries
+
+            aihub_summaries = {}
+            for workflow_id, entry in self.by_id.items():
+                aihub_summaries[workflow_id] = self.get_localized_summary(entry, locale)
+            return aihub_summaries
@@ -0,0 +1,44 @@
+import asyncio
+import json
+from functools import partial
+from os import environ, path, makedirs
+from concurrent.futures import ThreadPoolExecutor
+
+# the filesystem operations of the server run in these threads instead of the server loop, so a slow
+# disk or a network mounted AIHUB_DIR delays only the request that is waiting for it and not the
+# pings and the progress of every other client
+AIHUB_IO_WORKERS = max(1, int(environ.get("AIHUB_IO_WORKERS", 8)))
+IO_POOL = ThreadPoolExecutor(max_workers=AIHUB_IO_WORKERS, thread_name_prefix="aihub-io")
+
+async def run_io(fn, *args, **kwargs):
+    """
+    Runs a blocking function in the io threads and waits for its result
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(IO_POOL, partial(fn, *args, **kwargs))
+
+def write_json_file(file_path, data):
+    directory = path.dirname(file_path)
+    if directory and not path.exists(directory):
+        makedirs(directory, exist_ok=True)
+    with open(file_path, "w") as f:
+        json.dump(data, f)
+
+def write_binary_file(file_path, data):
+    with open(file_path, "wb") as f:
+        f.write(data)
+
+def is_file(file_path):
+    return path.exists(file_path) and path.isfile(file_path)
+
+async def write_json(file_path, data):
+    await run_io(write_json_file, file_path, data)
+
+async def write_binary(file_path, data):
+    await run_io(write_binary_file, file_path, data)
+
+async def file_exists(file_path):
+    return await run_io(is_file, file_path)
+
+async def make_dirs(directory):
+    await run_io(makedirs, directory, exist_ok=True)
@@ -0,0 +1,221 @@
+import io
+import struct
+from collections import deque
+from os import environ, cpu_count
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from PIL import Image
+import numpy as np
+import torch
+from nodes import LoadImage
+
+from .inputcache import DECODE_CACHE, get_stat_key
+
+# the images are encoded and decoded in a pool of threads, PIL releases the GIL while
+# compressing and decompressing so a batch of images is processed in parallel
+AIHUB_ENCODE_WORKERS = max(1, int(environ.get("AIHUB_ENCODE_WORKERS", min(8, cpu_count() or 1))))
+ENCODE_POOL = ThreadPoolExecutor(max_workers=AIHUB_ENCODE_WORKERS, thread_name_prefix="aihub-encode")
+
+def images_to_uint8(images, masks=None):
+    """
+    Converts a batch of image tensors (B, H, W, C) with values from 0 to 1 into a uint8 numpy
+    array (B, H, W, C), if masks (B, H, W) are given they become the alpha channel and the
+    result is RGBA (B, H, W, 4)
+
+    The scaling and the conversion happen on the device of the tensors and the result is copied
+    to the cpu only once, the frames of the result can be given to the encoders as they are
+    """
+    with torch.no_grad():
+        converted = images.mul(255).clamp_(0, 255).to(torch.uint8)
+        if masks is not None:
+            if masks.dim() == 2:
+                masks = masks.unsqueeze(0)
+            if masks.shape[0] > converted.shape[0]:
+                masks = masks[:converted.shape[0]]
+            elif masks.shape[0] == 1 and converted.shape[0] > 1:
+                masks = masks.expand(converted.shape[0], -1, -1)
+            if masks.shape[1:] != converted.shape[1:3] or masks.shape[0] != converted.shape[0]:
+                print(f"Error adding alpha channel: mask of shape {tuple(masks.shape)} does not match images of shape {tuple(images.shape)}")
+            else:
+                alpha = masks.to(converted.device).mul(255).clamp_(0, 255).to(torch.uint8)
+                converted = torch.cat((converted[..., :3], alpha.unsqueeze(-1)), dim=-1)
+        return converted.cpu().numpy()
+
+def image_to_pil(c_image, c_mask=None):
+    """
+    Converts a single image tensor (H, W, C) and an optional mask (H, W) into a PIL image,
+    the mask becomes the alpha channel
+    """
+    return Image.fromarray(images_to_uint8(c_image.unsqueeze(0), c_mask.unsqueeze(0) if c_mask is not None else None)[0])
+
+# the encodings an image action can use to send its images to the client
+IMAGE_ENCODINGS = ["png", "webp_lossless", "webp", "jpeg", "raw_rgba8"]
+IMAGE_ENCODING_TYPES = {
+    "png": "image/png",
+    "webp_lossless": "image/webp",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "raw_rgba8": "image/x-aihub-rgba8",
+}
+IMAGE_ENCODING_EXTENSIONS = {
+    "png": ".png",
+    "webp_lossless": ".webp",
+    "webp": ".webp",
+    "jpeg": ".jpg",
+    "raw_rgba8": ".rgba",
+}
+
+# the raw encoding is the magic, the width and the height as little endian uint32 followed by the RGBA8 pixels row by row
+RAW_RGBA8_MAGIC = b"AIHR"
+RAW_RGBA8_HEADER = struct.Struct("<4sII")
+
+def get_image_encoding_inputs():
+    """
+    The optional inputs of the nodes that let the workflow choose how the images are encoded
+    """
+    return {
+        "encoding": (IMAGE_ENCODINGS, {"default": "png", "tooltip": "How the image is encoded to be sent to the client, png and webp_lossless are lossless, webp and jpeg use the quality value, raw_rgba8 is not compressed at all and is the fastest for clients on the same machine; jpeg does not keep the mask"}),
+        "quality": ("INT", {"default": 95, "min": 1, "max": 100, "tooltip": "The quality for the webp and jpeg encodings"}),
+        "compress_level": ("INT", {"default": 6, "min": 0, "max": 9, "tooltip": "The compression level for the png encoding, lower is faster but bigger"}),
+    }
+
+def encode_raw_rgba8(pixels):
+    """
+    Encodes an uint8 array (H, W, 3 or 4) as raw RGBA8, the pixels are copied straight
+    after the header without any intermediate copy when they already are RGBA
+    """
+    height, width, channels = pixels.shape
+    if channels != 4:
+        rgba = np.empty((height, width, 4), dtype=np.uint8)
+        rgba[..., :3] = pixels[..., :3]
+        rgba[..., 3] = 255
+        pixels = rgba
+    data = bytearray(RAW_RGBA8_HEADER.size + pixels.nbytes)
+    RAW_RGBA8_HEADER.pack_into(data, 0, RAW_RGBA8_MAGIC, width, height)
+    np.frombuffer(data, dtype=np.uint8, offset=RAW_RGBA8_HEADER.size).reshape(pixels.shape)[...] = pixels
+    return data
+
+def encode_image(img, encoding="png", quality=95, compress_level=6):
+    """
+    Encodes an image with the given encoding, see IMAGE_ENCODINGS, the image can be a PIL
+    image or an uint8 array (H, W, C) as given by images_to_uint8
+    """
+    if encoding == "raw_rgba8":
+        if isinstance(img, np.ndarray):
+            return encode_raw_rgba8(img)
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+        return encode_raw_rgba8(np.asarray(img))
+
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+
+    img_bytes = io.BytesIO()
+    if encoding == "png":
+        img.save(img_bytes, format='PNG', compress_level=compress_level, optimize=False)
+    elif encoding == "webp_lossless":
+        img.save(img_bytes, format='WEBP', lossless=True)
+    elif encoding == "webp":
+        img.save(img_bytes, format='WEBP', quality=quality)
+    elif encoding == "jpeg":
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        # no chroma subsampling at high qualities, it is what makes the edges blurry
+        img.save(img_bytes, format='JPEG', quality=quality, subsampling=0 if quality >= 90 else 2)
+    else:
+        raise ValueError(f"Unknown image encoding {encoding}")
+    return img_bytes.getvalue()
+
+def get_image_file_name(name, encoding="png"):
+    """
+    The default file name of an image with the extension of its encoding
+    """
+    extension = IMAGE_ENCODING_EXTENSIONS[encoding]
+    file_name = name
+    if not file_name.lower().endswith(extension):
+        file_name += extension
+    # replace spaces with underscores
+    return file_name.replace(" ", "_")
+
+def encode_as_completed(count, encode_fn, max_in_flight=None):
+    """
+    Calls encode_fn(index) for every index in the pool and yields (index, result) as soon
+    as each one is ready, which is not necessarily in order
+
+    Only a few more than the workers are in flight at once so that a large batch does not hold
+    every encoded image in memory while the client is still receiving the first ones
+    """
+    if max_in_flight is None:
+        max_in_flight = AIHUB_ENCODE_WORKERS * 2
+
+    pending = {}
+    next_index = 0
+    try:
+        while next_index < count or len(pending) > 0:
+            while next_index < count and len(pending) < max_in_flight:
+                pending[ENCODE_POOL.submit(encode_fn, next_index)] = next_index
+                next_index += 1
+
+            done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda f: pending[f]):
+                index = pending.pop(future)
+                yield index, future.result()
+    finally:
+        # the consumer stopped early or an encoding failed, the rest is not needed
+        for future in pending.keys():
+            future.cancel()
+
+def encode_in_order(count, encode_fn, max_in_flight=None):
+    """
+    Like encode_as_completed but yields (index, result) in the order of the indexes, the results
+    that are ready before the ones in front of them wait until those are ready; only a few more
+    than the workers are in flight at once, counting the ones that are waiting
+    """
+    if max_in_flight is None:
+        max_in_flight = AIHUB_ENCODE_WORKERS * 2
+
+    pending = deque()
+    next_index = 0
+    try:
+        while next_index < count or len(pending) > 0:
+            while next_index < count and len(pending) < max_in_flight:
+                pending.append(ENCODE_POOL.submit(encode_fn, next_index))
+                next_index += 1
+
+            future = pending.popleft()
+            yield next_index - len(pending) - 1, future.result()
+    finally:
+        # the consumer stopped early or an encoding failed, the rest is not needed
+        for future in pending:
+            future.cancel()
+
+def load_image_file(file_path):
+    """
+    Decodes an image file with the logic of the LoadImage node, provides the image and its mask
+
+    The decoded images are kept in the decode cache by the stat key of the file, so the same
+    file is not read or decoded again on every run
+    """
+    key = None
+    if DECODE_CACHE.enabled():
+        key = ("image", get_stat_key(file_path))
+        cached = DECODE_CACHE.get(key)
+        if cached is not None:
+            return cached
+
+    image, mask = LoadImage().load_image(file_path)
+    # comfyui has a bug where masks are inverted, so we need to invert it back
+    if mask is not None:
+        mask = 1.0 - mask
+
+    if key is not None:
+        # the cache keeps its own copies, what is given to the workflow can be modified
+        DECODE_CACHE.put(key, tuple(tensor.clone() if tensor is not None else None for tensor in (image, mask)))
+    return image, mask
+
+def load_images_as_completed(file_paths, max_in_flight=None):
+    """
+    Decodes image files in the pool and yields (index, (image, mask)) as soon as each
+    one is ready, the index is the position of the file in file_paths
+    """
+    return encode_as_completed(len(file_paths), lambda i: load_image_file(file_paths[i]), max_in_flight)
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from os import environ, path, stat
+
+from .blobs import hash_file
+
+# how many bytes of decoded inputs are kept in memory, 0 disables the cache
+AIHUB_DECODE_CACHE_BYTES = int(environ.get("AIHUB_DECODE_CACHE_BYTES", 1024 * 1024 * 1024))  # 1 GB
+
+# how many file versions have their hash remembered
+FINGERPRINT_MEMO_SIZE = 4096
+
+# the fingerprints given to IS_CHANGED hash this many bytes from the start, the middle and the
+# end of a file instead of all of it, the smaller files are hashed whole
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+FINGERPRINT_MEMO = OrderedDict()
+FINGERPRINT_MEMO_LOCK = threading.Lock()
+
+# path -> (stat key, sampled fingerprint, fingerprint) of what IS_CHANGED gave last for every local file
+PATH_FINGERPRINTS = OrderedDict()
+
+def get_stat_key(file_path):
+    info = stat(file_path)
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+def remember(memo, key, value):
+    # the lock must be held
+    memo[key] = value
+    memo.move_to_end(key)
+    while len(memo) > FINGERPRINT_MEMO_SIZE:
+        memo.popitem(last=False)
+
+def memoized_hash(kind, stat_key, compute):
+    key = (kind, stat_key)
+    with FINGERPRINT_MEMO_LOCK:
+        digest = FINGERPRINT_MEMO.get(key)
+        if digest is not None:
+            FINGERPRINT_MEMO.move_to_end(key)
+            return digest
+
+    digest = compute()
+    with FINGERPRINT_MEMO_LOCK:
+        remember(FINGERPRINT_MEMO, key, digest)
+    return digest
+
+def sample_file(file_path, size):
+    """
+    Provides the sha256 of the size of a file and of three samples of its content
+    """
+    digest = hashlib.sha256()
+    digest.update(str(size).encode())
+    with open(file_path, "rb") as f:
+        for offset in (0, (size - FINGERPRINT_SAMPLE_SIZE) // 2, size - FINGERPRINT_SAMPLE_SIZE):
+            f.seek(offset)
+            digest.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+    return digest.hexdigest()
+
+def file_fingerprint(file_path, stat_key=None):
+    """
+    Provides the sha256 of the content of a file, the hash is remembered for as long as the
+    file keeps its size and modification time so it is computed once per version of the file;
+    the files hardlinked from the blob store share it between all the sessions
+    """
+    if stat_key is None:
+        stat_key = get_stat_key(file_path)
+    return memoized_hash("full", stat_key, lambda: hash_file(file_path))
+
+def sampled_fingerprint(file_path, stat_key=None):
+    """
+    Like file_fingerprint but only reads a few samples of the larger files, so it is cheap
+    enough for videos; two files with the same fingerprint are very likely the same but
+    not for sure, which the full hash is for
+    """
+    if stat_key is None:
+        stat_key = get_stat_key(file_path)
+    size = stat_key[2]
+    if size <= 3 * FINGERPRINT_SAMPLE_SIZE:
+        return file_fingerprint(file_path, stat_key)
+    return "sampled:" + memoized_hash("sampled", stat_key, lambda: sample_file(file_path, size))
+
+def local_file_fingerprint(local_file):
+    """
+    The fingerprint of the local_file of an expose node, meant to be given by IS_CHANGED so
+    comfyui reuses the outputs of the node while the file has the same content
+
+    The file is not read again while its size and modification time stay the same, and only
+    sampled when they change; when it was written again and the samples did not change, the
+    full hash tells whether it is the same file, and from then on the full hash is given for
+    that path so the fingerprint stays the same while the content does
+    """
+    if not local_file or not path.isfile(local_file):
+        return ""
+    stat_key = get_stat_key(local_file)
+    with FINGERPRINT_MEMO_LOCK:
+        previous = PATH_FINGERPRINTS.get(local_file)
+    if previous is not None and previous[0] == stat_key:
+        return previous[2]
+
+    sampled = sampled_fingerprint(local_file, stat_key)
+    fingerprint = sampled
+    if previous is not None and sampled.startswith("sampled:"):
+        # the previous fingerprint was the full hash when it differs from the sampled one
+        if previous[1] == sampled or previous[2] != previous[1]:
+            fingerprint = file_fingerprint(local_file, stat_key)
+
+    with FINGERPRINT_MEMO_LOCK:
+        remember(PATH_FINGERPRINTS, local_file, (stat_key, sampled, fingerprint))
+    return fingerprint
+
+def local_files_fingerprint(local_files):
+    """
+    The fingerprint of the local_files of an expose node, a JSON array of paths
+    """
+    try:
+        filenames = json.loads(local_files) if local_files else []
+    except json.JSONDecodeError:
+        return ""
+    if not isinstance(filenames, list):
+        return ""
+    return ",".join(local_file_fingerprint(filename) if isinstance(filename, str) else "" for filename in filenames)
+
+class DecodedCache:
+    """
+    The inputs that were decoded recently, up to a budget of bytes, the ones used least recently
+    are dropped first; they are found by the stat key of their file, so a file is not even read
+    again while it is the same, and the hardlinks of the blob store share the entry between the sessions
+
+    Every get provides copies of the cached tensors, so a workflow that modifies them in place
+    does not change what the next run gets
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (value, bytes)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            value = entry[0]
+        return tuple(tensor.clone() if tensor is not None else None for tensor in value)
+
+    def put(self, key, value):
+        """
+        Keeps a tuple of tensors, the ones that are None take no room; the tensors are kept as
+        they are, the caller must not modify them afterwards
+        """
+        size = sum(tensor.numel() * tensor.element_size() for tensor in value if tensor is not None)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+DECODE_CACHE = DecodedCache(AIHUB_DECODE_CACHE_BYTES)
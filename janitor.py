@@ -0,0 +1,210 @@
+import asyncio
+import re
+import shutil
+import threading
+import time
+import uuid
+from os import getpid, path, scandir, walk
+
+import psutil
+
+from .fsio import run_io
+
+# session directories are named after the process that made them, so the ones left behind
+# by a process that is not running anymore can be told apart
+SESSION_DIR_PATTERN = re.compile(r'^(?:(\d+)-)?[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+def get_directory_size(directory):
+    total = 0
+    for root, _, files in walk(directory):
+        for name in files:
+            try:
+                total += path.getsize(path.join(root, name))
+            except OSError:
+                # removed meanwhile
+                pass
+    return total
+
+class SessionJanitor:
+    """
+    Keeps track of the directories where the websocket sessions store their files and
+    removes them in the io threads once the session is over, as well as the ones left
+    behind by previous runs of the server
+
+    A session cannot store more than session_max_bytes, and all the sessions together
+    not more than total_max_bytes; when persist is set the directories of the sessions
+    that are over are kept until the room is needed, the oldest are removed first
+
+    The sizes are measured on every sweep and the uploads are added in between, the
+    directories that are not sessions (eg. the blob store) are never touched, they can be
+    cleaned up by the extra_sweeps, functions that run in the io threads with every sweep
+    """
+
+    def __init__(self, root, session_max_bytes, total_max_bytes, persist=False, interval=60, extra_sweeps=None):
+        self.root = root
+        self.session_max_bytes = session_max_bytes
+        self.total_max_bytes = total_max_bytes
+        self.persist = persist
+        self.interval = interval
+        self.extra_sweeps = extra_sweeps or []
+
+        self.lock = threading.Lock()
+        # directory -> {"active", "bytes", "ended_at"}
+        self.sessions = {}
+        self.wakeup = None
+        self.task = None
+
+    def new_session_dir(self):
+        """
+        Provides the directory for a new session, it must be created by the caller
+        """
+        session_dir = path.join(self.root, f"{getpid()}-{uuid.uuid4()}")
+        with self.lock:
+            self.sessions[session_dir] = {"active": True, "bytes": 0, "ended_at": None}
+        return session_dir
+
+    def end_session(self, session_dir):
+        """
+        Marks a session as over, its directory is removed by the next sweep unless persisted,
+        must be called from the server loop
+        """
+        with self.lock:
+            session = self.sessions.get(session_dir)
+            if session is None:
+                return
+            session["active"] = False
+            session["ended_at"] = time.time()
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def check_quota(self, session_dir, incoming_bytes):
+        """
+        Provides an error message if storing incoming_bytes more in the session would go over
+        a quota, or None if they fit
+        """
+        with self.lock:
+            session = self.sessions.get(session_dir)
+            session_bytes = session["bytes"] if session is not None else 0
+            if self.session_max_bytes > 0 and session_bytes + incoming_bytes > self.session_max_bytes:
+                return f"The files of this session would go over the limit of {self.session_max_bytes} bytes"
+            if self.total_max_bytes > 0:
+                # what the persisted sessions use can be freed
+                total_bytes = sum(s["bytes"] for s in self.sessions.values() if s["active"])
+                if total_bytes + incoming_bytes > self.total_max_bytes:
+                    return "The server does not have room for more files right now"
+        return None
+
+    def account(self, session_dir, added_bytes):
+        """
+        Adds what was just stored in a session to its size, until the next sweep measures it
+        """
+        with self.lock:
+            session = self.sessions.get(session_dir)
+            if session is not None:
+                session["bytes"] += added_bytes
+
+    def remove(self, session_dir):
+        try:
+            if path.exists(session_dir):
+                shutil.rmtree(session_dir)
+        except Exception as e:
+            print(f"Error cleaning up socket file directory {session_dir}: {e}")
+
+    def collect_stale(self):
+        """
+        Finds the session directories of processes that are not running anymore, they are
+        removed or, when persisting, kept as sessions that are over
+        """
+        if not path.exists(self.root):
+            return
+        own_pid = getpid()
+        for entry in scandir(self.root):
+            if not entry.is_dir():
+                continue
+            match = SESSION_DIR_PATTERN.match(entry.name)
+            if match is None:
+                continue
+            # directories without a pid are from older versions
+            pid = int(match.group(1)) if match.group(1) is not None else None
+            if pid == own_pid or (pid is not None and psutil.pid_exists(pid)):
+                continue
+            with self.lock:
+                self.sessions.setdefault(entry.path, {"active": False, "bytes": 0, "ended_at": entry.stat().st_mtime})
+
+    def sweep(self):
+        """
+        Measures the sessions and removes the ones that are over, and the oldest persisted
+        ones while all of them together are over the quota
+        """
+        with self.lock:
+            known = list(self.sessions.keys())
+        sizes = {session_dir: get_directory_size(session_dir) for session_dir in known if path.exists(session_dir)}
+
+        to_remove = []
+        with self.lock:
+            for session_dir in known:
+                session = self.sessions.get(session_dir)
+                if session is None:
+                    continue
+                if session_dir not in sizes and not session["active"]:
+                    # already gone
+                    del self.sessions[session_dir]
+                    continue
+                session["bytes"] = sizes.get(session_dir, 0)
+                if not session["active"] and not self.persist:
+                    to_remove.append(session_dir)
+
+            if self.persist and self.total_max_bytes > 0:
+                total_bytes = sum(s["bytes"] for s in self.sessions.values())
+                ended = sorted(
+                    (s["ended_at"], session_dir) for session_dir, s in self.sessions.items() if not s["active"]
+                )
+                for _, session_dir in ended:
+                    if total_bytes <= self.total_max_bytes:
+                        break
+                    total_bytes -= self.sessions[session_dir]["bytes"]
+                    to_remove.append(session_dir)
+
+            for session_dir in to_remove:
+                del self.sessions[session_dir]
+
+        for session_dir in to_remove:
+            self.remove(session_dir)
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "sessions": sum(1 for s in self.sessions.values() if s["active"]),
+                "ended_sessions": sum(1 for s in self.sessions.values() if not s["active"]),
+                "total_bytes": sum(s["bytes"] for s in self.sessions.values()),
+                "session_max_bytes": self.session_max_bytes,
+                "total_max_bytes": self.total_max_bytes,
+            }
+
+    def start(self):
+        """
+        Starts sweeping in the background, must be called from the server loop
+        """
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        try:
+            await run_io(self.collect_stale)
+        except Exception as e:
+            print(f"Error looking for old socket file directories: {e}")
+        while True:
+            try:
+                await run_io(self.sweep)
+            except Exception as e:
+                print(f"Error cleaning up socket file directories: {e}")
+            for extra_sweep in self.extra_sweeps:
+                try:
+                    await run_io(extra_sweep)
+                except Exception as e:
+                    print(f"Error cleaning up socket files: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
@@ -0,0 +1,151 @@
+import base64
+import json
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import torch
+import comfy.model_management
+from safetensors import safe_open
+
+from .inputcache import get_stat_key, remember
+
+# the storage types a latent can be sent as, the latents are always float32 once loaded
+LATENT_DTYPES = {
+    "float32": (torch.float32, "F32"),
+    "float16": (torch.float16, "F16"),
+    "bfloat16": (torch.bfloat16, "BF16"),
+}
+
+LOADABLE_LATENT_DTYPES = {torch_dtype for torch_dtype, _ in LATENT_DTYPES.values()}
+
+# full keeps the metadata as comfyui writes it, compressed compresses the values that are
+# larger than LATENT_METADATA_COMPRESS_THRESHOLD and none leaves the metadata out
+LATENT_METADATA_MODES = ["full", "compressed", "none"]
+LATENT_METADATA_COMPRESS_THRESHOLD = 4096
+LATENT_METADATA_COMPRESSED_PREFIX = "zlib+base64:"
+
+# the stat keys of the latent files whose metadata was decoded without errors, so the same
+# file is only decoded once however many times it is loaded
+DECODED_METADATA_KEYS = OrderedDict()
+DECODED_METADATA_LOCK = threading.Lock()
+
+# the latents saved before the format was versioned were scaled
+LEGACY_LATENT_MULTIPLIER = 1.0 / 0.18215
+
+def encode_latent_metadata(metadata, mode="full"):
+    """
+    Provides the metadata to store in a latent file for the given mode, or None
+    if there is none to store
+    """
+    if metadata is None or mode == "none":
+        return None
+    if mode == "full":
+        return metadata
+    compressed = {}
+    for key, value in metadata.items():
+        if len(value) > LATENT_METADATA_COMPRESS_THRESHOLD:
+            value = LATENT_METADATA_COMPRESSED_PREFIX + base64.b64encode(zlib.compress(value.encode("utf-8"), 9)).decode("ascii")
+        compressed[key] = value
+    return compressed
+
+def decode_latent_metadata(metadata):
+    """
+    Reverses encode_latent_metadata, the values that were not compressed are given as they are,
+    raises ValueError if a compressed value is damaged
+    """
+    if metadata is None:
+        return None
+    decoded = {}
+    for key, value in metadata.items():
+        if value.startswith(LATENT_METADATA_COMPRESSED_PREFIX):
+            try:
+                value = zlib.decompress(base64.b64decode(value[len(LATENT_METADATA_COMPRESSED_PREFIX):], validate=True)).decode("utf-8")
+            except (ValueError, zlib.error) as e:
+                raise ValueError(f"The metadata {key} of the latent is damaged: {e}")
+        decoded[key] = value
+    return decoded
+
+def check_latent_metadata(path, metadata):
+    """
+    Makes sure the metadata of a latent file decodes, see decode_latent_metadata, the check is
+    only done again once the file changes
+    """
+    if metadata is None:
+        return
+    stat_key = get_stat_key(path)
+    with DECODED_METADATA_LOCK:
+        if stat_key in DECODED_METADATA_KEYS:
+            DECODED_METADATA_KEYS.move_to_end(stat_key)
+            return
+    decode_latent_metadata(metadata)
+    with DECODED_METADATA_LOCK:
+        remember(DECODED_METADATA_KEYS, stat_key, True)
+
+def latent_to_safetensors(samples, dtype="float32", metadata=None):
+    """
+    Serializes a latent tensor as a safetensors file in the format the expose latent nodes read
+
+    The tensor is converted on its device and copied straight after the header, unlike
+    safetensors.torch.save there is no intermediate copy of the whole file
+    """
+    torch_dtype, safetensors_dtype = LATENT_DTYPES[dtype]
+    with torch.no_grad():
+        tensor = samples.to(dtype=torch_dtype).contiguous().cpu()
+    nbytes = tensor.numel() * tensor.element_size()
+
+    header = {
+        "latent_tensor": {"dtype": safetensors_dtype, "shape": list(tensor.shape), "data_offsets": [0, nbytes]},
+        "latent_format_version_0": {"dtype": "F32", "shape": [0], "data_offsets": [nbytes, nbytes]},
+    }
+    if metadata:
+        header["__metadata__"] = metadata
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # the data must start aligned to 8 bytes, the header is padded with spaces
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    data = bytearray(8 + len(header_bytes) + nbytes)
+    struct.pack_into("<Q", data, 0, len(header_bytes))
+    data[8:8 + len(header_bytes)] = header_bytes
+    if nbytes > 0:
+        # bfloat16 has no numpy type, the bytes are copied as they are
+        data[8 + len(header_bytes):] = tensor.reshape(-1).view(torch.uint8).numpy()
+    return data
+
+def load_latent(path):
+    """
+    Loads a latent file saved by the new latent action, the file is memory mapped and
+    the tensor is converted to float32 and scaled in a single step on the intermediate
+    device of comfyui
+
+    The file is checked before it is used, the tensor must have one of the latent dtypes
+    and at least a batch, a channel and a spatial dimension, and its metadata must decode
+    the first time the file is loaded
+    """
+    with safe_open(path, framework="pt", device="cpu") as f:
+        keys = f.keys()
+        if "latent_tensor" not in keys:
+            raise ValueError("The file is not a latent, it has no latent_tensor")
+        check_latent_metadata(path, f.metadata())
+        tensor = f.get_tensor("latent_tensor")
+
+    if tensor.dtype not in LOADABLE_LATENT_DTYPES:
+        raise ValueError(f"The latent has the unsupported dtype {tensor.dtype}")
+    if tensor.dim() < 3:
+        raise ValueError(f"The latent has the shape {list(tensor.shape)}, it needs at least 3 dimensions")
+
+    multiplier = 1.0
+    if "latent_format_version_0" not in keys:
+        multiplier = LEGACY_LATENT_MULTIPLIER
+
+    device = comfy.model_management.intermediate_device()
+    with torch.no_grad():
+        # half precision latents are moved before they are converted so half as much is copied
+        tensor = tensor.to(device=device)
+        if tensor.dtype != torch.float32:
+            tensor = tensor.to(dtype=torch.float32)
+        if multiplier != 1.0:
+            # the tensor is not shared with anything, it is scaled in place
+            tensor.mul_(multiplier)
+    return {"samples": tensor}
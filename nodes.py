@@ -5,16 +5,18 @@ from nodes import LoadImage, CheckpointLoaderSimple, LoraLoader, UNETLoader, Lor
 from folder_paths import get_filename_list
 import json
 import torch
-import torchaudio
 import random
 import comfy.samplers
-import safetensors.torch
 from comfy.cli_args import args
 from comfy_extras.nodes_audio import load as load_audio_file
 from torch.nn.functional import interpolate
 from comfy.utils import common_upscale
 from comfy_api.latest import InputImpl, Types
-from .video import video_save_to
+from .video import video_save_to, ChunkWriter
+from .latents import latent_to_safetensors, encode_latent_metadata, load_latent, LATENT_DTYPES, LATENT_METADATA_MODES
+from .audio import send_audio, AUDIO_POOL, get_audio_encoding_inputs, get_audio_file_name, AUDIO_FORMATS, AUDIO_FORMAT_TYPES
+from .inputcache import local_file_fingerprint, local_files_fingerprint
+from .imaging import ENCODE_POOL, load_images_as_completed, load_image_file, image_to_pil, images_to_uint8, encode_image, encode_in_order, get_image_encoding_inputs, get_image_file_name, IMAGE_ENCODING_TYPES
 from nodes import NODE_CLASS_MAPPINGS
 
 from PIL import Image
@@ -30,7 +32,7 @@ import numpy as np
 #import LoadVideoPath
 
 #from server import PromptServer, BinaryEventTypes
-from .server import AIHubServer
+from .server import AIHubServer, invalidate_aihub_cache
 
 SERVER = AIHubServer()
 SERVER.start_server()
@@ -569,6 +571,11 @@ class AIHubExposeImage:
     RETURN_TYPES = ("IMAGE", "MASK", "INT", "INT", "STRING", "INT", "INT",)
     RETURN_NAMES = ("IMAGE", "MASK", "POS_X", "POS_Y", "LAYER_ID", "WIDTH", "HEIGHT",)
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -601,15 +608,8 @@ class AIHubExposeImage:
         mask = None
         if local_file is not None:
             if (local_file and os.path.exists(local_file)):
-                # Instantiate a LoadImage node and use its logic to load the file
-                loader = LoadImage()
-                # The load_image method returns a tuple, so we need to get the first element
-                loaded_image_tuple = loader.load_image(local_file)
-                image = loaded_image_tuple[0]
-                mask = loaded_image_tuple[1]
-                # comfyui has a bug where masks are inverted, so we need to invert it back
-                if mask is not None:
-                    mask = 1.0 - mask
+                # decoded with the logic of the LoadImage node, or taken from the decode cache
+                image, mask = load_image_file(local_file)
             elif not optional:
                 filenameOnly = os.path.basename(local_file)
                 raise ValueError(f"Error: Image file not found: {filenameOnly}")
@@ -635,6 +635,11 @@ class AIHubExposeFrame:
     RETURN_TYPES = ("IMAGE", "INT", "INT", "INT", "INT",)
     RETURN_NAMES = ("IMAGE", "WIDTH", "HEIGHT", "FRAME_INDEX", "TOTAL_FRAMES",)
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -661,11 +666,8 @@ class AIHubExposeFrame:
         image = None
         if local_file is not None:
             if (os.path.exists(local_file) and local_file):
-                # Instantiate a LoadImage node and use its logic to load the file
-                loader = LoadImage()
-                # The load_image method returns a tuple, so we need to get the first element
-                loaded_image_tuple = loader.load_image(local_file)
-                image = loaded_image_tuple[0]
+                # decoded with the logic of the LoadImage node, or taken from the decode cache
+                image, _ = load_image_file(local_file)
             elif not optional:
                 filenameOnly = os.path.basename(local_file)
                 raise ValueError(f"Error: Image file not found: {filenameOnly}")
@@ -691,6 +693,11 @@ class AIHubExposeProjectImage:
     RETURN_TYPES = ("IMAGE", "MASK", "INT", "INT",)
     RETURN_NAMES = ("IMAGE", "MASK", "WIDTH", "HEIGHT",)
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -709,15 +716,8 @@ class AIHubExposeProjectImage:
         mask = None
         if local_file is not None:
             if (os.path.exists(local_file) and local_file):
-                # Instantiate a LoadImage node and use its logic to load the file
-                loader = LoadImage()
-                # The load_image method returns a tuple, so we need to get the first element
-                loaded_image_tuple = loader.load_image(local_file)
-                image = loaded_image_tuple[0]
-                mask = loaded_image_tuple[1]
-                # comfyui has a bug where masks are inverted, so we need to invert it back
-                if mask is not None:
-                    mask = 1.0 - mask
+                # decoded with the logic of the LoadImage node, or taken from the decode cache
+                image, mask = load_image_file(local_file)
             elif not optional:
                 filenameOnly = os.path.basename(local_file)
                 raise ValueError(f"Error: Image file not found: {filenameOnly}")
@@ -773,6 +773,30 @@ class AIHubExposeImageInfoOnly:
     def get_exposed_image_info_only(self, id, label, tooltip, type, index, optional, pos_x=0, pos_y=0, layer_id="", value_width=1024, value_height=1024):
         return (pos_x, pos_y, layer_id, value_width, value_height,)
     
+def load_image_batch(filenames, normalizer=None, skip_missing=False):
+    """
+    Decodes the files of an image batch in parallel and provides the images and the masks in
+    the order of the files; when the normalizer has a fixed size each image is resized as soon
+    as it is decoded, while the rest are still being decoded
+    """
+    if skip_missing:
+        filenames = [filename for filename in filenames if os.path.exists(filename)]
+    else:
+        for filename in filenames:
+            if not os.path.exists(filename):
+                filenameOnly = os.path.basename(filename)
+                raise ValueError(f"Error: Image file not found: {filenameOnly}")
+
+    loaded_images = [None] * len(filenames)
+    loaded_masks = [None] * len(filenames)
+    fixed_size = normalizer.get_fixed_size() if normalizer is not None else None
+    for i, (image, mask) in load_images_as_completed(filenames):
+        if fixed_size is not None:
+            image, mask = normalizer.resize(image, mask, *fixed_size)
+        loaded_images[i] = image
+        loaded_masks[i] = mask
+    return loaded_images, loaded_masks
+
 class AIHubExposeImageBatch:
     """
     An utility to expose an image batch to be used in the workflow
@@ -783,6 +807,11 @@ class AIHubExposeImageBatch:
     RETURN_TYPES = ("IMAGE", "MASK", "AIHUB_METADATA", "INT", "INT",)
     RETURN_NAMES = ("IMAGE", "MASKS", "METADATA", "WIDTH", "HEIGHT",)
 
+    @classmethod
+    def IS_CHANGED(cls, local_files=None, **kwargs):
+        # the outputs are reused while the files have the same content
+        return local_files_fingerprint(local_files)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -938,30 +967,9 @@ class AIHubExposeImageBatch:
                                     raise ValueError(f"Error: metadata field '{field_name}' is marked as SORTED but the items are not in sorted order")
                             previous_value_of_sorted_field[field_name] = item[field_name]
 
-                loaded_images = []
-                loaded_masks = []
-                loader = LoadImage()
-                
-                for filename in filenames:
-                    # Check if the file exists before trying to load it.
-                    if os.path.exists(filename):
-                        # Load each image and append it to the list.
-                        loaded_img_tuple = loader.load_image(filename)
-                        loaded_images.append(loaded_img_tuple[0])
-                        mask = loaded_img_tuple[1]
-                        # comfyui has a bug where masks are inverted, so we need to invert it back
-                        if mask is not None:
-                            mask = 1.0 - mask
-                        loaded_masks.append(mask)
-                    else:
-                        filenameOnly = os.path.basename(filename)
-                        raise ValueError(f"Error: Image file not found: {filenameOnly}")
-                    
-                image_batch, masks, width, height = normalizer.normalize(loaded_images, loaded_masks)
+                loaded_images, loaded_masks = load_image_batch(filenames, normalizer)
 
-                # Concatenate all the images into a single batch tensor.
-                image_batch = torch.cat(loaded_images, dim=0)
-                masks = torch.cat(loaded_masks, dim=0)
+                image_batch, masks, width, height = normalizer.normalize(loaded_images, loaded_masks)
             except json.JSONDecodeError:
                 # Handle invalid JSON input gracefully.
                 raise ValueError("Error: local_files is not a valid JSON string encoding an array")
@@ -982,6 +990,11 @@ class AIHubExposeProjectImageBatch:
     RETURN_TYPES = ("IMAGE", "MASK", "INT", "INT",)
     RETURN_NAMES = ("IMAGE", "MASK", "WIDTH", "HEIGHT")
 
+    @classmethod
+    def IS_CHANGED(cls, local_files=None, **kwargs):
+        # the outputs are reused while the files have the same content
+        return local_files_fingerprint(local_files)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -1013,21 +1026,9 @@ class AIHubExposeProjectImageBatch:
                 if len(filenames) == 0:
                     return (None, None, 0, 0,)
                 
-                loaded_images = []
-                loaded_masks = []
-                loader = LoadImage()
-                
-                for filename in filenames:
-                    # Check if the file exists before trying to load it.
-                    if os.path.exists(filename):
-                        # Load each image and append it to the list.
-                        loaded_img_tuple = loader.load_image(filename)
-                        loaded_images.append(loaded_img_tuple[0])
-                        mask = loaded_img_tuple[1]
-                        # comfyui has a bug where masks are inverted, so we need to invert it back
-                        if mask is not None:
-                            mask = 1.0 - mask
-                        loaded_masks.append(mask)
+                normalizer = normalizer if normalizer is not None else Normalizer(0, 0, "nearest-exact")
+                # the files that are not there are skipped
+                loaded_images, loaded_masks = load_image_batch(filenames, normalizer, skip_missing=True)
 
             except json.JSONDecodeError:
                 # Handle invalid JSON input gracefully.
@@ -1036,7 +1037,6 @@ class AIHubExposeProjectImageBatch:
         if not loaded_images:
             raise ValueError(f"Error: {id} no valid images found")
 
-        normalizer = normalizer if normalizer is not None else Normalizer(0, 0, "nearest-exact")
         return normalizer.normalize(loaded_images, loaded_masks)
 
 class AIHubExposeModel:
@@ -1203,6 +1203,11 @@ class AIHubExposeProjectText:
 
     RETURN_TYPES = ("STRING",)
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -1246,6 +1251,11 @@ class AIHubExposeProjectVideo:
     RETURN_TYPES = ("VIDEO", "STRING")
     RETURN_NAMES = ("VIDEO", "LOCAL_FILE")
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -1292,6 +1302,11 @@ class AIHubExposeVideo:
     RETURN_TYPES = ("VIDEO", "STRING", "STRING")
     RETURN_NAMES = ("VIDEO", "LOCAL_FILE", "SEGMENT_ID")
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -1338,6 +1353,11 @@ class AIHubExposeProjectAudio:
     RETURN_TYPES = ("AUDIO", "STRING")
     RETURN_NAMES = ("AUDIO", "LOCAL_FILE")
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -1382,6 +1402,11 @@ class AIHubExposeAudio:
     RETURN_TYPES = ("AUDIO", "STRING", "STRING")
     RETURN_NAMES = ("AUDIO", "LOCAL_FILE", "SEGMENT_ID")
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -1427,6 +1452,11 @@ class AIHubExposeProjectLatent:
     FUNCTION = "get_exposed_latent"
     RETURN_TYPES = ("LATENT",)
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -1445,11 +1475,7 @@ class AIHubExposeProjectLatent:
         samples = None
         if local_file is not None and local_file.strip() != "":
             if (os.path.exists(local_file)):
-                latent = safetensors.torch.load_file(local_file, device="cpu")
-                multiplier = 1.0
-                if "latent_format_version_0" not in latent:
-                    multiplier = 1.0 / 0.18215
-                samples = {"samples": latent["latent_tensor"].float() * multiplier}
+                samples = load_latent(local_file)
             else:
                 filenameOnly = os.path.basename(local_file)
                 raise ValueError(f"Error: Latent file not found: {filenameOnly}")
@@ -1468,6 +1494,11 @@ class AIHubExposeLatent:
     RETURN_TYPES = ("LATENT",)
     RETURN_NAMES = ("LATENT",)
 
+    @classmethod
+    def IS_CHANGED(cls, local_file=None, **kwargs):
+        # the outputs are reused while the file has the same content
+        return local_file_fingerprint(local_file)
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -1487,11 +1518,7 @@ class AIHubExposeLatent:
         samples = None
         if local_file is not None and local_file.strip() != "":
             if (os.path.exists(local_file)):
-                latent = safetensors.torch.load_file(local_file, device="cpu")
-                multiplier = 1.0
-                if "latent_format_version_0" not in latent:
-                    multiplier = 1.0 / 0.18215
-                samples = {"samples": latent["latent_tensor"].float() * multiplier}
+                samples = load_latent(local_file)
             else:
                 filenameOnly = os.path.basename(local_file)
                 raise ValueError(f"Error: Latent file not found: {filenameOnly}")
@@ -1519,8 +1546,9 @@ class AIHubActionNewImage:
             },
             "optional": {
                 "mask": ("MASK",),
-                "file_name": ("STRING", {"default": "", "tooltip": "The filename to use, if not given the name value will be used with a .png extension"}),
+                "file_name": ("STRING", {"default": "", "tooltip": "The filename to use, if not given the name value will be used with the extension of the encoding"}),
                 "autoopen": ("BOOLEAN", {"default": False, "tooltip": "If set to true, the image will be automatically opened in a new tab when added"}),
+                **get_image_encoding_inputs(),
             }
         }
     
@@ -1528,44 +1556,26 @@ class AIHubActionNewImage:
     def IS_CHANGED(cls, **kwargs):
         return float("NaN")
     
-    def run_action(self, image, action, name, mask=None, file_name="", autoopen=False):
+    def run_action(self, image, action, name, mask=None, file_name="", autoopen=False, encoding="png", quality=95, compress_level=6):
         print("RUNNING ACTION")
 
         if image is None:
             return (None, None)
 
         if not file_name:
-            file_name = name
-            if not file_name.lower().endswith(".png"):
-                file_name += ".png"
-            # replace spaces with underscores
-            file_name = file_name.replace(" ", "_")
+            file_name = get_image_file_name(name, encoding)
 
         c_image = image[0]
         # we have to convert this image to bytes and apply the mask if the mask is given
-        if mask is not None:
-            c_mask = mask[0]
-            # convert mask to binary
-            mask_np = c_mask.cpu().numpy()
-            alpha_channel = Image.fromarray((mask_np * 255).clip(0, 255).astype(np.uint8), mode='L')
-            i = 255. * c_image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            try:
-                img.putalpha(alpha_channel)
-            except Exception as e:
-                print(f"Error adding alpha channel: {e}")
-        else:
-            i = 255. * c_image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format='PNG')
+        pixels = images_to_uint8(image[:1], mask)[0]
+        img_bytes = encode_image(pixels, encoding, quality, compress_level)
 
         SERVER.send_binary_data_to_current_client_sync(
-            img_bytes.getvalue(), "image/png", {
+            img_bytes, IMAGE_ENCODING_TYPES[encoding], {
                 "action": "NEW_IMAGE",
                 "width": c_image.shape[1],
                 "height": c_image.shape[0],
-                "type": "image/png",
+                "type": IMAGE_ENCODING_TYPES[encoding],
                 "file_action": action,
                 "file_name": file_name,
                 "name": name,
@@ -1596,20 +1606,17 @@ class AIHubActionNewImageBatch:
             },
             "optional": {
                 "masks": ("MASK",),
-                "file_name": ("STRING", {"default": "", "tooltip": "The filename to use as base extension included, if not given the name value will be used with a .png extension"}),
+                "file_name": ("STRING", {"default": "", "tooltip": "The filename to use as base extension included, if not given the name value will be used with the extension of the encoding"}),
+                **get_image_encoding_inputs(),
             }
         }
 
-    def run_action(self, images, action, name, masks=None, file_name=""):
+    def run_action(self, images, action, name, masks=None, file_name="", encoding="png", quality=95, compress_level=6):
         if images is None or images.shape[0] == 0:
             return (images,)
 
         if not file_name:
-            file_name = name
-            if not file_name.lower().endswith(".png"):
-                file_name += ".png"
-            # replace spaces with underscores
-            file_name = file_name.replace(" ", "_")
+            file_name = get_image_file_name(name, encoding)
 
         SERVER.send_json_to_current_client_sync(
             {
@@ -1621,33 +1628,22 @@ class AIHubActionNewImageBatch:
         )
 
         c_images = images
+
         # we have to convert this image to bytes and apply the mask if the mask is given
-        for j in range(c_images.shape[0]):
-            c_image = c_images[j]
-            c_mask = masks[j] if masks is not None else None
-
-            if c_mask is not None:
-                # convert mask to binary
-                mask_np = c_mask.cpu().numpy()
-                alpha_channel = Image.fromarray((mask_np * 255).clip(0, 255).astype(np.uint8), mode='L')
-                i = 255. * c_image.cpu().numpy()
-                img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-                try:
-                    img.putalpha(alpha_channel)
-                except Exception as e:
-                    print(f"Error adding alpha channel: {e}")
-            else:
-                i = 255. * c_image.cpu().numpy()
-                img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            img_bytes = io.BytesIO()
-            img.save(img_bytes, format='PNG')
+        # the whole batch is converted at once and then the frames are encoded in parallel,
+        # they are sent in order because the clients append them as they arrive
+        pixels = images_to_uint8(c_images, masks)
+
+        def encode(j):
+            return encode_image(pixels[j], encoding, quality, compress_level)
 
+        for j, img_bytes in encode_in_order(c_images.shape[0], encode):
             SERVER.send_binary_data_to_current_client_sync(
-                img_bytes.getvalue(), "image/png", {
+                img_bytes, IMAGE_ENCODING_TYPES[encoding], {
                     "action": "NEW_IMAGE",
                     "width": c_images.shape[2],
                     "height": c_images.shape[1],
-                    "type": "image/png",
+                    "type": IMAGE_ENCODING_TYPES[encoding],
                     "file_action": "APPEND",
                     "file_name": file_name,
                     "name": name,
@@ -1655,7 +1651,7 @@ class AIHubActionNewImageBatch:
                     "batch_index": j,
                     "batch_size": c_images.shape[0],
                 },
-        )
+            )
 
         return (images,)
     
@@ -1687,22 +1683,19 @@ class AIHubActionNewFrames:
                 "insert_action": (["REPLACE", "APPEND"], {"default": "REPLACE", "tooltip": "The action to execute on the video frames themselves that are being worked on"})
             },
             "optional": {
-                "file_name": ("STRING", {"default": "", "tooltip": "The filename to use as base extension included, if not given the name value will be used with a .png extension"}),
+                "file_name": ("STRING", {"default": "", "tooltip": "The filename to use as base extension included, if not given the name value will be used with the extension of the encoding"}),
+                **get_image_encoding_inputs(),
             }
         }
 
-    def run_action(self, images, action, name, insert_index, insert_action, file_name=""):
-        AIHubActionNewImageBatch().run_action(images, action, name, None, file_name)
+    def run_action(self, images, action, name, insert_index, insert_action, file_name="", encoding="png", quality=95, compress_level=6):
+        AIHubActionNewImageBatch().run_action(images, action, name, None, file_name, encoding, quality, compress_level)
 
         if images is None or images.shape[0] == 0:
             return (images,)
 
         if not file_name:
-            file_name = name
-            if not file_name.lower().endswith(".png"):
-                file_name += ".png"
-            # replace spaces with underscores
-            file_name = file_name.replace(" ", "_")
+            file_name = get_image_file_name(name, encoding)
 
         SERVER.send_json_to_current_client_sync(
             {
@@ -1744,46 +1737,29 @@ class AIHubActionNewLayer:
             },
             "optional": {
                 "mask": ("MASK",),
-                "file_name": ("STRING", {"default": "", "tooltip": "The filename to use, if not given the name value will be used with a .png extension"}),
+                "file_name": ("STRING", {"default": "", "tooltip": "The filename to use, if not given the name value will be used with the extension of the encoding"}),
+                **get_image_encoding_inputs(),
             }
         }
 
-    def run_action(self, image, pos_x, pos_y, reference_layer_id, reference_layer_action, name, action="REPLACE", mask=None, file_name=""):
+    def run_action(self, image, pos_x, pos_y, reference_layer_id, reference_layer_action, name, action="REPLACE", mask=None, file_name="", encoding="png", quality=95, compress_level=6):
         if image is None:
             return (None, None)
 
         if not file_name:
-            file_name = name
-            if not file_name.lower().endswith(".png"):
-                file_name += ".png"
-            # replace spaces with underscores
-            file_name = file_name.replace(" ", "_")
+            file_name = get_image_file_name(name, encoding)
 
         c_image = image[0]
         # we have to convert this image to bytes and apply the mask if the mask is given
-        if mask is not None:
-            c_mask = mask[0]
-            # convert mask to binary
-            mask_np = c_mask.cpu().numpy()
-            alpha_channel = Image.fromarray((mask_np * 255).clip(0, 255).astype(np.uint8), mode='L')
-            i = 255. * c_image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            try:
-                img.putalpha(alpha_channel)
-            except Exception as e:
-                print(f"Error adding alpha channel: {e}")
-        else:
-            i = 255. * c_image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format='PNG')
+        pixels = images_to_uint8(image[:1], mask)[0]
+        img_bytes = encode_image(pixels, encoding, quality, compress_level)
 
         SERVER.send_binary_data_to_current_client_sync(
-            img_bytes.getvalue(), "image/png", {
+            img_bytes, IMAGE_ENCODING_TYPES[encoding], {
                 "action": "NEW_LAYER",
                 "width": c_image.shape[1],
                 "height": c_image.shape[0],
-                "type": "image/png",
+                "type": IMAGE_ENCODING_TYPES[encoding],
                 "pos_x": pos_x,
                 "pos_y": pos_y,
                 "reference_layer_id": reference_layer_id,
@@ -1962,6 +1938,10 @@ class AIHubActionNewLatent:
                 "action": (["REPLACE", "APPEND"], {"default": "APPEND", "tooltip": "If append is selected, the latents will be added a number to the name to make it unique, if replace is selected, the latents will be replaced with the new one"}),
                 "file_name": ("STRING", {"default": "new_latent.safetensors", "tooltip": "The name of the latents this is used for the filename value directly"}),
             },
+            "optional": {
+                "dtype": (list(LATENT_DTYPES.keys()), {"default": "float32", "tooltip": "The precision the latent is stored with, float16 and bfloat16 are half the size, bfloat16 keeps the range of float32"}),
+                "metadata": (LATENT_METADATA_MODES, {"default": "full", "tooltip": "full stores the workflow with the latent as comfyui does, compressed compresses the large values and none leaves it out"}),
+            },
             "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
         }
     
@@ -1970,32 +1950,25 @@ class AIHubActionNewLatent:
     RETURN_TYPES = ()
     FUNCTION = "run_action"
 
-    def run_action(self, samples, action, file_name, prompt=None, extra_pnginfo=None):
+    def run_action(self, samples, action, file_name, dtype="float32", metadata="full", prompt=None, extra_pnginfo=None):
         if not samples:
             return ()
-        
-        # support save metadata for latent sharing
-        prompt_info = ""
-        if prompt is not None:
-            prompt_info = json.dumps(prompt)
 
+        metadata_mode = metadata
         metadata = None
-        if not args.disable_metadata:
+        if not args.disable_metadata and metadata_mode != "none":
+            # support save metadata for latent sharing
+            prompt_info = ""
+            if prompt is not None:
+                prompt_info = json.dumps(prompt)
+
             metadata = {"prompt": prompt_info}
             if extra_pnginfo is not None:
                 for x in extra_pnginfo:
                     metadata[x] = json.dumps(extra_pnginfo[x])
 
-        output = {}
-        output["latent_tensor"] = samples["samples"].contiguous()
-        output["latent_format_version_0"] = torch.tensor([])
+        bytes = latent_to_safetensors(samples["samples"], dtype, encode_latent_metadata(metadata, metadata_mode))
 
-        bytes = None
-        if metadata is not None:
-            bytes = safetensors.torch.save(output, metadata=metadata)
-        else:
-            bytes = safetensors.torch.save(output)
-        
         SERVER.send_binary_data_to_current_client_sync(
             bytes, "application/octet-stream", {
                 "action": "NEW_LATENT",
@@ -2020,9 +1993,10 @@ class AIHubActionNewAudio:
                 "name": ("STRING", {"default": "new audio", "tooltip": "The name of the audio to be used"}),
             },
             "optional": {
-                "format": (["wav", "ogg", "flac"], {"default": "wav", "tooltip": "The format to save the audio in"}),
+                "format": (AUDIO_FORMATS, {"default": "wav", "tooltip": "The format to save the audio in, wav and flac are lossless, ogg, opus and mp3 are compressed and much smaller"}),
                 "file_name": ("STRING", {"default": "", "tooltip": "The filename to use, with the extension, if not given the name value will be used with the given format extension"}),
                 "autoplay": ("BOOLEAN", {"default": False, "tooltip": "If true, the audio will autoplay when added"}),
+                **get_audio_encoding_inputs(),
             }
         }
     
@@ -2031,32 +2005,27 @@ class AIHubActionNewAudio:
     RETURN_TYPES = ()
     FUNCTION = "run_action"
 
-    def run_action(self, audio, action, name, format="wav", file_name="", autoplay=False):
+    def run_action(self, audio, action, name, format="wav", file_name="", autoplay=False, bitrate=128, compression_level=5, streaming=False):
         if not audio:
             return ()
         
         if not file_name:
-            file_name = name
-            if not file_name.lower().endswith(f".{format}"):
-                file_name += f".{format}"
-            # replace spaces with underscores
-            file_name = file_name.replace(" ", "_")
+            file_name = get_audio_file_name(name, format)
 
-        waveform = audio["waveform"][0]
+        # the audio is copied here since the execution goes on while it is encoded
+        waveform = audio["waveform"][0].detach().cpu().clone()
         sample_rate = audio["sample_rate"]
-        buffer = io.BytesIO()
-        torchaudio.save(buffer, waveform, sample_rate, format=format.upper())
-        audio_bytes = buffer.getvalue()
+        mime_type = AUDIO_FORMAT_TYPES[format]
 
-        SERVER.send_binary_data_to_current_client_sync(
-            audio_bytes, f"audio/{format}", {
+        SERVER.submit_for_current_client(
+            AUDIO_POOL, send_audio, waveform, sample_rate, {
                 "action": "NEW_AUDIO",
                 "file_name": file_name,
                 "file_action": action,
                 "name": name,
-                "type": f"audio/{format}",
+                "type": mime_type,
                 "autoplay": autoplay,
-            }
+            }, format, bitrate, compression_level, streaming,
         )
         return ()
     
@@ -2076,9 +2045,10 @@ class AIHubActionNewAudioSegment:
                 "reference_segment_action": (["REPLACE", "NEW_BEFORE", "NEW_AFTER", "MERGE"], {"default": "NEW_AFTER", "tooltip": "Specify the action to execute at the given segment id"}),
             },
             "optional": {
-                "format": (["wav", "ogg", "flac"], {"default": "wav", "tooltip": "The format to save the audio in"}),
+                "format": (AUDIO_FORMATS, {"default": "wav", "tooltip": "The format to save the audio in, wav and flac are lossless, ogg, opus and mp3 are compressed and much smaller"}),
                 "file_name": ("STRING", {"default": "", "tooltip": "The filename to use, with the extension, if not given the name value will be used with the given format extension"}),
                 "autoplay": ("BOOLEAN", {"default": False, "tooltip": "If true, the audio segment will autoplay when added"}),
+                **get_audio_encoding_inputs(),
             }
         }
     
@@ -2087,37 +2057,55 @@ class AIHubActionNewAudioSegment:
     RETURN_TYPES = ()
     FUNCTION = "run_action"
 
-    def run_action(self, audio, action, name, reference_segment_id, reference_segment_action, format="wav", file_name="", autoplay=False):
+    def run_action(self, audio, action, name, reference_segment_id, reference_segment_action, format="wav", file_name="", autoplay=False, bitrate=128, compression_level=5, streaming=False):
         if not audio:
             return ()
         
         if not file_name:
-            file_name = name
-            if not file_name.lower().endswith(f".{format}"):
-                file_name += f".{format}"
-            # replace spaces with underscores
-            file_name = file_name.replace(" ", "_")
+            file_name = get_audio_file_name(name, format)
 
-        waveform = audio["waveform"][0]
+        # the audio is copied here since the execution goes on while it is encoded
+        waveform = audio["waveform"][0].detach().cpu().clone()
         sample_rate = audio["sample_rate"]
-        buffer = io.BytesIO()
-        torchaudio.save(buffer, waveform, sample_rate, format=format.upper())
-        audio_bytes = buffer.getvalue()
+        mime_type = AUDIO_FORMAT_TYPES[format]
 
-        SERVER.send_binary_data_to_current_client_sync(
-            audio_bytes, f"audio/{format}", {
+        SERVER.submit_for_current_client(
+            AUDIO_POOL, send_audio, waveform, sample_rate, {
                 "action": "NEW_AUDIO_SEGMENT",
                 "file_name": file_name,
                 "file_action": action,
                 "name": name,
-                "type": f"audio/{format}",
+                "type": mime_type,
                 "reference_segment_id": reference_segment_id,
                 "reference_segment_action": reference_segment_action,
                 "autoplay": autoplay,
-            }
+            }, format, bitrate, compression_level, streaming,
         )
         return ()
 
+def send_video(video, mime_type, action_data, format, codec, crf, streaming):
+    """
+    Encodes a video and sends it to the current client, when streaming the video is sent
+    in chunks as it is encoded instead of all at once at the end
+    """
+    if not streaming:
+        video_io_buffer = io.BytesIO()
+        video_save_to(video, video_io_buffer, format=format, codec=codec, crf=crf)
+        SERVER.send_binary_data_to_current_client_sync(video_io_buffer.getbuffer(), mime_type, action_data)
+        return
+
+    def on_chunk(chunk, chunk_index, final):
+        SERVER.send_binary_data_to_current_client_sync(chunk, mime_type, {
+            **action_data,
+            "streaming": True,
+            "chunk_index": chunk_index,
+            "chunk_final": final,
+        })
+
+    writer = ChunkWriter(on_chunk)
+    video_save_to(video, writer, format=format, codec=codec, crf=crf, fragmented=True)
+    writer.close()
+
 class AIHubActionNewVideo:
     @classmethod
     def IS_CHANGED(cls, **kwargs):
@@ -2137,6 +2125,7 @@ class AIHubActionNewVideo:
             "optional": {
                 "file_name": ("STRING", {"default": "", "tooltip": "The filename to use, with the extension"}),
                 "autoplay": ("BOOLEAN", {"default": False, "tooltip": "If true, the video will autoplay when added"}),
+                "streaming": ("BOOLEAN", {"default": False, "tooltip": "If true, the video is sent as a fragmented mp4 in chunks while it is being encoded, the client receives many files with a chunk_index and the last one has chunk_final set"}),
             }
         }
     
@@ -2145,7 +2134,7 @@ class AIHubActionNewVideo:
     RETURN_TYPES = ()
     FUNCTION = "run_action"
 
-    def run_action(self, video, action, name, format, codec, crf, file_name="", autoplay=False):
+    def run_action(self, video, action, name, format, codec, crf, file_name="", autoplay=False, streaming=False):
         if not video:
             return ()
         
@@ -2158,19 +2147,15 @@ class AIHubActionNewVideo:
             file_name = file_name.replace(" ", "_")
 
         mime_type = ("video/" + format) if format and format != "auto" else "video/mp4"
-        video_io_buffer = io.BytesIO()
-        video_save_to(video, video_io_buffer, format=format, codec=codec, crf=crf)
-
-        SERVER.send_binary_data_to_current_client_sync(
-            video_io_buffer.getvalue(), mime_type, {
-                "action": "NEW_VIDEO",
-                "file_name": file_name,
-                "file_action": action,
-                "name": name,
-                "type": mime_type,
-                "autoplay": autoplay,
-            }
-        )
+        action_data = {
+            "action": "NEW_VIDEO",
+            "file_name": file_name,
+            "file_action": action,
+            "name": name,
+            "type": mime_type,
+            "autoplay": autoplay,
+        }
+        send_video(video, mime_type, action_data, format, codec, crf, streaming)
         return ()
     
 class AIHubActionNewVideoSegment:
@@ -2194,6 +2179,7 @@ class AIHubActionNewVideoSegment:
             "optional": {
                 "file_name": ("STRING", {"default": "", "tooltip": "The filename to use, with the extension, if not given the name value will be used with the given format extension based on the mime type"}),
                 "autoplay": ("BOOLEAN", {"default": False, "tooltip": "If true, the video segment will autoplay when added"}),
+                "streaming": ("BOOLEAN", {"default": False, "tooltip": "If true, the video is sent as a fragmented mp4 in chunks while it is being encoded, the client receives many files with a chunk_index and the last one has chunk_final set"}),
             }
         }
     
@@ -2202,7 +2188,7 @@ class AIHubActionNewVideoSegment:
     RETURN_TYPES = ()
     FUNCTION = "run_action"
 
-    def run_action(self, video, action, name, format, codec, crf, reference_segment_id, reference_segment_action, file_name="", autoplay=False):
+    def run_action(self, video, action, name, format, codec, crf, reference_segment_id, reference_segment_action, file_name="", autoplay=False, streaming=False):
         if not video:
             return ()
         
@@ -2215,21 +2201,17 @@ class AIHubActionNewVideoSegment:
             file_name = file_name.replace(" ", "_")
 
         mime_type = ("video/" + format) if format and format != "auto" else "video/mp4"
-        video_io_buffer = io.BytesIO()
-        video_save_to(video, video_io_buffer, format=format, codec=codec, crf=crf)
-
-        SERVER.send_binary_data_to_current_client_sync(
-            video_io_buffer.getvalue(), mime_type, {
-                "action": "NEW_VIDEO_SEGMENT",
-                "file_name": file_name,
-                "file_action": action,
-                "name": name,
-                "type": mime_type,
-                "reference_segment_id": reference_segment_id,
-                "reference_segment_action": reference_segment_action,
-                "autoplay": autoplay,
-            }
-        )
+        action_data = {
+            "action": "NEW_VIDEO_SEGMENT",
+            "file_name": file_name,
+            "file_action": action,
+            "name": name,
+            "type": mime_type,
+            "reference_segment_id": reference_segment_id,
+            "reference_segment_action": reference_segment_action,
+            "autoplay": autoplay,
+        }
+        send_video(video, mime_type, action_data, format, codec, crf, streaming)
 
 class AIHubActionNewText:
     @classmethod
@@ -2791,69 +2773,171 @@ class AIHubUtilsMetadataMap:
         result = separator.join(values)
         return (result,)
 
+# how the size all the images of a batch are resized to is chosen
+NORMALIZER_STRATEGIES = ["auto", "largest", "smallest", "first", "fixed", "fit_megapixels"]
+
 class Normalizer:
-    def __init__(self, normalize_at_width=0, normalize_at_height=0, normalize_upscale_method="nearest-exact"):
+    """
+    Resizes the images of a batch to the same size, the size is chosen by the strategy
+
+     - largest: the size of the image with the most megapixels
+     - smallest: the size of the image with the least megapixels
+     - first: the size of the first image
+     - fixed: normalize_at_width x normalize_at_height
+     - fit_megapixels: the size of the largest image scaled down to fit within the megapixels
+     - auto: fixed if a width and height are given, otherwise largest
+    """
+    def __init__(self, normalize_at_width=0, normalize_at_height=0, normalize_upscale_method="nearest-exact", strategy="auto", megapixels=1.0):
         self.normalize_at_width = normalize_at_width
         self.normalize_at_height = normalize_at_height
         self.normalize_upscale_method = normalize_upscale_method
+        if strategy == "auto":
+            strategy = "fixed" if normalize_at_width > 0 and normalize_at_height > 0 else "largest"
+        if strategy not in NORMALIZER_STRATEGIES:
+            raise ValueError(f"Error: Unknown normalization strategy {strategy}")
+        if strategy == "fixed" and (normalize_at_width <= 0 or normalize_at_height <= 0):
+            raise ValueError("Error: The fixed normalization strategy requires normalize_at_width and normalize_at_height to be greater than 0")
+        self.strategy = strategy
+        self.megapixels = megapixels
+
+    def get_fixed_size(self):
+        """
+        Provides the (width, height) all the images are resized to if it does not depend
+        on the images, otherwise None
+        """
+        if self.strategy == "fixed":
+            return (self.normalize_at_width, self.normalize_at_height)
+        return None
+
+    def get_target_size(self, shapes):
+        """
+        Provides the (width, height) to resize to for the given (height, width) of the images
+        """
+        fixed_size = self.get_fixed_size()
+        if fixed_size is not None:
+            return fixed_size
+        if len(shapes) == 0:
+            raise ValueError("Error: There are no images to normalize")
+        if self.strategy == "first":
+            h, w = shapes[0]
+        elif self.strategy == "smallest":
+            h, w = min(shapes, key=lambda shape: shape[0] * shape[1])
+        else:
+            h, w = max(shapes, key=lambda shape: shape[0] * shape[1])
+
+        if self.strategy == "fit_megapixels":
+            budget = self.megapixels * 1_000_000
+            if w * h > budget:
+                # keep the aspect ratio, in multiples of 8 as the models expect
+                scale = (budget / (w * h)) ** 0.5
+                w = max(8, int(w * scale) // 8 * 8)
+                h = max(8, int(h * scale) // 8 * 8)
+        return (w, h)
+
+    def resize(self, img, mask, normalize_width, normalize_height):
+        """
+        Resizes a single image (N, H, W, C) and its mask (N, H, W) if they are not at the given size
+        """
+        masks = None if mask is None else [mask]
+        image_batch, masks_batch = self.resize_batch([img], masks, normalize_width, normalize_height)
+        return image_batch, masks_batch
 
     def normalize(self, images, masks, is_tensor=False):
-        normalize_width = self.normalize_at_width
-        normalize_height = self.normalize_at_height
-        normalize_megapixels = (normalize_width * normalize_height) / 1_000_000
-
         if is_tensor:
-            # Convert images and masks to list of tensors
-            images = [img.unsqueeze(0) for img in images]
+            # the whole batch is a single group of the same size
+            images = [images]
             if masks is not None:
-                masks = [mask.unsqueeze(0) for mask in masks]
+                masks = [masks]
 
-            if normalize_width == 0 or normalize_height == 0:
+            if self.strategy != "fixed":
                 raise ValueError("Error: When using tensor images, both normalize_at_width and normalize_at_height must be greater than 0")
-        elif normalize_width == 0 and normalize_height == 0:
-            for i in range(len(images)):
-                img = images[i]
-                _, h, w, _ = img.shape
-                image_megapixels = (w * h) / 1_000_000
-                if image_megapixels > normalize_megapixels:
-                    normalize_width = w
-                    normalize_height = h
-                    break
-
-        if len(masks) == 0:
+
+        if masks is None or len(masks) == 0:
             masks = None
         elif len(masks) != len(images):
             raise ValueError("Error: The number of masks must match the number of images")
 
-        width = normalize_width
-        height = normalize_height
+        width, height = self.get_target_size([(img.shape[1], img.shape[2]) for img in images])
+        image_batch, masks_batch = self.resize_batch(images, masks, width, height)
+        return (image_batch, masks_batch, width, height)
+
+    def can_fuse(self, img, mask):
+        # lanczos goes through PIL, which would treat the mask as the alpha of the image
+        return (
+            mask is not None
+            and self.normalize_upscale_method != "lanczos"
+            and mask.shape[0] == img.shape[0]
+            and mask.shape[1:3] == img.shape[1:3]
+            and mask.dtype == img.dtype
+            and mask.device == img.device
+        )
 
-        for i in range(len(images)):
-            img = images[i]
+    def resize_batch(self, images, masks, width, height):
+        """
+        Resizes a list of images (N, H, W, C) and their masks (N, H, W) into a single batch that is
+        allocated once, the ones that have the same size are resized together in a single call, and
+        a mask of the same size as its image is resized along with it as one more channel
+        """
+        total = sum(img.shape[0] for img in images)
+        channels = images[0].shape[-1]
+        image_batch = torch.empty((total, height, width, channels), dtype=images[0].dtype, device=images[0].device)
+        masks_batch = None
+        if masks is not None:
+            masks_batch = torch.empty((total, height, width), dtype=masks[0].dtype, device=masks[0].device)
+
+        # (kind, source height, source width) -> [(tensor, mask, offset in the output)]
+        groups = {}
+        offset = 0
+        for i, img in enumerate(images):
             mask = None if masks is None else masks[i]
-            _, h, w, _ = img.shape
-
-            if w != normalize_width or h != normalize_height:
-                samples = img.movedim(-1, 1)  # NHWC -> NCHW
-                samples = common_upscale(
-                    samples, normalize_width, normalize_height, self.normalize_upscale_method, crop="center"
-                )
-                images[i] = samples.movedim(1, -1)  # NCHW -> NHWC
-            if mask is not None:
-                c_mask = masks[i]
-                # check if the mask has the correct size
-                if c_mask.shape[1] != normalize_width or c_mask.shape[2] != normalize_height:
-                    samples_masks = c_mask.unsqueeze(1)  # NCHW -> NHW
-                    samples_masks = common_upscale(
-                        samples_masks, normalize_width, normalize_height, self.normalize_upscale_method, crop="center"
-                    )
-                    masks[i] = samples_masks.squeeze(1)  # NHW -> NCHW
-
-        # Concatenate all the images into a single batch tensor.
-        image_batch = torch.cat(images, dim=0)
-        masks_batch = None if masks is None else torch.cat(masks, dim=0)
+            if mask is not None and mask.dim() == 2:
+                mask = mask.unsqueeze(0)
+            if self.can_fuse(img, mask):
+                groups.setdefault(("fused", img.shape[1], img.shape[2]), []).append((img, mask, offset))
+            else:
+                groups.setdefault(("image", img.shape[1], img.shape[2]), []).append((img, None, offset))
+                if mask is not None:
+                    groups.setdefault(("mask", mask.shape[1], mask.shape[2]), []).append((None, mask, offset))
+            offset += img.shape[0]
+
+        for (kind, h, w), members in groups.items():
+            if h == height and w == width:
+                # nothing to resize, copied as they are
+                for img, mask, offset in members:
+                    if img is not None:
+                        image_batch[offset:offset + img.shape[0]] = img
+                    if mask is not None:
+                        masks_batch[offset:offset + mask.shape[0]] = mask
+                continue
+
+            if kind == "fused":
+                tensors = [torch.cat((img, mask.unsqueeze(-1)), dim=-1) for img, mask, _ in members]
+            elif kind == "image":
+                tensors = [img for img, _, _ in members]
+            else:
+                tensors = [mask.unsqueeze(-1) for _, mask, _ in members]
+
+            stacked = tensors[0] if len(tensors) == 1 else torch.cat(tensors, dim=0)
+            samples = stacked.movedim(-1, 1)  # NHWC -> NCHW
+            samples = common_upscale(samples, width, height, self.normalize_upscale_method, crop="center")
+            resized = samples.movedim(1, -1)  # NCHW -> NHWC
+            resized_parts = []
+            position = 0
+            for tensor in tensors:
+                resized_parts.append(resized[position:position + tensor.shape[0]])
+                position += tensor.shape[0]
+
+            for (img, mask, offset), part in zip(members, resized_parts):
+                count = part.shape[0]
+                if kind == "fused":
+                    image_batch[offset:offset + count] = part[..., :channels]
+                    masks_batch[offset:offset + count] = part[..., channels]
+                elif kind == "image":
+                    image_batch[offset:offset + count] = part
+                else:
+                    masks_batch[offset:offset + count] = part[..., 0]
 
-        return (image_batch, masks_batch, width, height)
+        return image_batch, masks_batch
 
 class AIHubUtilsNewNormalizer:
     """
@@ -2871,14 +2955,18 @@ class AIHubUtilsNewNormalizer:
                 "normalize_at_width": ("INT", {"default": 0, "tooltip": "If greater than 0, it will resize all images to this width, requiring normalize_at_height to be set, by default normalization is otherwise done at the image with most megapixels"}),
                 "normalize_at_height": ("INT", {"default": 0, "tooltip": "If greater than 0, it will resize all images to this height, requiring normalize_at_width to be set, by default normalization is otherwise done at the image with most megapixels"}),
                 "normalize_upscale_method": (["nearest-exact", "bilinear", "area", "bicubic", "lanczos"], {"default": "nearest-exact", "tooltip": "The method to use when upscaling images"}),
+            },
+            "optional": {
+                "strategy": (NORMALIZER_STRATEGIES, {"default": "auto", "tooltip": "How the size is chosen, largest, smallest and first use the size of that image, fixed uses normalize_at_width and normalize_at_height, fit_megapixels scales the largest image down to fit within the megapixels; auto is fixed if the width and height are given, otherwise largest"}),
+                "megapixels": ("FLOAT", {"default": 1.0, "min": 0.01, "max": 100.0, "step": 0.01, "tooltip": "The megapixels the images must fit within for the fit_megapixels strategy"}),
             }
         }
     
-    def new_normalizer(self, normalize_at_width, normalize_at_height, normalize_upscale_method):
+    def new_normalizer(self, normalize_at_width, normalize_at_height, normalize_upscale_method, strategy="auto", megapixels=1.0):
         if ((normalize_at_width == 0) or (normalize_at_height == 0)) and ((normalize_at_width != 0) or (normalize_at_height != 0)):
             raise ValueError("Error: Both normalize_at_width and normalize_at_height must be set to values greater than 0, or both must be set to 0 to disable fixed size normalization")
         
-        normalizer = Normalizer(normalize_at_width, normalize_at_height, normalize_upscale_method)
+        normalizer = Normalizer(normalize_at_width, normalize_at_height, normalize_upscale_method, strategy, megapixels)
         return (normalizer,)
     
 class AIHubUtilsScaleImageAndMasks:
@@ -2940,10 +3028,13 @@ class AIHubMetaSetExportedModelImage:
             "required": {
                 "model": (get_filename_list_for_aihub_folder(AIHUB_MODELS_DIR), {"default": "", "tooltip": "The id of the model to set the image for"}),
                 "image": ("IMAGE", {"tooltip": "The image to set for the model"}),
+            },
+            "optional": {
+                "compress_level": ("INT", {"default": 6, "min": 0, "max": 9, "tooltip": "The png compression level, 9 makes the smallest files for the clients to download but takes longer"}),
             }
         }
     
-    def set_exported_model_image(self, model, image):
+    def set_exported_model_image(self, model, image, compress_level=6):
         if image is None or len(image) == 0:
             raise ValueError("Error: No image specified")
 
@@ -2951,10 +3042,10 @@ class AIHubMetaSetExportedModelImage:
 
         if image is not None:
             # save the image to the models folder with the name of the model id
-            c_image = image[0]
-            i = 255. * c_image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            img.save(os.path.join(AIHUB_MODELS_DIR, image_filename), format='PNG')
+            # the file is served as a png to the clients so it is always encoded as one
+            img = image_to_pil(image[0])
+            with open(os.path.join(AIHUB_MODELS_DIR, image_filename), "wb") as f:
+                f.write(encode_image(img, "png", compress_level=compress_level))
 
         return ()
     
@@ -3045,9 +3136,7 @@ class AIHubMetaExportModel:
 
         if optional_image is not None:
             # save the image to the models folder with the name of the model id
-            c_image = optional_image[0]
-            i = 255. * c_image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+            img = image_to_pil(optional_image[0])
             img.save(os.path.join(AIHUB_MODELS_DIR, image_filename), format='PNG')
 
         json_filename = id + ".json"
@@ -3063,6 +3152,9 @@ class AIHubMetaExportModel:
         with open(os.path.join(AIHUB_MODELS_LOCALE_DIR, "default", json_filename), "w", encoding="utf-8") as f:
             json.dump({"name": name, "description": description}, f, indent=4)
 
+        # let the server know so the clients get the new model
+        invalidate_aihub_cache("models", json_filename)
+
         return ()
     
 class AIHubMetaExportLora:
@@ -3130,9 +3222,7 @@ class AIHubMetaExportLora:
         image_filename = id + ".png"
         if optional_image is not None:
             # save the image to the models folder with the name of the model id
-            c_image = optional_image[0]
-            i = 255. * c_image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+            img = image_to_pil(optional_image[0])
             img.save(os.path.join(AIHUB_LORAS_DIR, image_filename), format='PNG')
 
         json_filename = id + ".json"
@@ -3148,6 +3238,9 @@ class AIHubMetaExportLora:
         with open(os.path.join(AIHUB_LORAS_LOCALE_DIR, "default", json_filename), "w", encoding="utf-8") as f:
             json.dump({"name": name, "description": description}, f, indent=4)
 
+        # let the server know so the clients get the new lora
+        invalidate_aihub_cache("loras", json_filename)
+
         return ()
     
 class AIHubMetaSetExportedLoraImage:
@@ -3168,10 +3261,13 @@ class AIHubMetaSetExportedLoraImage:
             "required": {
                 "lora": (get_filename_list_for_aihub_folder(AIHUB_LORAS_DIR), {"default": "", "tooltip": "The id of the lora to set the image for"}),
                 "image": ("IMAGE", {"tooltip": "The image to set for the lora"}),
+            },
+            "optional": {
+                "compress_level": ("INT", {"default": 6, "min": 0, "max": 9, "tooltip": "The png compression level, 9 makes the smallest files for the clients to download but takes longer"}),
             }
         }
 
-    def set_exported_lora_image(self, lora, image):
+    def set_exported_lora_image(self, lora, image, compress_level=6):
         if image is None or len(image) == 0:
             raise ValueError("Error: No image specified")
 
@@ -3179,10 +3275,10 @@ class AIHubMetaSetExportedLoraImage:
 
         if image is not None:
             # save the image to the lora folder with the name of the lora id
-            c_image = image[0]
-            i = 255. * c_image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            img.save(os.path.join(AIHUB_LORAS_DIR, image_filename), format='PNG')
+            # the file is served as a png to the clients so it is always encoded as one
+            img = image_to_pil(image[0])
+            with open(os.path.join(AIHUB_LORAS_DIR, image_filename), "wb") as f:
+                f.write(encode_image(img, "png", compress_level=compress_level))
 
         return ()
     
@@ -3204,10 +3300,13 @@ class AIHubMetaSetExportedWorkflowImage:
             "required": {
                 "workflow": (get_filename_list_for_aihub_folder(AIHUB_WORKFLOWS_DIR), {"default": "", "tooltip": "The id of the workflow to set the image for"}),
                 "image": ("IMAGE", {"tooltip": "The image to set for the workflow"}),
+            },
+            "optional": {
+                "compress_level": ("INT", {"default": 6, "min": 0, "max": 9, "tooltip": "The png compression level, 9 makes the smallest files for the clients to download but takes longer"}),
             }
         }
 
-    def set_exported_workflow_image(self, workflow, image):
+    def set_exported_workflow_image(self, workflow, image, compress_level=6):
         if image is None or len(image) == 0:
             raise ValueError("Error: No image specified")
 
@@ -3215,9 +3314,9 @@ class AIHubMetaSetExportedWorkflowImage:
 
         if image is not None:
             # save the image to the workflows folder with the name of the workflow id
-            c_image = image[0]
-            i = 255. * c_image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            img.save(os.path.join(AIHUB_WORKFLOWS_DIR, image_filename), format='PNG')
+            # the file is served as a png to the clients so it is always encoded as one
+            img = image_to_pil(image[0])
+            with open(os.path.join(AIHUB_WORKFLOWS_DIR, image_filename), "wb") as f:
+                f.write(encode_image(img, "png", compress_level=compress_level))
 
         return ()
\ No newline at end of file
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+class ClientConnection:
+    """
+    The outbound queue of a websocket client, everything that is sent to the client goes
+    through here in order, and the messages that belong together such as the header of a file
+    and the file itself are sent one right after the other
+
+    The queue has a budget of bytes, a thread that wants to send more than what fits waits until
+    the client received enough of what was queued before, that way a slow client makes the
+    execution wait instead of piling up its outputs in memory; a client that does not receive
+    anything for budget_timeout seconds while a thread waits is considered gone and its
+    connection is closed, so the execution is never stuck on a dead socket
+    """
+
+    def __init__(self, ws, loop, max_queued_bytes, budget_timeout=None):
+        self.ws = ws
+        self.loop = loop
+        self.max_queued_bytes = max_queued_bytes
+        self.budget_timeout = budget_timeout
+
+        self.condition = threading.Condition()
+        self.queue = asyncio.Queue()
+        self.closed = False
+        self.writer_task = None
+
+        # metrics
+        self.queued_bytes = 0
+        self.queued_messages = 0
+        self.peak_queued_bytes = 0
+        self.sent_bytes = 0
+        self.sent_messages = 0
+        self.waiting_producers = 0
+        self.total_wait_count = 0
+
+    def start(self):
+        """
+        Starts the writer, must be called from the server loop
+        """
+        self.writer_task = self.loop.create_task(self.writer())
+
+    async def writer(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                break
+            messages, size, future = item
+            try:
+                if self.closed:
+                    raise ConnectionResetError("Connection closed")
+                for kind, payload in messages:
+                    if kind == "str":
+                        await self.ws.send_str(payload)
+                    else:
+                        await self.ws.send_bytes(payload)
+                with self.condition:
+                    self.sent_bytes += size
+                    self.sent_messages += len(messages)
+                future.set_result(None)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self.release(size, len(messages))
+
+        # nothing is put in the queue after the end, but what was there is failed so nobody waits for it
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                messages, size, future = item
+                future.set_exception(ConnectionResetError("Connection closed"))
+                self.release(size, len(messages))
+
+    def release(self, size, count):
+        with self.condition:
+            self.queued_bytes -= size
+            self.queued_messages -= count
+            self.condition.notify_all()
+
+    def prepare(self, messages):
+        """
+        Converts the messages into what is sent through the websocket, json messages are
+        serialized here so their size is known
+        """
+        prepared = []
+        size = 0
+        for message in messages:
+            if isinstance(message, (bytes, bytearray, memoryview)):
+                prepared.append(("bytes", message))
+                size += len(message)
+            else:
+                payload = json.dumps(message)
+                prepared.append(("str", payload))
+                size += len(payload)
+        return prepared, size
+
+    def enqueue(self, messages, wait_for_budget=False):
+        """
+        Queues messages to be sent in order, each message is either a json serializable object
+        or bytes, provides a future that is done once the client received them
+
+        When wait_for_budget is set the calling thread waits while the queue is over its budget,
+        this must never be done from the server loop because that is the one that empties the queue
+        """
+        prepared, size = self.prepare(messages)
+        future = Future()
+        timed_out = False
+        with self.condition:
+            if wait_for_budget:
+                waited = False
+                deadline = None
+                # a message that is larger than the budget is allowed once the queue is empty
+                while not self.closed and self.queued_bytes > 0 and self.queued_bytes + size > self.max_queued_bytes:
+                    if not waited:
+                        waited = True
+                        self.total_wait_count += 1
+                    if self.budget_timeout is not None:
+                        # the deadline moves whenever the client receives something
+                        if deadline is None:
+                            deadline = time.monotonic() + self.budget_timeout
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            timed_out = True
+                            break
+                    else:
+                        remaining = None
+                    self.waiting_producers += 1
+                    sent_bytes = self.sent_bytes
+                    try:
+                        self.condition.wait(remaining)
+                    finally:
+                        self.waiting_producers -= 1
+                    if self.sent_bytes != sent_bytes:
+                        deadline = None
+            if self.closed or timed_out:
+                future.set_exception(ConnectionResetError("Connection closed"))
+            else:
+                self.queued_bytes += size
+                self.queued_messages += len(prepared)
+                self.peak_queued_bytes = max(self.peak_queued_bytes, self.queued_bytes)
+                # queued with the lock held so nothing gets behind the end put by close
+                self.put(prepared, size, future)
+
+        if timed_out:
+            print(f"Client did not receive anything in {self.budget_timeout} seconds, closing its connection")
+            self.close()
+            try:
+                asyncio.run_coroutine_threadsafe(self.ws.close(), self.loop)
+            except RuntimeError:
+                # the loop is gone already
+                pass
+        return future
+
+    def put(self, prepared, size, future):
+        # the condition must be held
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (prepared, size, future))
+        except RuntimeError as e:
+            # the server loop is closed, nothing will ever be sent
+            self.queued_bytes -= size
+            self.queued_messages -= len(prepared)
+            future.set_exception(ConnectionResetError(f"Connection closed: {e}"))
+
+    def send_sync(self, *messages):
+        """
+        Sends from a thread other than the server loop, waits if the queue is over its budget
+        """
+        return self.enqueue(messages, wait_for_budget=True)
+
+    async def send(self, *messages):
+        """
+        Sends from the server loop and waits until the client received the messages
+        """
+        await asyncio.wrap_future(self.enqueue(messages))
+
+    async def send_json(self, data):
+        await self.send(data)
+
+    def close(self):
+        """
+        Closes the queue, what was not sent yet is dropped and the threads waiting for the budget are released
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+            try:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+            except RuntimeError:
+                # the server loop is closed, the writer is not running anymore
+                pass
+
+    def get_metrics(self):
+        with self.condition:
+            return {
+                "queued_bytes": self.queued_bytes,
+                "queued_messages": self.queued_messages,
+                "peak_queued_bytes": self.peak_queued_bytes,
+                "sent_bytes": self.sent_bytes,
+                "sent_messages": self.sent_messages,
+                "waiting_producers": self.waiting_producers,
+                "total_wait_count": self.total_wait_count,
+                "max_queued_bytes": self.max_queued_bytes,
+            }
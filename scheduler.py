@@ -0,0 +1,177 @@
+import threading
+from collections import deque, OrderedDict
+
+# the priority a client can ask for a run, higher runs first
+MIN_PRIORITY = -10
+MAX_PRIORITY = 10
+DEFAULT_PRIORITY = 0
+
+def parse_priority(value):
+    """
+    Provides the priority for a run from the value given by the client, clamped
+    to the allowed range, or None if the value is not valid
+    """
+    if value is None:
+        return DEFAULT_PRIORITY
+    if isinstance(value, bool) or not isinstance(value, int):
+        return None
+    return max(MIN_PRIORITY, min(MAX_PRIORITY, value))
+
+class WorkflowScheduler:
+    """
+    Keeps the workflow runs that are waiting to be executed
+
+    Runs with a higher priority always go first, within the same priority the clients
+    take turns so that a client that queued many runs does not starve the others, and
+    the runs of a single client are executed in the order they arrived
+
+    Cancelling a run only removes it from the index, the queues of the clients
+    skip the ids that are not in the index anymore when they are reached
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+        # priority -> client -> deque of run ids, the order of the clients is the turn order
+        self.levels = {}
+        # run id -> (run, priority, client)
+        self.index = {}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.index)
+
+    def push(self, run, client, priority=DEFAULT_PRIORITY):
+        """
+        Adds a run to the queue, the run must be a dictionary with an id
+        """
+        with self.lock:
+            level = self.levels.get(priority)
+            if level is None:
+                level = OrderedDict()
+                self.levels[priority] = level
+            queue = level.get(client)
+            if queue is None:
+                # a client that was not waiting gets its turn after the ones that are
+                queue = deque()
+                level[client] = queue
+            queue.append(run["id"])
+            self.index[run["id"]] = (run, priority, client)
+
+    def pop(self):
+        """
+        Takes the next run to execute, or None if there is nothing waiting
+        """
+        with self.lock:
+            for priority in sorted(self.levels.keys(), reverse=True):
+                level = self.levels[priority]
+                while len(level) > 0:
+                    client, queue = next(iter(level.items()))
+                    run = None
+                    while len(queue) > 0 and run is None:
+                        indexed = self.index.pop(queue.popleft(), None)
+                        if indexed is not None:
+                            run = indexed[0]
+
+                    if len(queue) == 0:
+                        del level[client]
+                    else:
+                        # the client goes to the end of the line
+                        level.move_to_end(client)
+
+                    if run is not None:
+                        if len(level) == 0:
+                            del self.levels[priority]
+                        return run
+                del self.levels[priority]
+            return None
+
+    def cancel(self, run_id, client=None):
+        """
+        Removes a run from the queue, if a client is given the run must belong to it,
+        provides the removed run or None if it was not waiting
+        """
+        with self.lock:
+            indexed = self.index.get(run_id)
+            if indexed is None or (client is not None and indexed[2] is not client):
+                return None
+            del self.index[run_id]
+            return indexed[0]
+
+    def remove_client(self, client):
+        """
+        Removes all the runs of a client, provides the removed runs
+        """
+        removed = []
+        with self.lock:
+            for priority in list(self.levels.keys()):
+                level = self.levels[priority]
+                queue = level.pop(client, None)
+                if queue is not None:
+                    for run_id in queue:
+                        indexed = self.index.pop(run_id, None)
+                        if indexed is not None:
+                            removed.append(indexed[0])
+                if len(level) == 0:
+                    del self.levels[priority]
+        return removed
+
+    def ordered(self):
+        """
+        Provides the runs that are waiting in the order they would be executed
+        """
+        result = []
+        with self.lock:
+            for priority in sorted(self.levels.keys(), reverse=True):
+                # simulate the turns of the clients without modifying the queues
+                turns = deque(
+                    deque(run_id for run_id in queue if run_id in self.index)
+                    for queue in self.levels[priority].values()
+                )
+                while len(turns) > 0:
+                    queue = turns.popleft()
+                    if len(queue) == 0:
+                        continue
+                    result.append(self.index[queue.popleft()][0])
+                    turns.append(queue)
+        return result
+
+class RunRegistry:
+    """
+    Keeps the runs that were submitted to comfyui by their prompt id, this is where
+    the progress, the outputs and the completion of a prompt find the client they belong to
+
+    A run that is not in the registry anymore was cancelled or finished, whatever
+    it still produces is dropped
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # prompt id -> run, in the order they were submitted
+        self.runs = {}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.runs)
+
+    def add(self, run):
+        with self.lock:
+            self.runs[run["id"]] = run
+
+    def get(self, prompt_id):
+        if prompt_id is None:
+            return None
+        with self.lock:
+            return self.runs.get(prompt_id, None)
+
+    def remove(self, prompt_id):
+        """
+        Removes a run from the registry, provides the run or None if it was
+        already removed, so only one caller gets to finish a run
+        """
+        with self.lock:
+            return self.runs.pop(prompt_id, None)
+
+    def for_client(self, client):
+        with self.lock:
+            return [run for run in self.runs.values() if run["ws"] is client]
@@ -2,15 +2,13 @@ import asyncio
 import threading
 import json
 import uuid
-from os import path, listdir, environ, makedirs
-from copy import deepcopy
+from os import path, listdir, environ, makedirs, remove
 import tempfile
-from time import sleep
 import re
+import hmac
 from functools import partial
 from nodes import interrupt_processing
 import comfy.samplers
-from shutil import rmtree
 import threading
 from folder_paths import get_filename_list
 
@@ -19,6 +17,20 @@ from server import PromptServer
 from execution import validate_prompt, SENSITIVE_EXTRA_DATA_KEYS
 
 from .aihub_env import AIHUB_DIR, AIHUB_LORAS_LOCALE_DIR, AIHUB_MODELS_DIR, AIHUB_LORAS_DIR, AIHUB_MODELS_LOCALE_DIR, AIHUB_WORKFLOWS_DIR, AIHUB_WORKFLOWS_LOCALE_DIR
+from .catalog import JsonDirectoryCatalog, WorkflowCatalog, resolve_locale_file
+from .scheduler import WorkflowScheduler, RunRegistry, parse_priority
+from .outbound import ClientConnection
+from .uploads import ChunkedUpload, UploadOffsetError, UploadHashError, UPLOAD_CHUNK_OFFSET, write_file_atomic, get_partial_path
+from .fsio import run_io, write_json, write_binary, file_exists, make_dirs
+from .janitor import SessionJanitor
+from .blobs import BlobStore, HASH_PATTERN
+from .inputcache import DECODE_CACHE
+
+try:
+    from comfy_execution.utils import get_executing_context
+except ImportError:
+    # older comfyui versions do not expose the context of the executing node
+    get_executing_context = None
 
 WEB_SOCKET_SERVER_PORT = 8000
 SERVER_THREAD = None
@@ -27,21 +39,103 @@ SERVER_RUNNING_FLAG = threading.Event()
 AIHUB_COLD = environ.get("AIHUB_COLD", "0") == "1"
 AIHUB_PERSIST_TEMPFILES = environ.get("AIHUB_PERSIST_TEMPFILES", "0") == "1"
 
-WORKFLOWS_CACHE_RAW = None
-WORKFLOWS_CACHE_VALID = None
-WORKFLOWS_AIHUB_SUMMARY = {}
+# token required to use the administrative endpoints, if not set those endpoints are disabled
+AIHUB_ADMIN_TOKEN = environ.get("AIHUB_ADMIN_TOKEN", None)
 
-LORAS_CACHE_RAW = None
-LORAS_CACHE_CLEANED = {}
+# how many seconds pass at least between two scans of the aihub directories for new or changed files
+AIHUB_CATALOG_RESCAN_INTERVAL = float(environ.get("AIHUB_CATALOG_RESCAN_INTERVAL", 5))
+
+# the workflows, loras and models are kept parsed in memory, only the files that change are read again
+# and in cold mode the directories are only read once until the cache is invalidated
+WORKFLOW_CATALOG = WorkflowCatalog(AIHUB_WORKFLOWS_DIR, AIHUB_WORKFLOWS_LOCALE_DIR, cold=AIHUB_COLD, rescan_interval=AIHUB_CATALOG_RESCAN_INTERVAL)
+LORAS_CATALOG = JsonDirectoryCatalog(AIHUB_LORAS_DIR, "lora", cold=AIHUB_COLD, rescan_interval=AIHUB_CATALOG_RESCAN_INTERVAL)
+MODELS_CATALOG = JsonDirectoryCatalog(AIHUB_MODELS_DIR, "model", cold=AIHUB_COLD, rescan_interval=AIHUB_CATALOG_RESCAN_INTERVAL)
 
-MODELS_CACHE_RAW = None
+# locale -> (catalog version, cleaned list), only used in cold mode
+LORAS_CACHE_CLEANED = {}
 MODELS_CACHE_CLEANED = {}
 
+def warm_aihub_cache():
+    """
+    Reads the workflows, loras and models into memory so that
+    the first client does not have to wait for it
+    """
+    WORKFLOW_CATALOG.refresh()
+    LORAS_CATALOG.refresh()
+    MODELS_CATALOG.refresh()
+
+def invalidate_aihub_cache(kind=None, file_name=None):
+    """
+    Invalidates the cached data of the given kind, "workflows", "loras" or "models"
+    or all of them if no kind is given; if a file name is given only that file is
+    read again, otherwise the whole directory is
+
+    This waits for the catalog locks, so it must not be called from the server loop, see run_io
+    """
+    catalogs = {
+        "workflows": WORKFLOW_CATALOG,
+        "loras": LORAS_CATALOG,
+        "models": MODELS_CATALOG,
+    }
+    if kind is not None and kind not in catalogs:
+        raise ValueError(f"Unknown cache kind {kind}")
+
+    for catalog_kind, catalog in catalogs.items():
+        if kind is not None and catalog_kind != kind:
+            continue
+        if file_name is not None:
+            catalog.reload_file(file_name)
+        else:
+            catalog.invalidate()
+            if AIHUB_COLD:
+                catalog.refresh()
+
+    # the locale files may have changed as well
+    if kind is None or kind == "workflows":
+        WORKFLOW_CATALOG.clear_locale_cache()
+    if kind is None or kind == "loras":
+        LORAS_CACHE_CLEANED.clear()
+    if kind is None or kind == "models":
+        MODELS_CACHE_CLEANED.clear()
+
 AIHUB_TEMP_DIRECTORY_ENV = environ.get("AIHUB_TEMP_DIR", None)
 AIHUB_TEMP_DIRECTORY = AIHUB_TEMP_DIRECTORY_ENV if AIHUB_TEMP_DIRECTORY_ENV is not None else tempfile.gettempdir()
 
 AIHUB_MAX_MESSAGE_SIZE = int(environ.get("AIHUB_MAX_MESSAGE_SIZE", 50 * 1024 * 1024))  # 50 MB
 
+# the uploads that come with a hash are kept in a store shared by all the sessions, up to this
+# many bytes, the least recently used are removed first; 0 disables the store
+AIHUB_BLOB_STORE_MAX_BYTES = int(environ.get("AIHUB_BLOB_STORE_MAX_BYTES", 10 * 1024 * 1024 * 1024))  # 10 GB
+# how many seconds the partial files of the hashed uploads that were left unfinished are kept
+AIHUB_BLOB_PARTIAL_MAX_AGE = int(environ.get("AIHUB_BLOB_PARTIAL_MAX_AGE", 24 * 60 * 60))  # 1 day
+# the store reads its directory the first time it is used, in the io threads
+BLOB_STORE = BlobStore(path.join(AIHUB_TEMP_DIRECTORY, "comfyui_socket_aihub_files", "blobs"), AIHUB_BLOB_STORE_MAX_BYTES, AIHUB_BLOB_PARTIAL_MAX_AGE)
+
+# how many bytes of files a single session can store and all the sessions together, 0 is no limit
+AIHUB_SESSION_MAX_BYTES = int(environ.get("AIHUB_SESSION_MAX_BYTES", 5 * 1024 * 1024 * 1024))  # 5 GB
+AIHUB_SESSIONS_MAX_BYTES = int(environ.get("AIHUB_SESSIONS_MAX_BYTES", 20 * 1024 * 1024 * 1024))  # 20 GB
+# how often in seconds the session directories are measured and the ones that are over removed
+AIHUB_JANITOR_INTERVAL = max(1, int(environ.get("AIHUB_JANITOR_INTERVAL", 60)))
+JANITOR = SessionJanitor(
+    path.join(AIHUB_TEMP_DIRECTORY, "comfyui_socket_aihub_files"),
+    AIHUB_SESSION_MAX_BYTES,
+    AIHUB_SESSIONS_MAX_BYTES,
+    persist=AIHUB_PERSIST_TEMPFILES,
+    interval=AIHUB_JANITOR_INTERVAL,
+    # the blob store is not a session, only its stale partial files are collected
+    extra_sweeps=[BLOB_STORE.collect_partials],
+)
+
+# how many runs are submitted to the comfyui prompt queue at once, the runs after the first
+# are already waiting in comfyui when the previous one finishes so the gpu does not idle in between
+AIHUB_PIPELINE_DEPTH = max(1, int(environ.get("AIHUB_PIPELINE_DEPTH", 2)))
+
+# how many bytes can be waiting to be sent to a single client before the execution waits for it
+AIHUB_MAX_QUEUED_BYTES_PER_CLIENT = int(environ.get("AIHUB_MAX_QUEUED_BYTES_PER_CLIENT", 64 * 1024 * 1024))  # 64 MB
+
+# how many seconds the execution waits for a client that does not receive anything before its connection is closed, 0 waits forever
+AIHUB_SEND_TIMEOUT = float(environ.get("AIHUB_SEND_TIMEOUT", 300))
+
 @PromptServer.instance.routes.post("/aihub_workflows")
 async def handle_workflow_add(request):
     # get the json data from the request
@@ -61,8 +155,10 @@ async def handle_workflow_add(request):
         return web.json_response({"error": "Invalid workflow data"}, status=400)
     
     # save the json data to the aihub directory
-    with open(path.join(AIHUB_WORKFLOWS_DIR, f"{workflow_id}.json"), "w") as f:
-        json.dump(data, f)
+    await write_json(path.join(AIHUB_WORKFLOWS_DIR, f"{workflow_id}.json"), data)
+
+    # make sure the catalog picks the new workflow regardless of the mtime resolution
+    await run_io(invalidate_aihub_cache, "workflows", f"{workflow_id}.json")
 
     return web.json_response({"status": "ok"})
 
@@ -79,10 +175,10 @@ async def handle_workflow_locale_add(request):
     
     # save the json data to the aihub directory
     locale_folder = path.join(AIHUB_WORKFLOWS_LOCALE_DIR, locale)
-    if not path.exists(locale_folder):
-        makedirs(locale_folder)
-    with open(path.join(locale_folder, f"{workflow_id}.json"), "w") as f:
-        json.dump(data, f)
+    await write_json(path.join(locale_folder, f"{workflow_id}.json"), data)
+
+    # the catalog lock may be held by a refresh in the io threads, it is not waited for in the server loop
+    await run_io(WORKFLOW_CATALOG.clear_locale_cache)
 
     return web.json_response({"status": "ok"})
 
@@ -101,11 +197,64 @@ async def handle_workflow_image_add(request):
         return web.json_response({"error": "Invalid workflow id"}, status=400)
 
     # save the image data to the aihub directory
-    with open(path.join(AIHUB_WORKFLOWS_DIR, f"{workflow_id}.png"), "wb") as f:
-        f.write(data)
+    await write_binary(path.join(AIHUB_WORKFLOWS_DIR, f"{workflow_id}.png"), data)
+
+    return web.json_response({"status": "ok"})
+
+def check_admin_request(request, what):
+    """
+    Provides an error response if the request does not carry the admin token as
+    a bearer token, or None if it does
+    """
+    if not AIHUB_ADMIN_TOKEN:
+        return web.json_response({"error": f"{what} is disabled, set AIHUB_ADMIN_TOKEN to enable it"}, status=403)
+    
+    authorization = request.headers.get("Authorization", "")
+    if not authorization.startswith("Bearer ") or not hmac.compare_digest(authorization[len("Bearer "):].encode("utf-8"), AIHUB_ADMIN_TOKEN.encode("utf-8")):
+        return web.json_response({"error": "Unauthorized"}, status=401)
+    return None
+
+@PromptServer.instance.routes.post("/aihub_cache/invalidate")
+async def handle_cache_invalidate(request):
+    # this endpoint requires the admin token to be configured and given as a bearer token
+    error_response = check_admin_request(request, "Cache invalidation")
+    if error_response is not None:
+        return error_response
+
+    kind = None
+    if request.can_read_body:
+        try:
+            data = await request.json()
+            kind = data.get("kind", None) if isinstance(data, dict) else None
+        except Exception as e:
+            return web.json_response({"error": "Invalid JSON data"}, status=400)
+
+    try:
+        await run_io(invalidate_aihub_cache, kind)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
 
     return web.json_response({"status": "ok"})
 
+@PromptServer.instance.routes.get("/aihub_metrics")
+async def handle_metrics(request):
+    error_response = check_admin_request(request, "Metrics")
+    if error_response is not None:
+        return error_response
+
+    clients = [connection.get_metrics() for connection in list(AIHubServer.CONNECTIONS.values())]
+    return web.json_response({
+        "clients": clients,
+        "queued_bytes": sum(client["queued_bytes"] for client in clients),
+        "queued_messages": sum(client["queued_messages"] for client in clients),
+        "waiting_producers": sum(client["waiting_producers"] for client in clients),
+        "runs_waiting": len(AIHubServer.SCHEDULER),
+        "runs_submitted": len(AIHubServer.RUNS),
+        "blob_store": BLOB_STORE.get_metrics(),
+        "session_files": JANITOR.get_metrics(),
+        "decode_cache": DECODE_CACHE.get_metrics(),
+    })
+
 @PromptServer.instance.routes.get("/aihub_list_models_and_loras")
 async def handle_list_models(request):
     return web.json_response({"checkpoints": get_filename_list("checkpoints"), "diffusion_models": get_filename_list("diffusion_models"),
@@ -116,14 +265,17 @@ class AIHubServer:
     the server class handles the websocket server and the workflow queue
     file uploads and downloads, as well as the workflow validation and processing
     """
-    CURRENTLY_RUNNING = None
-    WORKFLOW_REQUEST_QUEUE = []
+    # the prompt comfyui is executing right now, it may not be one of ours
+    EXECUTING_PROMPT_ID = None
+    # the runs that were put in the comfyui prompt queue and did not finish yet, by prompt id
+    RUNS = RunRegistry()
+    SCHEDULER = WorkflowScheduler()
+    # websocket -> outbound queue of the client
+    CONNECTIONS = {}
     QUEUE_LOCK = threading.Lock()
 
     LAST_PING_QUEUE_VALUE = None
 
-    awaiting_tasks_amount = 0
-    awaiting_tasks_done_flag = None
     awaiting_tasks_lock = threading.Lock()
 
     loop = None
@@ -157,9 +309,11 @@ class AIHubServer:
         if not path.exists(AIHUB_MODELS_LOCALE_DIR):
             makedirs(AIHUB_MODELS_LOCALE_DIR)
 
-        originalQueueUpdatedFn = PromptServer.instance.queue_updated
+        # in cold mode everything is read once at start so connecting clients never touch the disk
+        if AIHUB_COLD:
+            warm_aihub_cache()
+
         originalSendSyncFn = PromptServer.instance.send_sync
-        PromptServer.instance.queue_updated = partial(self.queue_updated_override, originalQueueUpdatedFn)
         PromptServer.instance.send_sync = partial(self.send_sync_override, originalSendSyncFn)
         
         return
@@ -167,124 +321,107 @@ class AIHubServer:
     def send_sync_override(self, originalFn, event, data, sid=None):
         originalFn(event, data, sid)
 
-        if (event == "progress_state" and self.CURRENTLY_RUNNING is not None):
-            prompt_id_to_check = self.CURRENTLY_RUNNING["id"]
-            if data is not None and data.get("prompt_id", None) == prompt_id_to_check:
-                # this is a dictionary where the key is the node id and the value is the node data
-                # we need to get the data of a node that has a property named state that equals to "running"
-                all_nodes = data.get("nodes", {})
-                for node_id, node_data in all_nodes.items():
-                    if node_data.get("state", "") == "running":
-                        workflow = self.CURRENTLY_RUNNING['workflow']
-                        node_info = workflow.get(node_id, {})
-                        node_name = node_info.get("_meta", {}).get("title", node_info.get("class_type", "Unknown"))
-                        future = asyncio.run_coroutine_threadsafe(
-                                self.CURRENTLY_RUNNING["ws"].send_json({
-                                    'type': 'WORKFLOW_STATUS',
-                                    'id': prompt_id_to_check,
-                                    'workflow_id': self.CURRENTLY_RUNNING['workflow_id'],
-                                    'node_id': node_id,
-                                    'node_name': node_name,
-                                    'progress': node_data.get("value", 0),
-                                    'total': node_data.get("max", 1),
-                                }), self.loop
-                            )
-                        break
-    
-    def queue_updated_override(self, originalFn):
-        # this should still have the self of the PromptServer instance because it is a bound method
-        originalFn()
-
-        queue_info = PromptServer.instance.get_queue_info()
-        task_completed = False
-        if (queue_info is not None and "exec_info" in queue_info and "queue_remaining" in queue_info["exec_info"]):
-            queue_remaining = queue_info["exec_info"]["queue_remaining"]
-            task_completed = queue_remaining == 0
-
-        # {'exec_info': {'queue_remaining': 0}}
-        prompt_id_to_check = self.CURRENTLY_RUNNING["id"] if self.CURRENTLY_RUNNING is not None else None
-        if (prompt_id_to_check is not None and task_completed):
-            prompt_info = PromptServer.instance.prompt_queue.get_history(prompt_id=prompt_id_to_check)
-
-            if prompt_info and prompt_id_to_check in prompt_info:
-                prompt_specific_data = prompt_info[prompt_id_to_check]
-                status = prompt_specific_data["status"]
-
-                if self.awaiting_tasks_amount > 0:
-                    self.awaiting_tasks_done_flag.wait(timeout=30)
-
-                if ("status_str" in status and status["status_str"] == "error"):
-                    error_message = "Unknown error"
-                    if "messages" in status:
-                        error_message = ", ".join([data.get('exception_message', "").replace("\n", "") 
-                            for v, data in status['messages'] 
-                            if v == 'execution_error'])
-                    try:
-                        asyncio.run(self.CURRENTLY_RUNNING["ws"].send_json({
-                            'type': 'WORKFLOW_FINISHED',
-                            'id': prompt_id_to_check,
-                            'workflow_id': self.CURRENTLY_RUNNING['workflow_id'],
-                            'error': True,
-                            'error_message': error_message,
-                        }))
-                    except Exception as e:
-                        print(f"Error sending workflow finished message, maybe user closed connection? {e}")
-                    self.CURRENTLY_RUNNING = None
-                    
-                else:
-                    try:
-                        asyncio.run(self.CURRENTLY_RUNNING["ws"].send_json({
-                            'type': 'WORKFLOW_FINISHED',
-                            'id': prompt_id_to_check,
-                            'workflow_id': self.CURRENTLY_RUNNING['workflow_id'],
-                            'error': False,
-                        }))
-                    except Exception as e:
-                        print(f"Error sending workflow finished message, maybe user closed connection? {e}")
-                    self.CURRENTLY_RUNNING = None
-        
-        if (task_completed):
-            if (self.CURRENTLY_RUNNING is not None):
-                print("Warning: queue remaining is 0 but currently running is not None")
+        prompt_id = data.get("prompt_id", None) if isinstance(data, dict) else None
+        if prompt_id is None:
+            return
+
+        if event == "execution_start":
+            # comfyui executes one prompt at a time, the rest of the submitted runs are waiting in its queue
+            self.EXECUTING_PROMPT_ID = prompt_id
+            run = self.RUNS.get(prompt_id)
+            if run is not None:
+                run["connection"].enqueue([{
+                    'type': 'WORKFLOW_START',
+                    'workflow_id': run["workflow_id"],
+                    'id': run["id"],
+                }])
+
+        elif event == "progress_state":
+            run = self.RUNS.get(prompt_id)
+            if run is None:
                 return
-                
-            self.CURRENTLY_RUNNING = None
-            
-            asyncio.run(self.process_next_workflow_in_queue())
-        else:
-            print("Queue not empty or no current workflow running, not processing next workflow")
-    
-    def retrieve_checkpoints_raw(self):
+            # this is a dictionary where the key is the node id and the value is the node data
+            # we need to get the data of a node that has a property named state that equals to "running"
+            all_nodes = data.get("nodes", {})
+            for node_id, node_data in all_nodes.items():
+                if node_data.get("state", "") == "running":
+                    workflow = run['workflow']
+                    node_info = workflow.get(node_id, {})
+                    node_name = node_info.get("_meta", {}).get("title", node_info.get("class_type", "Unknown"))
+                    # progress messages are small, they never wait for the budget of the client
+                    run["connection"].enqueue([{
+                        'type': 'WORKFLOW_STATUS',
+                        'id': prompt_id,
+                        'workflow_id': run['workflow_id'],
+                        'node_id': node_id,
+                        'node_name': node_name,
+                        'progress': node_data.get("value", 0),
+                        'total': node_data.get("max", 1),
+                    }])
+                    break
+
+        elif event == "execution_success" or event == "execution_error" or event == "execution_interrupted":
+            if self.EXECUTING_PROMPT_ID == prompt_id:
+                self.EXECUTING_PROMPT_ID = None
+
+            # whoever removes the run from the registry finishes it, a cancelled run is already gone
+            run = self.RUNS.remove(prompt_id)
+            if run is None:
+                return
+
+            error_message = None
+            if event == "execution_error":
+                error_message = str(data.get("exception_message", "Unknown error")).replace("\n", "")
+            elif event == "execution_interrupted":
+                error_message = "Workflow run interrupted"
+
+            # this is called from the execution thread, it must not wait for the client
+            asyncio.run_coroutine_threadsafe(self.finish_run(run, error_message), self.loop)
+            asyncio.run_coroutine_threadsafe(self.process_next_workflow_in_queue(), self.loop)
+
+    async def finish_run(self, run, error_message=None):
         """
-        Retrieves all checkpoints json information from the aihub/models directory.
-        checkpoint json files are expected to have the following attributes:
+        Tells the client that a run finished, once everything the run sent before reached the client
         """
+        self.release_run_files(run)
+        while run["awaiting_tasks_amount"] > 0:
+            run["awaiting_tasks_done_flag"].clear()
+            await run["awaiting_tasks_done_flag"].wait()
+
+        message = {
+            'type': 'WORKFLOW_FINISHED',
+            'id': run["id"],
+            'workflow_id': run['workflow_id'],
+            'error': error_message is not None,
+        }
+        if error_message is not None:
+            message['error_message'] = error_message
 
-        if (AIHUB_COLD and MODELS_CACHE_RAW is not None):
-            return MODELS_CACHE_RAW
-        
-        # first let's read the files in the ComfyUI models directory
-        print(f"Loading models from directory: {AIHUB_MODELS_DIR}")
-
-        # if the directory does not exist, return empty list
-        if path.exists(AIHUB_MODELS_DIR):
-            # otherwise, read the files
-            files = listdir(AIHUB_MODELS_DIR)
-            models = []
-            for file in files:
-                if file.endswith(".json"):
-                    with open(path.join(AIHUB_MODELS_DIR, file), "r", encoding="utf-8") as f:
-                        try:
-                            model_data = json.load(f)
-                            models.append(model_data)
-                        except json.JSONDecodeError:
-                            print(f"Error decoding JSON from model file: {file}")
+        try:
+            await run["connection"].send_json(message)
+        except Exception as e:
+            print(f"Error sending workflow finished message, maybe user closed connection? {e}")
 
-            if AIHUB_COLD:
-                MODELS_CACHE_RAW = models
+    def retrieve_info_list(self, locale=None):
+        """
+        The message with everything a client can use that is sent when it connects,
+        it reads the aihub directory so it must not be called from the server loop
+        """
+        return {
+            'type': 'INFO_LIST',
+            'workflows': self.retrieve_valid_workflows_aihub_summary(locale=locale),
+            'models': self.retrieve_checkpoints_cleaned(locale=locale),
+            'loras': self.retrieve_loras_cleaned(locale=locale),
+            'samplers': comfy.samplers.KSampler.SAMPLERS,
+            'schedulers': comfy.samplers.KSampler.SCHEDULERS
+        }
 
-            return models
-        return []
+    def retrieve_checkpoints_raw(self):
+        """
+        Retrieves all checkpoints json information from the aihub/models directory.
+        checkpoint json files are expected to have the following attributes:
+        """
+        return MODELS_CATALOG.values()
     
     def retrieve_checkpoints_cleaned(self, locale=None):
         """
@@ -292,18 +429,18 @@ class AIHubServer:
         """
 
         locale = locale if locale is not None else "default"
-        if (AIHUB_COLD and locale in MODELS_CACHE_CLEANED):
-            return MODELS_CACHE_CLEANED[locale]
+        if AIHUB_COLD:
+            cached = MODELS_CACHE_CLEANED.get(locale)
+            if cached is not None and cached[0] == MODELS_CATALOG.version:
+                return cached[1]
 
         raw_models = self.retrieve_checkpoints_raw()
+        raw_version = MODELS_CATALOG.version
         cleaned_models = []
 
         for model in raw_models:
             id = model.get("id", "None")
-            locale = locale.lower().replace("-", "_")
-            potential_locale_file = path.join(AIHUB_MODELS_LOCALE_DIR, locale, id + ".json")
-            if "_" in locale and not path.exists(potential_locale_file):
-                potential_locale_file = path.join(AIHUB_MODELS_LOCALE_DIR, locale.split("_")[0], id + ".json")
+            potential_locale_file = resolve_locale_file(AIHUB_MODELS_LOCALE_DIR, locale, id)
             locale_data = model
             if path.exists(potential_locale_file):
                 with open(potential_locale_file, "r", encoding="utf-8") as f:
@@ -333,7 +470,7 @@ class AIHubServer:
             cleaned_models.append(cleaned_model)
 
         if AIHUB_COLD:
-            MODELS_CACHE_CLEANED[locale] = cleaned_models
+            MODELS_CACHE_CLEANED[locale] = (raw_version, cleaned_models)
 
         return cleaned_models
     
@@ -341,32 +478,7 @@ class AIHubServer:
         """
         Retrieves all loras information from the aihub/loras directory.
         """
-
-        if (AIHUB_COLD and LORAS_CACHE_RAW is not None):
-            return LORAS_CACHE_RAW
-        
-        # first let's read the files in the ComfyUI loras directory
-        print(f"Loading loras from directory: {AIHUB_LORAS_DIR}")
-
-        # if the directory does not exist, return empty list
-        if path.exists(AIHUB_LORAS_DIR):
-            # otherwise, read the files
-            files = listdir(AIHUB_LORAS_DIR)
-            loras = []
-            for file in files:
-                if file.endswith(".json"):
-                    with open(path.join(AIHUB_LORAS_DIR, file), "r", encoding="utf-8") as f:
-                        try:
-                            lora_data = json.load(f)
-                            loras.append(lora_data)
-                        except json.JSONDecodeError:
-                            print(f"Error decoding JSON from lora file: {file}")
-
-            if AIHUB_COLD:
-                LORAS_CACHE_RAW = loras
-
-            return loras
-        return []
+        return LORAS_CATALOG.values()
 
     def retrieve_loras_cleaned(self, locale=None):
         """
@@ -375,18 +487,18 @@ class AIHubServer:
         """
 
         locale = locale if locale is not None else "default"
-        if (AIHUB_COLD and locale in LORAS_CACHE_CLEANED):
-            return LORAS_CACHE_CLEANED[locale]
+        if AIHUB_COLD:
+            cached = LORAS_CACHE_CLEANED.get(locale)
+            if cached is not None and cached[0] == LORAS_CATALOG.version:
+                return cached[1]
         
         raw_loras = self.retrieve_loras_raw()
+        raw_version = LORAS_CATALOG.version
         cleaned_loras = []
 
         for lora in raw_loras:
             id = lora.get("id", "None")
-            locale = locale.lower().replace("-", "_")
-            potential_locale_file = path.join(AIHUB_LORAS_LOCALE_DIR, locale, id + ".json")
-            if "_" in locale and not path.exists(potential_locale_file):
-                potential_locale_file = path.join(AIHUB_LORAS_LOCALE_DIR, locale.split("_")[0], id + ".json")
+            potential_locale_file = resolve_locale_file(AIHUB_LORAS_LOCALE_DIR, locale, id)
             locale_data = lora
             if path.exists(potential_locale_file):
                 with open(potential_locale_file, "r", encoding="utf-8") as f:
@@ -409,43 +521,17 @@ class AIHubServer:
             cleaned_loras.append(cleaned_lora)
 
         if AIHUB_COLD:
-            LORAS_CACHE_CLEANED[locale] = cleaned_loras
+            LORAS_CACHE_CLEANED[locale] = (raw_version, cleaned_loras)
 
         return cleaned_loras
     
     def retrieve_workflows_raw(self):
         """
-        Retrieves all workflow JSON files from the specified directory.
-        1. Reads all JSON files in the ComfyUI workflows directory.
-        2. Parses them into Python dictionaries.
-        3. Caches the results if AIHUB_COLD is enabled.
-        4. Returns a list of workflow dictionaries.
+        Retrieves all workflow JSON files from the workflows directory.
+        The workflows are kept parsed in the workflow catalog, only files
+        that changed since the last call are read again.
         """
-        if (AIHUB_COLD and WORKFLOWS_CACHE_RAW is not None):
-            return WORKFLOWS_CACHE_RAW
-        
-        # first let's read the files in the ComfyUI workflows directory
-        print(f"Loading workflows from directory: {AIHUB_WORKFLOWS_DIR}")
-
-        # if the directory does not exist, return empty list
-        if path.exists(AIHUB_WORKFLOWS_DIR):
-            # otherwise, read the files
-            files = listdir(AIHUB_WORKFLOWS_DIR)
-            workflows = []
-            for file in files:
-                if file.endswith(".json"):
-                    with open(path.join(AIHUB_WORKFLOWS_DIR, file), "r", encoding="utf-8") as f:
-                        try:
-                            workflow_data = json.load(f)
-                            workflows.append(workflow_data)
-                        except json.JSONDecodeError:
-                            print(f"Error decoding JSON from workflow file: {file}")
-
-            if AIHUB_COLD:
-                WORKFLOWS_CACHE_RAW = workflows
-
-            return workflows
-        return []
+        return WORKFLOW_CATALOG.values()
     
     def retrieve_valid_workflows(self):
         """
@@ -455,101 +541,7 @@ class AIHubServer:
         However they may not all be usable as they may be corrupted or missing
         required nodes.
         """
-
-        # in order to validate the workflows, we need to check if they contain a specific node
-        # that establishes them as valid for AIHub processing.
-        # the node type we are looking for is "AIHubWorkflowController"
-
-        if (AIHUB_COLD and WORKFLOWS_CACHE_VALID is not None):
-            return WORKFLOWS_CACHE_VALID
-        
-        raw_workflows = self.retrieve_workflows_raw()
-        valid_workflows = []
-
-        for workflow in raw_workflows:
-            if workflow is None or not isinstance(workflow, dict):
-                continue
-            for key, node in workflow.items():
-                if node.get("class_type", None) == "AIHubWorkflowController":
-                    valid_workflows.append(workflow)
-                    break
-
-        if AIHUB_COLD:
-            WORKFLOWS_CACHE_VALID = valid_workflows
-
-        return valid_workflows
-    
-    def retrieve_valid_workflow_aihub_summary_from(self, workflow, locale=None):
-        """
-        Retrieves the aihub summary for a specific workflow.
-        This is used to provide the client with the basic information
-        about the workflow without sending the whole workflow data.
-        """
-        # we build the basic data structure for the workflow summary
-        workflow_summary = {"expose":{}, "conditions": []}
-
-        workflow_locale_patch = None
-        if locale is not None and locale != "default":
-            id = None
-            for key, node in workflow.items():
-                # check if it is a AIHubWorkflowController or AIHubExpose node
-                # those are the only nodes we care about for the summary
-                if node.get("class_type") == "AIHubWorkflowController":
-                    id = node.get("inputs", {}).get("id", None)
-                    break
-
-            locale = locale.lower().replace("-", "_")
-            potential_locale_file = path.join(AIHUB_WORKFLOWS_LOCALE_DIR, locale, id + ".json")
-            if "_" in locale and not path.exists(potential_locale_file):
-                potential_locale_file = path.join(AIHUB_WORKFLOWS_LOCALE_DIR, locale.split("_")[0], id + ".json")
-            if path.exists(potential_locale_file):
-                with open(potential_locale_file, "r", encoding="utf-8") as f:
-                    try:
-                        workflow_locale_patch = json.load(f)
-                    except json.JSONDecodeError:
-                        print(f"Error decoding JSON from workflow locale file: {potential_locale_file}")
-
-        # we will iterate through the nodes to find the AIHubWorkflowController node
-        # and the AIHubExpose nodes, and extract their parameters
-        for nodeId, node in workflow.items():
-
-            # check if it is a AIHubWorkflowController or AIHubExpose node
-            # those are the only nodes we care about for the summary
-            if node.get("class_type") == "AIHubWorkflowController" or node.get("class_type", "").startswith("AIHubExpose") or node.get("class_type") == "AIHubAddRunCondition":
-                # the basic data structure for the node summary
-                data = node.get("inputs", {})
-                data_patch = {}
-                if workflow_locale_patch is not None:
-                    # make a shallow copy of data which is a dictionary
-                    data = data.copy()
-                    # apply the locale patch to the data
-                    data_patch = workflow_locale_patch.get(nodeId, {})
-                    for key, value in data_patch.items():
-                        if key in ["description", "name", "tooltip", "label", "options_label", "category", "metadata_fields_label", "error"]:
-                            data[key] = value
-
-                # if it is a controller node, we copy all the data to the workflow summary
-                if node.get("class_type") == "AIHubWorkflowController":
-                    # put every property of data into workflow_summary
-                    for key in data:
-                        workflow_summary[key] = data[key]
-
-                elif node.get("class_type") == "AIHubAddRunCondition":
-                    # add a new condition in the conditions list
-                    workflow_summary["conditions"].append(data)
-
-                # if it is an AIHubExpose node, we add it to the expose list
-                else:
-                    # add a new expose in the expose list
-                    id = data.get("id", None)
-
-                    # store the expose data
-                    workflow_summary["expose"][id] = {
-                        "type": node.get("class_type"),
-                        "data": data,
-                    }
-
-        return workflow_summary
+        return WORKFLOW_CATALOG.valid_workflows()
     
     def retrieve_valid_workflows_aihub_summary(self, locale=None):
         """
@@ -562,62 +554,50 @@ class AIHubServer:
         # it contains the basic information for the client to use the workflow
         # without sending the entire workflow data, basically the workflow summary will
         # contain only the nodes that start with AIHubExpose and the value of the parameters
-        # as key value pairs
-
-        original_locale = locale
-        locale = locale if locale is not None else "default"
-        if (AIHUB_COLD and locale in WORKFLOWS_AIHUB_SUMMARY):
-            return WORKFLOWS_AIHUB_SUMMARY[locale]
-        
-        valid_workflows = self.retrieve_valid_workflows()
-        aihub_summaries = {}
-
-        for workflow in valid_workflows:
-            # we build the basic data structure for the workflow summary
-            workflow_summary = self.retrieve_valid_workflow_aihub_summary_from(workflow, locale=original_locale)
-
-            # get the workflow id
-            workflow_id = workflow_summary.get("id")
-
-            # check for duplicate workflow ids
-            if aihub_summaries.get(workflow_id) is not None:
-                print("Warning: duplicate workflow id found, overwriting previous workflow with id " + workflow_id)
-
-            # store the workflow summary
-            aihub_summaries[workflow_id] = workflow_summary
-
-        if AIHUB_COLD:
-            WORKFLOWS_AIHUB_SUMMARY[locale] = aihub_summaries
-                    
-        return aihub_summaries
+        # as key value pairs, these are precomputed by the catalog
+        return WORKFLOW_CATALOG.get_summaries(locale=locale)
     
     def retrieve_workflow_by_id(self, workflow_id):
         """
         For a given workflow id, retrieves the full workflow data.
         This is used when a client requests to run a specific workflow
         """
-
-        valid_workflows = None
-        if AIHUB_COLD and WORKFLOWS_CACHE_VALID is not None:
-            valid_workflows = WORKFLOWS_CACHE_VALID
-        else:
-            valid_workflows = self.retrieve_valid_workflows()
-
-        #retrieve a specific workflow by the controller id
-        for workflow in valid_workflows:
-             for key, node in workflow.items():
-                if node.get("class_type", None) == "AIHubWorkflowController":
-                    if node.get("inputs", {}).get("id", None) == workflow_id:
-                        return workflow
-
-        return None
+        return WORKFLOW_CATALOG.get_workflow(workflow_id)
     
-    def validate_and_process_workflow_request(self, socket_file_dir, request):
+    def get_content_path(self, full_path, pins):
+        """
+        Provides the content path of a file of a session if it is a blob, pinning it, or the file itself
+        """
+        if not BLOB_STORE.enabled():
+            return full_path
+        try:
+            pinned = BLOB_STORE.pin_content_path(full_path)
+        except Exception as e:
+            print(f"Error finding the content path of {full_path}: {e}")
+            return full_path
+        if pinned is None:
+            return full_path
+        file_hash, content_path = pinned
+        pins.append(file_hash)
+        return content_path
+
+    def release_run_files(self, run):
+        """
+        Unpins the blobs a run used, it does nothing if they were released already
+        """
+        for file_hash in run.pop("blob_pins", []):
+            BLOB_STORE.unpin(file_hash)
+
+    def validate_and_process_workflow_request(self, socket_file_dir, request, pins):
         """
         Validates and processes a workflow request from a client.
         This requires the socket_file_dir to handle file uploads.
         The request must contain a valid workflow_id and expose parameters.
         The function returns a tuple of (processed_workflow, is_valid, message).
+
+        The files that come from the blob store are given by their content path instead, so the
+        inputs are the same for every session and comfyui reuses the outputs of the nodes that
+        use them; their hashes are added to pins, they must be unpinned once the run is over
         """
 
         # a valid request must contain a workflow_id that matches a valid workflow
@@ -628,24 +608,30 @@ class AIHubServer:
         if "expose" not in request:
             return None, False, "Missing expose parameters"
         
-        # get the workflow by id
-        workflow = self.retrieve_workflow_by_id(request["workflow_id"])
-        if workflow is None:
+        # get the workflow by id, alongside its binding plan that was compiled when it was loaded
+        entry = WORKFLOW_CATALOG.get_entry(request["workflow_id"])
+        if entry is None:
             return None, False, "Invalid workflow_id"
         
-        # make a deep copy of the workflow to modify
-        workflow_copy = deepcopy(workflow)
-        
-        # get the workflow summary to validate the expose parameters
-        workflow_summary = self.retrieve_valid_workflow_aihub_summary_from(workflow)
-        if workflow_summary is None:
+        workflow = entry["data"]
+        plan = entry["plan"]
+        if plan is None:
             return None, False, "Workflow summary not found, corrupted workflow?"
         
+        # the workflow in the catalog must not be modified, comfyui may write into the node
+        # objects themselves so those are copied, but the inputs are only cloned for the nodes
+        # that receive values from the request, the rest are shared with the catalog
+        workflow_copy = {key: dict(node) for key, node in workflow.items()}
+        cloned_inputs = set()
+
+        def get_inputs_to_patch(key):
+            if key not in cloned_inputs:
+                workflow_copy[key]["inputs"] = dict(workflow_copy[key].get("inputs", {}))
+                cloned_inputs.add(key)
+            return workflow_copy[key]["inputs"]
+        
         # validate that all expose parameters are present
-        for expose in workflow_summary["expose"].values():
-            # get the id of the expose
-            expose_id = expose["data"].get("id", None)
-
+        for expose_id in plan["exposes"]:
             # id is required
             if expose_id is None:
                 return None, False, "Corrupted workflow, expose node missing id"
@@ -654,82 +640,72 @@ class AIHubServer:
             if expose_id not in request["expose"]:
                 return None, False, f"Missing parameter for expose id {expose_id}"
             
-            for key, node in workflow_copy.items():
-                class_type = node.get("class_type", "")
-                if class_type.startswith("AIHubExpose") and node.get("inputs", {}).get("id", None) == expose_id:
-                    if isinstance(request["expose"][expose_id], dict) and "local_file" in request["expose"][expose_id]:
-                        # local_file is a special case, it must represent a local file path within a subdirectory that is
-                        # specific for the given websocket session, so we must check that it is alphanumeric and does not contain any path traversal characters
-                        local_file_path = request["expose"][expose_id]["local_file"]
-
-                        if local_file_path is None:
-                            # allow it
-                            workflow_copy[key]["inputs"]["local_file"] = None
-                            continue
+            expose_value = request["expose"][expose_id]
+            properties_to_set = None
+
+            if isinstance(expose_value, dict) and "local_file" in expose_value:
+                # local_file is a special case, it must represent a local file path within a subdirectory that is
+                # specific for the given websocket session, so we must check that it is alphanumeric and does not contain any path traversal characters
+                local_file_path = expose_value["local_file"]
+
+                if local_file_path is None:
+                    # allow it
+                    properties_to_set = {"local_file": None}
+                else:
+                    local_file_path_unmodified = local_file_path
+                    #check that it is a string and that fits the 0-9 A-Z a-z _-.
+                    if not isinstance(local_file_path, str) or not re.match(r'^[0-9A-Za-z_\-\.]+$', local_file_path):
+                        return None, False, f"Invalid local_file path for expose id {expose_id}, must be alphanumeric dots and dashes only not {local_file_path_unmodified}"
+                
+                    # if all checks pass, we need to convert the local_file_path to a full path
+                    value_to_set = path.join(socket_file_dir, local_file_path)
+
+                    # check that the file exists
+                    if not path.exists(value_to_set) or not path.isfile(value_to_set):
+                        return None, False, f"File not found for expose id {expose_id} at file {local_file_path_unmodified}"
+                    value_to_set = self.get_content_path(value_to_set, pins)
+
+                    properties_to_set = {prop_key: prop_value for prop_key, prop_value in expose_value.items() if prop_key != "local_file"}
+                    properties_to_set["local_file"] = value_to_set
+
+            elif isinstance(expose_value, dict) and "local_files" in expose_value:
+                # local_file is a special case, it must represent a local file path within a subdirectory that is
+                # specific for the given websocket session, so we must check that it is alphanumeric and does not contain any path traversal characters
+                local_file_paths = expose_value["local_files"]
 
-                        local_file_path_unmodified = local_file_path
-                        #check that it is a string and that fits the 0-9 A-Z a-z _-.
-                        if not isinstance(local_file_path, str) or not re.match(r'^[0-9A-Za-z_\-\.]+$', local_file_path):
-                            return None, False, f"Invalid local_file path for expose id {expose_id}, must be alphanumeric dots and dashes only not {local_file_path_unmodified}"
+                if not isinstance(local_file_paths, list):
+                    return None, False, f"Invalid local_files value for expose id {expose_id}, must be a list of file names"
+                
+                validated_file_paths = []
+                for local_file_path in local_file_paths:
+                    local_file_path_unmodified = local_file_path
+                    if not isinstance(local_file_path, str) or not re.match(r'^[0-9A-Za-z_\-\.]+$', local_file_path):
+                        return None, False, f"Invalid local_file path for expose id {expose_id}, must be alphanumeric dots and dashes only not {local_file_path_unmodified}"
+                    # if all checks pass, we need to convert the local_file_path to a full path
+                    full_path = path.join(socket_file_dir, local_file_path)
+
+                    # check that the file exists
+                    if not path.exists(full_path) or not path.isfile(full_path):
+                        return None, False, f"File not found for expose id {expose_id} at file {local_file_path_unmodified}"
                     
-                        # if all checks pass, we need to convert the local_file_path to a full path
-                        value_to_set = path.join(socket_file_dir, local_file_path)
-
-                        # check that the file exists
-                        if not path.exists(value_to_set) or not path.isfile(value_to_set):
-                            return None, False, f"File not found for expose id {expose_id} at file {local_file_path_unmodified}"
-
-                        workflow_copy[key]["inputs"]["local_file"] = value_to_set
-
-                        for prop_key, prop_value in request["expose"][expose_id].items():
-                            if prop_key != "local_file":
-                                workflow_copy[key]["inputs"][prop_key] = prop_value
-                    elif isinstance(request["expose"][expose_id], dict) and "local_files" in request["expose"][expose_id]:
-                        if not isinstance(request["expose"][expose_id], dict) or "local_files" not in request["expose"][expose_id]:
-                            return None, False, f"Invalid parameter for expose id {expose_id}, must be an object with a local_files property"
-                        
-                        # local_file is a special case, it must represent a local file path within a subdirectory that is
-                        # specific for the given websocket session, so we must check that it is alphanumeric and does not contain any path traversal characters
-                        local_file_paths = request["expose"][expose_id]["local_files"]
-
-                        if not isinstance(local_file_paths, list):
-                            return None, False, f"Invalid local_files value for expose id {expose_id}, must be a list of file names"
-                        
-                        validated_file_paths = []
-                        for local_file_path in local_file_paths:
-                            local_file_path_unmodified = local_file_path
-                            if not isinstance(local_file_path, str) or not re.match(r'^[0-9A-Za-z_\-\.]+$', local_file_path):
-                                return None, False, f"Invalid local_file path for expose id {expose_id}, must be alphanumeric dots and dashes only not {local_file_path_unmodified}"
-                            # if all checks pass, we need to convert the local_file_path to a full path
-                            full_path = path.join(socket_file_dir, local_file_path)
-
-                            # check that the file exists
-                            if not path.exists(full_path) or not path.isfile(full_path):
-                                return None, False, f"File not found for expose id {expose_id} at file {local_file_path_unmodified}"
-                            
-                            validated_file_paths.append(full_path)
-
-                        value_to_set = json.dumps(validated_file_paths)
-
-                        workflow_copy[key]["inputs"]["local_files"] = value_to_set
-
-                        for prop_key, prop_value in request["expose"][expose_id].items():
-                            if prop_key != "local_files":
-                                workflow_copy[key]["inputs"][prop_key] = prop_value
-                    elif isinstance(request["expose"][expose_id], dict):
-                        # for other types of expose nodes, we just copy every property that is exposed
-                        # into the inputs of the node
-                        for prop_key, prop_value in request["expose"][expose_id].items():
-                            workflow_copy[key]["inputs"][prop_key] = prop_value
-
-                        # security is not necessarily a concern here because the class will
-                        # only use the properties it expects
-                    elif "value" in workflow_copy[key]["inputs"]:
-                        workflow_copy[key]["inputs"]["value"] = request["expose"][expose_id]
-                    else:
-                        # set the value property by default even if it does not exist
-                        # may be hidden field
-                        workflow_copy[key]["inputs"]["value"] = request["expose"][expose_id]
+                    validated_file_paths.append(self.get_content_path(full_path, pins))
+
+                properties_to_set = {prop_key: prop_value for prop_key, prop_value in expose_value.items() if prop_key != "local_files"}
+                properties_to_set["local_files"] = json.dumps(validated_file_paths)
+
+            elif isinstance(expose_value, dict):
+                # for other types of expose nodes, we just copy every property that is exposed
+                # into the inputs of the node
+                # security is not necessarily a concern here because the class will
+                # only use the properties it expects
+                properties_to_set = expose_value
+            else:
+                # set the value property by default even if it does not exist
+                # may be hidden field
+                properties_to_set = {"value": expose_value}
+
+            for key in plan["bindings"].get(expose_id, []):
+                get_inputs_to_patch(key).update(properties_to_set)
 
         return workflow_copy, True, "Workflow validated and prepared"
     
@@ -741,13 +717,21 @@ class AIHubServer:
         ws = web.WebSocketResponse(max_msg_size=AIHUB_MAX_MESSAGE_SIZE)
         await ws.prepare(request)
 
+        # everything sent to this client goes through its outbound queue
+        connection = ClientConnection(ws, self.loop, AIHUB_MAX_QUEUED_BYTES_PER_CLIENT, AIHUB_SEND_TIMEOUT if AIHUB_SEND_TIMEOUT > 0 else None)
+        connection.start()
+        self.CONNECTIONS[ws] = connection
+
         # make a directory for this websocket connection to store files, use the Temp directory for the operating system
-        socket_file_dir = path.join(AIHUB_TEMP_DIRECTORY, "comfyui_socket_aihub_files", str(uuid.uuid4()))
-        if not path.exists(socket_file_dir):
-            makedirs(socket_file_dir)
+        socket_file_dir = JANITOR.new_session_dir()
+        await make_dirs(socket_file_dir)
 
         print(f"New WebSocket connection")
         PREVIOUS_UPLOAD_HEADER = None
+        # the upload that is receiving chunks, if the header had a total_size
+        CURRENT_UPLOAD = None
+        # the hash whose partial file in the blob store the current upload is using
+        CURRENT_UPLOAD_CLAIM = None
 
         locale = request.headers.get("locale", None)
 
@@ -756,14 +740,8 @@ class AIHubServer:
             # TODO validation
             # validate_websocket_user()
 
-            await ws.send_json({
-                'type': 'INFO_LIST',
-                'workflows': self.retrieve_valid_workflows_aihub_summary(locale=locale),
-                'models': self.retrieve_checkpoints_cleaned(locale=locale),
-                'loras': self.retrieve_loras_cleaned(locale=locale),
-                'samplers': comfy.samplers.KSampler.SAMPLERS,
-                'schedulers': comfy.samplers.KSampler.SCHEDULERS
-            })
+            # the catalogs may read the aihub directory, that happens in the io threads
+            await connection.send_json(await run_io(self.retrieve_info_list, locale))
 
             # Asynchronously wait for and process messages from the client
             async for msg in ws:
@@ -773,126 +751,208 @@ class AIHubServer:
                         data = json.loads(msg.data)
 
                         if not isinstance(data, dict):
-                            await ws.send_json({'type': 'ERROR', 'message': 'Invalid JSON format, must be an object'})
+                            await connection.send_json({'type': 'ERROR', 'message': 'Invalid JSON format, must be an object'})
                             continue
                         elif 'type' not in data:
-                            await ws.send_json({'type': 'ERROR', 'message': 'Missing request type in JSON'})
+                            await connection.send_json({'type': 'ERROR', 'message': 'Missing request type in JSON'})
                             continue
 
                         elif 'ping' in data and data["type"] == "PING":
-                            await ws.send_json({'type': 'PONG', 'value': data["ping"]})
+                            await connection.send_json({'type': 'PONG', 'value': data["ping"]})
                             self.LAST_PING_QUEUE_VALUE = str(data["ping"])
 
                         elif data["type"] == "FILE_CHECK_EXISTS":
                             file_to_check = data["filename"] if "filename" in data else None
                             if file_to_check is None:
-                                await ws.send_json({'type': 'ERROR', 'message': 'Missing file name to check'})
+                                await connection.send_json({'type': 'ERROR', 'message': 'Missing file name to check'})
                                 continue
                             if not isinstance(file_to_check, str) or not re.match(r'^[0-9A-Za-z_\-\.]+$', file_to_check):
-                                await ws.send_json({'type': 'ERROR', 'message': 'Invalid file name to check, must be alphanumeric dots and dashes only'})
+                                await connection.send_json({'type': 'ERROR', 'message': 'Invalid file name to check, must be alphanumeric dots and dashes only'})
                                 continue
                             full_path = path.join(socket_file_dir, file_to_check)
-                            exists = path.exists(full_path) and path.isfile(full_path)
-                            await ws.send_json({'type': 'CHECK_EXISTS_STATUS', 'file': file_to_check, 'exists': exists})
+                            exists = await file_exists(full_path)
+                            # a file that another session uploaded is made available to this one
+                            file_hash = data.get("hash", None)
+                            if not exists and isinstance(file_hash, str) and HASH_PATTERN.match(file_hash) and BLOB_STORE.enabled():
+                                exists = await run_io(BLOB_STORE.link_into, file_hash, full_path)
+                            await connection.send_json({'type': 'CHECK_EXISTS_STATUS', 'file': file_to_check, 'exists': exists})
                             continue
 
                         elif data["type"] == "FILE_UPLOAD":
                             if "filename" not in data or not data["filename"].isalnum():
-                                await ws.send_json({'type': 'ERROR', 'message': 'Invalid binary header'})
+                                await connection.send_json({'type': 'ERROR', 'message': 'Invalid binary header'})
                                 continue
                             if not re.match(r'^[0-9A-Za-z_\-\.]+$', data["filename"]):
-                                await ws.send_json({'type': 'ERROR', 'message': 'Invalid filename in binary header, must be alphanumeric dots and dashes only'})
+                                await connection.send_json({'type': 'ERROR', 'message': 'Invalid filename in binary header, must be alphanumeric dots and dashes only'})
+                                continue
+                            file_hash = data.get("hash", None)
+                            if file_hash is not None and (not isinstance(file_hash, str) or not HASH_PATTERN.match(file_hash)):
+                                await connection.send_json({'type': 'ERROR', 'message': 'Invalid hash in binary header, must be a lowercase hex sha256'})
                                 continue
+                            # a new header leaves the previous upload unfinished, it can be resumed later
+                            if CURRENT_UPLOAD is not None:
+                                await self.end_upload(CURRENT_UPLOAD, CURRENT_UPLOAD_CLAIM)
+                                CURRENT_UPLOAD = None
+                                CURRENT_UPLOAD_CLAIM = None
                             # now we got to check a if-not-exist flag
                             if "if_not_exists" in data and data["if_not_exists"] == True:
                                 full_path = path.join(socket_file_dir, data["filename"])
-                                if path.exists(full_path) and path.isfile(full_path):
-                                    await ws.send_json({'type': 'FILE_UPLOAD_SKIP', 'file': data["filename"]})
+                                if await file_exists(full_path):
+                                    await connection.send_json({'type': 'FILE_UPLOAD_SKIP', 'file': data["filename"]})
+                                    PREVIOUS_UPLOAD_HEADER = None
+                                    continue
+                            # the server may have the file already from this or another session
+                            if file_hash is not None and BLOB_STORE.enabled():
+                                full_path = path.join(socket_file_dir, data["filename"])
+                                if await run_io(BLOB_STORE.link_into, file_hash, full_path):
+                                    await connection.send_json({'type': 'FILE_UPLOAD_SKIP', 'file': data["filename"], 'hash': file_hash, 'cached': True})
                                     PREVIOUS_UPLOAD_HEADER = None
                                     continue
+                            # with a total size the file comes in chunks, each one a binary message
+                            # that starts with its offset in the file
+                            total_size = data.get("total_size", None)
+                            if total_size is not None:
+                                PREVIOUS_UPLOAD_HEADER = None
+                                if isinstance(total_size, bool) or not isinstance(total_size, int) or total_size < 0:
+                                    await connection.send_json({'type': 'ERROR', 'message': 'Invalid total_size in binary header, must be a positive integer'})
+                                    continue
+                                upload_id = data.get("upload_id", None)
+                                if upload_id is not None and (not isinstance(upload_id, str) or not re.match(r'^[0-9A-Za-z_\-]{1,64}$', upload_id)):
+                                    await connection.send_json({'type': 'ERROR', 'message': 'Invalid upload_id in binary header, must be up to 64 alphanumeric characters and dashes'})
+                                    continue
+                                quota_error = JANITOR.check_quota(socket_file_dir, total_size)
+                                if quota_error is not None:
+                                    await connection.send_json({'type': 'ERROR', 'message': quota_error, 'file': data["filename"]})
+                                    continue
+                                # an upload is only resumed from a partial file of the same file, that is with the
+                                # same hash, or the same name, total size and upload id; with a hash the partial
+                                # file is kept in the blob store so the upload can be resumed after a reconnection
+                                full_path = path.join(socket_file_dir, data["filename"])
+                                resume = data.get("resume", True) is not False
+                                claim = None
+                                partial_path = get_partial_path(full_path, total_size, upload_id)
+                                resumable = resume and upload_id is not None
+                                if file_hash is not None and BLOB_STORE.enabled():
+                                    blob_partial_path = await run_io(BLOB_STORE.claim_partial, file_hash)
+                                    if blob_partial_path is not None:
+                                        claim = file_hash
+                                        partial_path = blob_partial_path
+                                        resumable = resume
+                                upload = ChunkedUpload(full_path, total_size, partial_path, file_hash, resumable)
+                                try:
+                                    resume_offset = await run_io(upload.open)
+                                except UploadHashError as e:
+                                    await connection.send_json({'type': 'ERROR', 'message': 'The uploaded file does not match its hash', 'file': data["filename"]})
+                                    await self.end_upload(upload, claim)
+                                    continue
+                                except Exception as e:
+                                    await connection.send_json({'type': 'ERROR', 'message': 'Error saving file'})
+                                    print(f"Error starting upload of file {data['filename']}: {e}")
+                                    await self.end_upload(upload, claim)
+                                    continue
+                                if upload.complete:
+                                    # everything was already received before
+                                    if claim is not None:
+                                        await run_io(BLOB_STORE.release_partial, claim)
+                                    await self.finish_upload(connection, data["filename"], full_path, file_hash, verified=True)
+                                    continue
+                                PREVIOUS_UPLOAD_HEADER = data
+                                CURRENT_UPLOAD = upload
+                                CURRENT_UPLOAD_CLAIM = claim
+                                await connection.send_json({
+                                    'type': 'UPLOAD_ACK',
+                                    'file': data["filename"],
+                                    'chunked': True,
+                                    'resume_offset': resume_offset,
+                                    'max_chunk_size': AIHUB_MAX_MESSAGE_SIZE - UPLOAD_CHUNK_OFFSET.size,
+                                })
+                                continue
                             PREVIOUS_UPLOAD_HEADER = data
-                            await ws.send_json({'type': 'UPLOAD_ACK', 'file': data["filename"]})
+                            await connection.send_json({'type': 'UPLOAD_ACK', 'file': data["filename"]})
                             continue
 
                         elif 'cancel' in data and data["type"] == "WORKFLOW_OPERATION":
-                            cancelled_current = False
+                            cancelled_submitted = False
                             what_to_cancel = data['cancel']
                             if type(what_to_cancel) is str:
-                                if (self.CURRENTLY_RUNNING is not None and self.CURRENTLY_RUNNING["ws"] == ws and self.CURRENTLY_RUNNING["id"] == what_to_cancel):
-                                    await self.CURRENTLY_RUNNING["ws"].send_json({
+                                submitted_run = self.RUNS.get(what_to_cancel)
+                                if (submitted_run is not None and submitted_run["ws"] is ws and self.cancel_submitted_run(submitted_run)):
+                                    await connection.send_json({
                                         'type': 'WORKFLOW_FINISHED',
-                                        'id': self.CURRENTLY_RUNNING["id"],
-                                        'workflow_id': self.CURRENTLY_RUNNING["workflow_id"],
+                                        'id': submitted_run["id"],
+                                        'workflow_id': submitted_run["workflow_id"],
                                         'error': True,
                                         "error_message": "Workflow run cancelled by user",
                                         "cancelled": True
                                     })
-                                    self.cancel_current_run()
-                                    cancelled_current = True
+                                    cancelled_submitted = True
                                 else:
-                                    with self.QUEUE_LOCK:
-                                        for i in range(0, len(self.WORKFLOW_REQUEST_QUEUE)):
-                                            if self.WORKFLOW_REQUEST_QUEUE[i]["id"] == what_to_cancel and self.WORKFLOW_REQUEST_QUEUE[i]["ws"] == ws:
-                                                await self.WORKFLOW_REQUEST_QUEUE[i]["ws"].send_json({
-                                                    'type': 'WORKFLOW_FINISHED',
-                                                    'id': self.WORKFLOW_REQUEST_QUEUE[i]["id"],
-                                                    'workflow_id': self.WORKFLOW_REQUEST_QUEUE[i]["workflow_id"],
-                                                    'error': True,
-                                                    "error_message": "Workflow run cancelled by user",
-                                                    "cancelled": True
-                                                })
-                                                del self.WORKFLOW_REQUEST_QUEUE[i]
-                                                break
-                                
-                                        for i in range(0, len(self.WORKFLOW_REQUEST_QUEUE)):
-                                            await self.WORKFLOW_REQUEST_QUEUE[i]["ws"].send_json({
-                                                'type': 'WORKFLOW_AWAIT',
-                                                'id': self.WORKFLOW_REQUEST_QUEUE[i]["id"],
-                                                'workflow_id': self.WORKFLOW_REQUEST_QUEUE[i]["workflow_id"],
-                                                'before_this': i
-                                            })
-
-                            if cancelled_current:
+                                    cancelled_run = self.SCHEDULER.cancel(what_to_cancel, ws)
+                                    if cancelled_run is not None:
+                                        self.release_run_files(cancelled_run)
+                                        await connection.send_json({
+                                            'type': 'WORKFLOW_FINISHED',
+                                            'id': cancelled_run["id"],
+                                            'workflow_id': cancelled_run["workflow_id"],
+                                            'error': True,
+                                            "error_message": "Workflow run cancelled by user",
+                                            "cancelled": True
+                                        })
+                                        await self.notify_queue_positions()
+
+                            if cancelled_submitted:
                                 asyncio.create_task(self.process_next_workflow_in_queue())
 
                         elif 'workflow_id' not in data and data["type"] == "WORKFLOW_OPERATION":
-                            await ws.send_json({'type': 'ERROR', 'message': 'Missing workflow_id to execute'})
+                            await connection.send_json({'type': 'ERROR', 'message': 'Missing workflow_id to execute'})
 
                         elif 'workflow_id' in data and data["type"] == "WORKFLOW_OPERATION":
+                            priority = parse_priority(data.get("priority", None))
+                            if priority is None:
+                                await connection.send_json({'type': 'ERROR', 'message': 'Invalid priority, must be an integer', 'workflow_id': data.get('workflow_id', None)})
+                                continue
+
                             # validate before queueing
-                            validated_workflow, valid, message = self.validate_and_process_workflow_request(socket_file_dir, data)
+                            # this checks that the files of the request exist
+                            pins = []
+                            try:
+                                validated_workflow, valid, message = await run_io(self.validate_and_process_workflow_request, socket_file_dir, data, pins)
+                            except Exception:
+                                self.release_run_files({"blob_pins": pins})
+                                raise
                             if not valid:
-                                await ws.send_json({'type': 'ERROR', 'message': message, 'workflow_id': data.get('workflow_id', None)})
+                                self.release_run_files({"blob_pins": pins})
+                                await connection.send_json({'type': 'ERROR', 'message': message, 'workflow_id': data.get('workflow_id', None)})
                                 continue
-                            # Place the prompt in the queue for the ComfyUI node to pick up.
-                            # We use a lock to ensure this is a thread-safe operation.
+                            # Place the prompt in the scheduler for the ComfyUI node to pick up.
                             run_id = str(uuid.uuid4())
-                            with self.QUEUE_LOCK:
-                                self.WORKFLOW_REQUEST_QUEUE.append({
-                                    'id': run_id,
-                                    'request': data,
-                                    'ws': ws,
-                                    'workflow': validated_workflow,
-                                    'workflow_id': data['workflow_id'],
-                                    'file_dir': socket_file_dir,
-                                })
-
-                            # Send a confirmation back to the external client
-                            await ws.send_json({
-                                'type': 'WORKFLOW_AWAIT',
+                            self.SCHEDULER.push({
                                 'id': run_id,
-                                'workflow_id': data["workflow_id"],
-                                'before_this': len(self.WORKFLOW_REQUEST_QUEUE) - 1
-                            })
-
-                            if self.CURRENTLY_RUNNING is None:
+                                'request': data,
+                                'ws': ws,
+                                'connection': connection,
+                                'workflow': validated_workflow,
+                                'workflow_id': data['workflow_id'],
+                                'file_dir': socket_file_dir,
+                                'priority': priority,
+                                'position': None,
+                                'awaiting_tasks_amount': 0,
+                                'awaiting_tasks_done_flag': asyncio.Event(),
+                                'blob_pins': pins,
+                            }, ws, priority)
+
+                            # Send a confirmation back to the external client, as well as the new
+                            # positions of the runs that got behind this one
+                            await self.notify_queue_positions()
+
+                            if len(self.RUNS) < AIHUB_PIPELINE_DEPTH:
                                 asyncio.create_task(self.process_next_workflow_in_queue())
 
                         else:
-                            await ws.send_json({'type': 'ERROR', 'message': 'Unknown request type'})
+                            await connection.send_json({'type': 'ERROR', 'message': 'Unknown request type'})
 
                     except json.JSONDecodeError:
-                        await ws.send_json({'type': 'ERROR', 'message': 'Invalid JSON'})
+                        await connection.send_json({'type': 'ERROR', 'message': 'Invalid JSON'})
                 
                 elif msg.type == web.WSMsgType.ERROR:
                     print(f'WebSocket connection closed with exception {ws.exception()}')
@@ -901,59 +961,133 @@ class AIHubServer:
                     print('WebSocket recieved a file')
                     # we now save the file to the socket_file_dir with the name specified in the previous header
                     if PREVIOUS_UPLOAD_HEADER is None:
-                        await ws.send_json({'type': 'ERROR', 'message': 'Missing upload header before file upload'})
+                        await connection.send_json({'type': 'ERROR', 'message': 'Missing upload header before file upload'})
                         continue
 
                     file_name = PREVIOUS_UPLOAD_HEADER.get("filename", None)
+
+                    if CURRENT_UPLOAD is not None:
+                        if len(msg.data) < UPLOAD_CHUNK_OFFSET.size:
+                            await connection.send_json({'type': 'ERROR', 'message': 'Missing offset in upload chunk'})
+                            continue
+                        offset = UPLOAD_CHUNK_OFFSET.unpack_from(msg.data)[0]
+                        chunk = memoryview(msg.data)[UPLOAD_CHUNK_OFFSET.size:]
+                        try:
+                            complete = await run_io(CURRENT_UPLOAD.write, offset, chunk)
+                            JANITOR.account(socket_file_dir, len(chunk))
+                        except UploadOffsetError as e:
+                            # a chunk got lost or was sent twice, the client continues from where the file is at
+                            await connection.send_json({'type': 'FILE_UPLOAD_RESUME', 'file': file_name, 'resume_offset': e.expected_offset})
+                            continue
+                        except UploadHashError:
+                            # what was received is discarded, the client must upload the file again
+                            await connection.send_json({'type': 'ERROR', 'message': 'The uploaded file does not match its hash', 'file': file_name})
+                            await self.end_upload(CURRENT_UPLOAD, CURRENT_UPLOAD_CLAIM)
+                            CURRENT_UPLOAD = None
+                            CURRENT_UPLOAD_CLAIM = None
+                            PREVIOUS_UPLOAD_HEADER = None
+                            continue
+                        except Exception as e:
+                            await connection.send_json({'type': 'ERROR', 'message': 'Error saving file'})
+                            print(f"Error saving chunk of file {file_name}: {e}")
+                            await self.end_upload(CURRENT_UPLOAD, CURRENT_UPLOAD_CLAIM, discard=True)
+                            CURRENT_UPLOAD = None
+                            CURRENT_UPLOAD_CLAIM = None
+                            PREVIOUS_UPLOAD_HEADER = None
+                            continue
+
+                        if complete:
+                            if CURRENT_UPLOAD_CLAIM is not None:
+                                await run_io(BLOB_STORE.release_partial, CURRENT_UPLOAD_CLAIM)
+                            await self.finish_upload(connection, file_name, CURRENT_UPLOAD.full_path, PREVIOUS_UPLOAD_HEADER.get("hash", None), verified=True)
+                            CURRENT_UPLOAD = None
+                            CURRENT_UPLOAD_CLAIM = None
+                            PREVIOUS_UPLOAD_HEADER = None
+                        else:
+                            await connection.send_json({'type': 'FILE_UPLOAD_CHUNK_ACK', 'file': file_name, 'received': CURRENT_UPLOAD.received})
+                        continue
+
                     full_path = path.join(socket_file_dir, file_name)
 
                     print('File to be saved at ' + full_path)
 
+                    quota_error = JANITOR.check_quota(socket_file_dir, len(msg.data))
+                    if quota_error is not None:
+                        await connection.send_json({'type': 'ERROR', 'message': quota_error, 'file': file_name})
+                        PREVIOUS_UPLOAD_HEADER = None
+                        continue
+
                     try:
-                        with open(full_path, "wb") as f:
-                            f.write(msg.data)
-                        await ws.send_json({'type': 'FILE_UPLOAD_SUCCESS', 'file': file_name})
+                        await run_io(write_file_atomic, full_path, msg.data)
+                        JANITOR.account(socket_file_dir, len(msg.data))
+                        await self.finish_upload(connection, file_name, full_path, PREVIOUS_UPLOAD_HEADER.get("hash", None))
                     except Exception as e:
-                        await ws.send_json({'type': 'ERROR', 'message': 'Error saving file'})
+                        await connection.send_json({'type': 'ERROR', 'message': 'Error saving file'})
                         print(f"Error saving file {file_name}: {e}")
 
                     PREVIOUS_UPLOAD_HEADER = None
                 else:
                     print('WebSocket received unknown message type')
-                    await ws.send_json({'type': 'ERROR', 'message': 'Unknown message type'})
+                    await connection.send_json({'type': 'ERROR', 'message': 'Unknown message type'})
                     
 
         finally:
             print(f"WebSocket connection closed by client")
 
-            with self.QUEUE_LOCK:
-                # We first find the keys of the prompts to remove.
-                for i in range(0, len(self.WORKFLOW_REQUEST_QUEUE)):
-                    if self.WORKFLOW_REQUEST_QUEUE[i]["ws"] == ws:
-                        del self.WORKFLOW_REQUEST_QUEUE[i]
-                
-                for i in range(0, len(self.WORKFLOW_REQUEST_QUEUE)):
-                    self.WORKFLOW_REQUEST_QUEUE[i]["ws"].send_json({
-                        'type': 'WORKFLOW_AWAIT',
-                        'id': self.WORKFLOW_REQUEST_QUEUE[i]["id"],
-                        'workflow_id': self.WORKFLOW_REQUEST_QUEUE[i]["workflow_id"],
-                        'before_this': i
-                    })
+            for run in self.SCHEDULER.remove_client(ws):
+                self.release_run_files(run)
+
+            cancelled_submitted = False
+            for run in self.RUNS.for_client(ws):
+                if self.cancel_submitted_run(run):
+                    cancelled_submitted = True
+
+            await self.notify_queue_positions()
+
+            if cancelled_submitted:
+                asyncio.create_task(self.process_next_workflow_in_queue())
 
-                if self.CURRENTLY_RUNNING and self.CURRENTLY_RUNNING["ws"] == ws:
-                    self.cancel_current_run()
-                    asyncio.create_task(self.process_next_workflow_in_queue())
+            if CURRENT_UPLOAD is not None:
+                await self.end_upload(CURRENT_UPLOAD, CURRENT_UPLOAD_CLAIM)
 
-            if not AIHUB_PERSIST_TEMPFILES:
-                # clean up the temporary directory for this websocket connection
-                try:
-                    if path.exists(socket_file_dir):
-                        rmtree(socket_file_dir)
-                except Exception as e:
-                    print(f"Error cleaning up socket file directory {socket_file_dir}: {e}")
+            # the janitor removes the temporary directory for this websocket connection in the background
+            JANITOR.end_session(socket_file_dir)
+
+            # drop whatever was still waiting to be sent and release the nodes waiting for the budget
+            connection.close()
+            self.CONNECTIONS.pop(ws, None)
 
         return ws
 
+    async def end_upload(self, upload, claimed_hash, discard=False):
+        """
+        Leaves a chunked upload unfinished, what was received is kept so it can be resumed
+        unless it is discarded
+        """
+        try:
+            await run_io(upload.discard if discard else upload.close)
+        finally:
+            if claimed_hash is not None:
+                await run_io(BLOB_STORE.release_partial, claimed_hash)
+
+    async def finish_upload(self, connection, file_name, full_path, file_hash, verified=False):
+        """
+        Answers a complete upload, a file that came with a hash is added to the blob store
+        once the hash is verified, unless it was verified already
+        """
+        if file_hash is not None and BLOB_STORE.enabled():
+            try:
+                matches = await run_io(BLOB_STORE.add, file_hash, full_path, verified)
+            except Exception as e:
+                # the file itself was saved, it just cannot be shared
+                print(f"Error adding file {file_name} to the blob store: {e}")
+                matches = True
+            if not matches:
+                await run_io(remove, full_path)
+                await connection.send_json({'type': 'ERROR', 'message': 'The uploaded file does not match its hash', 'file': file_name})
+                return
+        await connection.send_json({'type': 'FILE_UPLOAD_SUCCESS', 'file': file_name})
+
     async def run_websocket_server(self, app, host, port):
         """
         Starts the aiohttp web server.
@@ -964,6 +1098,7 @@ class AIHubServer:
         site = web.TCPSite(runner, host, port)
 
         await site.start()
+        JANITOR.start()
         SERVER_RUNNING_FLAG.set()
         print("WebSocket server is running and ready for connections.")
         # This will block until the runner is stopped
@@ -1010,55 +1145,78 @@ class AIHubServer:
             #threading.Thread(target=self.process_messages, daemon=True).start()
             #print("Process of messages thread started.")
 
+    async def notify_queue_positions(self):
+        """
+        Sends the position in the queue to every run that is waiting and whose
+        position changed since the last time it was told, the runs that were submitted
+        to comfyui and did not finish yet are ahead of all of them
+        """
+        submitted = len(self.RUNS)
+        for index, run in enumerate(self.SCHEDULER.ordered()):
+            position = submitted + index
+            if run["position"] == position:
+                continue
+            run["position"] = position
+            try:
+                await run["connection"].send_json({
+                    'type': 'WORKFLOW_AWAIT',
+                    'id': run["id"],
+                    'workflow_id': run["workflow_id"],
+                    'before_this': position
+                })
+            except Exception as e:
+                print(f"Error sending queue position, maybe user closed connection? {e}")
+
     async def process_next_workflow_in_queue(self):
+        """
+        Takes runs from the scheduler until the pipeline is full and submits them to comfyui
+        """
+        runs_to_submit = []
         with self.QUEUE_LOCK:
-            if len(self.WORKFLOW_REQUEST_QUEUE) > 0 and self.CURRENTLY_RUNNING is None:
-                self.CURRENTLY_RUNNING = self.WORKFLOW_REQUEST_QUEUE.pop()
-
-                for i in range(0, len(self.WORKFLOW_REQUEST_QUEUE)):
-                    await self.WORKFLOW_REQUEST_QUEUE[i]["ws"].send_json({
-                        'type': 'WORKFLOW_AWAIT',
-                        'id': self.WORKFLOW_REQUEST_QUEUE[i]["id"],
-                        'workflow_id': self.WORKFLOW_REQUEST_QUEUE[i].request["workflow_id"],
-                        'before_this': i
-                    })
-            
-                await self.process_current()
+            while len(self.RUNS) < AIHUB_PIPELINE_DEPTH:
+                run = self.SCHEDULER.pop()
+                if run is None:
+                    break
+                self.RUNS.add(run)
+                runs_to_submit.append(run)
 
-    def cancel_current_run(self):
-        interrupt_processing()
-        self.CURRENTLY_RUNNING = None
+        # a run that finished or was cancelled moves every waiting run forward, even when
+        # nothing could be submitted in its place
+        await self.notify_queue_positions()
+        for run in runs_to_submit:
+            await self.submit_run(run)
 
-    async def process_current(self):
-        self.awaiting_tasks_lock.acquire()
-        self.awaiting_tasks_amount = 0
-        self.awaiting_tasks_lock.release()
-        self.awaiting_tasks_done_flag = threading.Event()
+    def cancel_submitted_run(self, run):
+        """
+        Cancels a run that was already put in the comfyui prompt queue, it is interrupted
+        if it is executing or otherwise removed from the prompt queue
+        """
+        # once it is out of the registry whatever the run still outputs is dropped
+        if self.RUNS.remove(run["id"]) is None:
+            return False
+        run["cancelled"] = True
+        self.release_run_files(run)
+
+        if self.get_executing_prompt_id() == run["id"]:
+            interrupt_processing()
+        else:
+            PromptServer.instance.prompt_queue.delete_queue_item(lambda item: item[1] == run["id"])
+        return True
 
-        if not self.CURRENTLY_RUNNING:
-            return
-        
-        print("Processing current workflow...")
+    async def submit_run(self, run):
+        print("Submitting workflow run " + run["id"] + "...")
         # we will disable validation because it is not really useful (let it crash if the workflow is invalid, these should be curated workflows already)
         # and the original validate_prompt function is not good at validating because it makes errors where
         # there shouldn't be any so we use a custom function to fix this behaviour
 
-        #valid = await validate_prompt(self.CURRENTLY_RUNNING["id"], self.CURRENTLY_RUNNING["workflow"], None)
-        #print(valid)
-        
-        #if valid[0]:
-        await self.CURRENTLY_RUNNING["ws"].send_json({
-            'type': 'WORKFLOW_START',
-            'workflow_id': self.CURRENTLY_RUNNING["request"]["workflow_id"],
-            'id': self.CURRENTLY_RUNNING["id"],
-        })
-        #outputs_to_execute = valid[2]
+        # the client is told that the run started once comfyui starts executing it, see send_sync_override
+
         # we will however need to find all the output nodes to know which ones to execute
         # for that we will have to find for all actionable nodes (nodes that start with AIHubAction)
         # and get their ids, then we will pass those ids to the prompt queue to execute
 
         outputs_to_execute = []
-        for key, node in self.CURRENTLY_RUNNING["workflow"].items():
+        for key, node in run["workflow"].items():
             if node.get("class_type", "").startswith("AIHubAction"):
                 outputs_to_execute.append(key)
 
@@ -1067,38 +1225,63 @@ class AIHubServer:
         number = PromptServer.instance.number
         PromptServer.instance.number += 1
         sensitive = {}
-        extra_data = self.CURRENTLY_RUNNING["request"].get("extra_data", {})
+        extra_data = run["request"].get("extra_data", {})
+        # comfyui only reports the execution events of a prompt that has a client id, the id does not
+        # need to belong to a connected comfyui client, we only need the events to go through send_sync
+        if "client_id" not in extra_data:
+            extra_data["client_id"] = "aihub-" + run["id"]
         for sensitive_val in SENSITIVE_EXTRA_DATA_KEYS:
             if sensitive_val in extra_data:
                 sensitive[sensitive_val] = extra_data.pop(sensitive_val)
-        PromptServer.instance.prompt_queue.put((number, self.CURRENTLY_RUNNING["id"], self.CURRENTLY_RUNNING["workflow"], extra_data, outputs_to_execute, sensitive))
-        #else:
-        #    await self.CURRENTLY_RUNNING["ws"].send_json({
-        #        'type': 'ERROR',
-        #        'workflow_id': self.CURRENTLY_RUNNING["request"]["workflow_id"],
-        #        'id': self.CURRENTLY_RUNNING["id"],
-        #        'node_errors': valid[3],
-        #        'message': f'Error validating workflow: {json.dumps(valid[1])}',
-        #    })
-        #    self.CURRENTLY_RUNNING = None
+        PromptServer.instance.prompt_queue.put((number, run["id"], run["workflow"], extra_data, outputs_to_execute, sensitive))
 
-    async def send_binary_data(self, workflow_id, id, ws, binary_data, data_type, action_data):
+    def build_file_header(self, workflow_id, id, data_type, action_data):
         """
-        Sends binary data (e.g., images, files) to the client via websocket.
+        The header message that tells the client about the binary data that follows it
         """
-        # Send a header message to indicate incoming binary data
-        await ws.send_json({
+        return {
             "type": "FILE",
             'workflow_id': workflow_id,
             'id': id,
             "data_type": data_type,
             "action": action_data,
-        })
-        # Send the binary data itself
-        await ws.send_bytes(binary_data)
+        }
+
+    async def send_binary_data(self, workflow_id, id, ws, binary_data, data_type, action_data):
+        """
+        Sends binary data (e.g., images, files) to the client via websocket.
+        """
+        connection = self.CONNECTIONS.get(ws, None)
+        if connection is None:
+            return
+        # the header and the binary data itself go together so nothing gets in between
+        await connection.send(self.build_file_header(workflow_id, id, data_type, action_data), binary_data)
+
+    def get_executing_prompt_id(self):
+        """
+        Provides the prompt id of the node that is executing in the calling thread, or
+        the prompt that comfyui is executing when there is no node context available
+        """
+        if get_executing_context is not None:
+            context = get_executing_context()
+            if context is not None and context.prompt_id is not None:
+                return context.prompt_id
+        if self.EXECUTING_PROMPT_ID is not None:
+            return self.EXECUTING_PROMPT_ID
+        return getattr(PromptServer.instance, "last_prompt_id", None)
+
+    def get_current_run(self):
+        """
+        Provides the run the executing node belongs to, or None if it is not one
+        of ours or it was cancelled meanwhile
+        """
+        return self.RUNS.get(self.get_executing_prompt_id())
 
     async def send_binary_data_to_current_client(self, binary_data, data_type, action_data):
-        return await self.send_binary_data(self.CURRENTLY_RUNNING["workflow_id"], self.CURRENTLY_RUNNING["id"], self.CURRENTLY_RUNNING["ws"], binary_data, data_type, action_data)
+        run = self.get_current_run()
+        if run is None:
+            return
+        return await self.send_binary_data(run["workflow_id"], run["id"], run["ws"], binary_data, data_type, action_data)
     
     async def send_json(self, workflow_id, id, ws, data):
         data["workflow_id"] = workflow_id
@@ -1106,10 +1289,16 @@ class AIHubServer:
         """
         Sends JSON data to the client via websocket.
         """
-        await ws.send_json(data)
+        connection = self.CONNECTIONS.get(ws, None)
+        if connection is None:
+            return
+        await connection.send_json(data)
 
     async def send_json_to_current_client(self, data):
-        return await self.send_json(self.CURRENTLY_RUNNING["workflow_id"], self.CURRENTLY_RUNNING["id"], self.CURRENTLY_RUNNING["ws"], data)
+        run = self.get_current_run()
+        if run is None:
+            return
+        return await self.send_json(run["workflow_id"], run["id"], run["ws"], data)
     
     async def send_status_message_to_current_client(self, status_message, extra_data=None):
         data = {
@@ -1118,42 +1307,80 @@ class AIHubServer:
         }
         if extra_data:
             data.update(extra_data)
-        return await self.send_json(self.CURRENTLY_RUNNING["workflow_id"], self.CURRENTLY_RUNNING["id"], self.CURRENTLY_RUNNING["ws"], data)
+        run = self.get_current_run()
+        if run is None:
+            return
+        return await self.send_json(run["workflow_id"], run["id"], run["ws"], data)
     
-    def send_binary_data_to_current_client_sync(self, binary_data, data_type, action):
-        future = asyncio.run_coroutine_threadsafe(
-            self.send_binary_data_to_current_client(binary_data, data_type, action),
-            self.loop
-        )
-        self.awaiting_tasks_lock.acquire()
-        self.awaiting_tasks_amount += 1
-        self.awaiting_tasks_lock.release()
+    def track_pending_send(self, run, future):
+        """
+        Counts the sends of a run that did not finish yet, the run is not reported as finished until they do
+        but neither the execution thread nor the next run wait for them
+        """
+        with self.awaiting_tasks_lock:
+            run["awaiting_tasks_amount"] += 1
 
         def on_done(t):
-            self.awaiting_tasks_lock.acquire()
-            self.awaiting_tasks_amount -= 1
-            self.awaiting_tasks_lock.release()
-
-            if self.awaiting_tasks_amount == 0:
-                self.awaiting_tasks_done_flag.set()
+            with self.awaiting_tasks_lock:
+                run["awaiting_tasks_amount"] -= 1
+                if run["awaiting_tasks_amount"] == 0:
+                    # the flag belongs to the server loop, this may be called from another thread
+                    self.loop.call_soon_threadsafe(run["awaiting_tasks_done_flag"].set)
 
         future.add_done_callback(on_done)
 
-    def send_json_to_current_client_sync(self, data):
-        future = asyncio.run_coroutine_threadsafe(
-            self.send_json_to_current_client(data),
-            self.loop
+    def send_binary_data_to_current_client_sync(self, binary_data, data_type, action):
+        run = self.get_current_run()
+        if run is None:
+            # the run was cancelled while the node was executing or it is not an aihub run, nobody is waiting for this
+            return
+        self.send_binary_data_to_run_sync(run, binary_data, data_type, action)
+
+    def send_binary_data_to_run_sync(self, run, binary_data, data_type, action):
+        if run.get("cancelled", False):
+            return
+        # this waits if the client has too much waiting to be sent already
+        future = run["connection"].send_sync(
+            self.build_file_header(run["workflow_id"], run["id"], data_type, action),
+            binary_data,
         )
-        self.awaiting_tasks_lock.acquire()
-        self.awaiting_tasks_amount += 1
-        self.awaiting_tasks_lock.release()
+        self.track_pending_send(run, future)
 
-        def on_done(t):
-            self.awaiting_tasks_lock.acquire()
-            self.awaiting_tasks_amount -= 1
-            self.awaiting_tasks_lock.release()
+    def submit_for_current_client(self, executor, fn, *args):
+        """
+        Runs fn(send_binary_data, *args) in the executor so the execution does not wait for it,
+        send_binary_data(binary_data, data_type, action) sends to the client of the current run
+        and the run is not reported as finished until fn is done
+        """
+        run = self.get_current_run()
+        if run is None:
+            return None
+
+        def send_binary_data(binary_data, data_type, action):
+            self.send_binary_data_to_run_sync(run, binary_data, data_type, action)
+
+        def task():
+            try:
+                fn(send_binary_data, *args)
+            except Exception as e:
+                print(f"Error producing output for run {run['id']}: {e}")
+                if not run.get("cancelled", False):
+                    run["connection"].send_sync({
+                        'type': 'ERROR',
+                        'message': f"Error producing output: {e}",
+                        'workflow_id': run["workflow_id"],
+                        'id': run["id"],
+                    })
 
-            if self.awaiting_tasks_amount == 0:
-                self.awaiting_tasks_done_flag.set()
+        future = executor.submit(task)
+        self.track_pending_send(run, future)
+        return future
 
-        future.add_done_callback(on_done)
\ No newline at end of file
+    def send_json_to_current_client_sync(self, data):
+        run = self.get_current_run()
+        if run is None:
+            return
+        data["workflow_id"] = run["workflow_id"]
+        data["id"] = run["id"]
+        future = run["connection"].send_sync(data)
+        self.track_pending_send(run, future)
@@ -0,0 +1,15 @@
+import sys
+import types
+from os import path
+
+# the package __init__ registers the nodes, which needs comfyui, so the modules that do not
+# depend on it are imported as aihub.<module> through a package that skips it; pytest imports
+# the package of the directory too, by the name of the directory, so it gets the same one
+PACKAGE_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+if "aihub" not in sys.modules:
+    package = types.ModuleType("aihub")
+    package.__path__ = [PACKAGE_DIR]
+    package.__file__ = path.join(PACKAGE_DIR, "__init__.py")
+    sys.modules["aihub"] = package
+    sys.modules.setdefault(path.basename(PACKAGE_DIR), package)
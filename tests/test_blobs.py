@@ -0,0 +1,221 @@
+import hashlib
+import os
+import shutil
+import time
+
+from aihub import blobs
+from aihub.blobs import BlobStore, hash_file, link_or_copy
+
+def make_file(directory, name, data):
+    file_path = str(directory / name)
+    with open(file_path, "wb") as f:
+        f.write(data)
+    return file_path, hashlib.sha256(data).hexdigest()
+
+def write_partial(store, file_hash, data):
+    with open(store.get_partial_path(file_hash), "wb") as f:
+        f.write(data)
+
+def test_hash_file_and_link(tmp_path):
+    source, file_hash = make_file(tmp_path, "a", b"hello")
+    assert hash_file(source) == file_hash
+    link_or_copy(source, str(tmp_path / "b"))
+    link_or_copy(source, str(tmp_path / "b"))
+    assert open(tmp_path / "b", "rb").read() == b"hello"
+
+def test_directory_is_read_on_first_use(tmp_path):
+    store_dir = tmp_path / "blobs"
+    store = BlobStore(str(store_dir), 1000)
+    assert not store_dir.exists()
+    assert not store.loaded
+
+    source, file_hash = make_file(tmp_path, "a", b"a" * 10)
+    assert not store.link_into(file_hash, str(tmp_path / "missing"))
+    assert store.loaded
+    assert store.add(file_hash, source)
+
+    # a new store finds what the previous one left
+    store = BlobStore(str(store_dir), 1000)
+    destination = str(tmp_path / "linked")
+    assert store.link_into(file_hash, destination)
+    assert open(destination, "rb").read() == b"a" * 10
+
+def test_add_verifies_the_hash(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"), 1000)
+    source, _ = make_file(tmp_path, "a", b"a")
+    assert not store.add("0" * 64, source)
+    assert "0" * 64 not in store.blobs
+
+def test_least_recently_used_blobs_are_evicted(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"), 250)
+    hashes = []
+    for name in ("a", "b", "c"):
+        source, file_hash = make_file(tmp_path, name, name.encode() * 100)
+        hashes.append(file_hash)
+        if name == "c":
+            # b is the least recently used now
+            assert store.link_into(hashes[0], str(tmp_path / "again"))
+        assert store.add(file_hash, source)
+
+    assert hashes[0] in store.blobs
+    assert hashes[1] not in store.blobs
+    assert hashes[2] in store.blobs
+    assert not os.path.exists(store.get_blob_path(hashes[1]))
+    assert store.get_metrics()["total_bytes"] == 200
+
+def test_released_partials_count_and_go_first(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"), 250)
+    source, blob_hash = make_file(tmp_path, "a", b"a" * 100)
+    assert store.add(blob_hash, source)
+
+    partial_hash = "1" * 64
+    assert store.claim_partial(partial_hash) == store.get_partial_path(partial_hash)
+    # claimed twice, eg. from another session
+    assert store.claim_partial(partial_hash) is None
+    write_partial(store, partial_hash, b"p" * 100)
+    store.release_partial(partial_hash)
+    assert store.get_metrics()["partial_bytes"] == 100
+    assert store.get_metrics()["total_bytes"] == 200
+
+    other, other_hash = make_file(tmp_path, "b", b"b" * 100)
+    assert store.add(other_hash, other)
+    # the partial is evicted before any blob
+    assert not os.path.exists(store.get_partial_path(partial_hash))
+    assert blob_hash in store.blobs and other_hash in store.blobs
+    assert store.get_metrics()["total_bytes"] == 200
+
+def test_partials_in_progress_are_not_evicted(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"), 150)
+    partial_hash = "2" * 64
+    store.claim_partial(partial_hash)
+    write_partial(store, partial_hash, b"p" * 100)
+    store.release_partial(partial_hash)
+
+    store.claim_partial(partial_hash)
+    source, blob_hash = make_file(tmp_path, "a", b"a" * 100)
+    assert store.add(blob_hash, source)
+    assert os.path.exists(store.get_partial_path(partial_hash))
+
+    # a completed upload leaves no partial
+    os.remove(store.get_partial_path(partial_hash))
+    store.release_partial(partial_hash)
+    assert store.get_metrics()["partials"] == 0
+    assert store.get_metrics()["total_bytes"] == 100
+
+def test_stale_partials_are_collected(tmp_path):
+    store_dir = tmp_path / "blobs"
+    store_dir.mkdir()
+    store = BlobStore(str(store_dir), 1000, partial_max_age=60)
+    old_hash, new_hash, claimed_hash = "3" * 64, "4" * 64, "5" * 64
+    for file_hash in (old_hash, new_hash, claimed_hash):
+        write_partial(store, file_hash, b"p" * 10)
+    an_hour_ago = time.time() - 3600
+    for file_hash in (old_hash, claimed_hash):
+        os.utime(store.get_partial_path(file_hash), (an_hour_ago, an_hour_ago))
+
+    # found on load, as left by a previous run
+    store.claim_partial(claimed_hash)
+    assert store.get_metrics()["partials"] == 3
+    store.collect_partials()
+
+    assert not os.path.exists(store.get_partial_path(old_hash))
+    assert os.path.exists(store.get_partial_path(new_hash))
+    assert os.path.exists(store.get_partial_path(claimed_hash))
+    assert store.get_metrics()["partial_bytes"] == 20
+
+def test_content_path_is_the_same_for_every_session(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"), 1000)
+    source, file_hash = make_file(tmp_path, "upload.png", b"png" * 10)
+    assert store.add(file_hash, source)
+
+    paths = []
+    for session in ("one", "two"):
+        session_dir = tmp_path / session
+        session_dir.mkdir()
+        session_file = str(session_dir / f"{session}.png")
+        assert store.link_into(file_hash, session_file)
+        pinned_hash, content_path = store.pin_content_path(session_file)
+        assert pinned_hash == file_hash
+        paths.append(content_path)
+
+    assert paths[0] == paths[1]
+    assert paths[0].endswith(file_hash + ".png")
+    assert open(paths[0], "rb").read() == b"png" * 10
+
+    # a file that is not a blob keeps its own path
+    other, _ = make_file(tmp_path, "other.png", b"png" * 10)
+    assert store.pin_content_path(other) is None
+
+def test_pinned_blobs_are_not_evicted(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"), 150)
+    source, pinned_hash = make_file(tmp_path, "a.png", b"a" * 100)
+    assert store.add(pinned_hash, source)
+    session_file = str(tmp_path / "session.png")
+    store.link_into(pinned_hash, session_file)
+    _, content_path = store.pin_content_path(session_file)
+
+    other, other_hash = make_file(tmp_path, "b", b"b" * 100)
+    assert store.add(other_hash, other)
+    assert pinned_hash in store.blobs
+    assert os.path.exists(content_path)
+
+    store.unpin(pinned_hash)
+    third, third_hash = make_file(tmp_path, "c", b"c" * 100)
+    assert store.add(third_hash, third)
+    assert pinned_hash not in store.blobs
+    assert not os.path.exists(content_path)
+    # what a session linked stays until the session is gone
+    assert open(session_file, "rb").read() == b"a" * 100
+
+def test_content_paths_are_found_after_a_restart(tmp_path):
+    store_dir = tmp_path / "blobs"
+    store = BlobStore(str(store_dir), 1000)
+    source, file_hash = make_file(tmp_path, "a.png", b"a" * 10)
+    store.add(file_hash, source)
+    session_file = str(tmp_path / "session.png")
+    store.link_into(file_hash, session_file)
+    _, content_path = store.pin_content_path(session_file)
+    orphan = store_dir / "content" / ("6" * 64 + ".png")
+    orphan.write_bytes(b"gone")
+
+    store = BlobStore(str(store_dir), 1000)
+    assert store.pin_content_path(session_file) == (file_hash, content_path)
+    assert not orphan.exists()
+
+def test_files_are_copied_without_holding_the_lock(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path / "blobs"), 1000)
+    source, file_hash = make_file(tmp_path, "a.png", b"a" * 10)
+    original_copyfile = shutil.copyfile
+    copied = []
+
+    def link(source, destination):
+        # as if the store was on another filesystem
+        raise OSError("cross-device link")
+
+    def copyfile(source, destination):
+        assert store.lock.acquire(blocking=False)
+        store.lock.release()
+        copied.append(destination)
+        original_copyfile(source, destination)
+
+    monkeypatch.setattr(blobs, "link", link)
+    monkeypatch.setattr(blobs.shutil, "copyfile", copyfile)
+    assert store.add(file_hash, source)
+    assert store.link_into(file_hash, str(tmp_path / "session.png"))
+    # the copies in the sessions are not the blob, the blob itself is
+    _, content_path = store.pin_content_path(store.get_blob_path(file_hash))
+
+    assert len(copied) == 3
+    assert open(content_path, "rb").read() == b"a" * 10
+    assert store.get_metrics()["pinned"] == 1
+
+def test_leftover_temporary_links_are_removed(tmp_path):
+    store_dir = tmp_path / "blobs"
+    (store_dir / "content").mkdir(parents=True)
+    leftover = store_dir / ("a" * 64 + ".0123.link")
+    leftover.write_bytes(b"a")
+    content_leftover = store_dir / "content" / ("a" * 64 + ".png.0123.link")
+    content_leftover.write_bytes(b"a")
+
+    BlobStore(str(store_dir), 1000).ensure_loaded()
+    assert not leftover.exists() and not content_leftover.exists()
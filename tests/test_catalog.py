@@ -0,0 +1,123 @@
+import json
+import os
+
+from aihub import catalog as catalog_module
+from aihub.catalog import JsonDirectoryCatalog, WorkflowCatalog
+
+def write_json(directory, file_name, data):
+    with open(directory / file_name, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+def touch_later(file_path):
+    # the mtime resolution of some filesystems is coarse, the size changes anyway in these tests
+    info = os.stat(file_path)
+    os.utime(file_path, ns=(info.st_atime_ns, info.st_mtime_ns + 1_000_000_000))
+
+def test_reads_changed_files_only(tmp_path):
+    write_json(tmp_path, "a.json", {"id": "a"})
+    write_json(tmp_path, "b.json", {"id": "b"})
+    catalog = JsonDirectoryCatalog(str(tmp_path), "model")
+
+    assert sorted(v["id"] for v in catalog.values()) == ["a", "b"]
+    version = catalog.version
+    entry_b = catalog.entries["b.json"]
+
+    write_json(tmp_path, "a.json", {"id": "a", "name": "changed"})
+    touch_later(tmp_path / "a.json")
+    values = {v["id"]: v for v in catalog.values()}
+
+    assert values["a"]["name"] == "changed"
+    assert catalog.entries["b.json"] is entry_b
+    assert catalog.version == version + 1
+
+def test_removed_files_leave_the_catalog(tmp_path):
+    write_json(tmp_path, "a.json", {"id": "a"})
+    catalog = JsonDirectoryCatalog(str(tmp_path), "model")
+    assert len(catalog.values()) == 1
+
+    os.remove(tmp_path / "a.json")
+    assert catalog.values() == []
+
+def test_malformed_files_are_skipped_and_not_read_again(tmp_path, monkeypatch):
+    write_json(tmp_path, "good.json", {"id": "good"})
+    (tmp_path / "broken.json").write_text("{not json", encoding="utf-8")
+    write_json(tmp_path, "list.json", [1, 2, 3])
+    catalog = JsonDirectoryCatalog(str(tmp_path), "lora")
+
+    assert catalog.values() == [{"id": "good"}]
+
+    reads = []
+    original_read_file = catalog.read_file
+    monkeypatch.setattr(catalog, "read_file", lambda file_name: reads.append(file_name) or original_read_file(file_name))
+    version = catalog.version
+    assert catalog.values() == [{"id": "good"}]
+    assert reads == []
+    assert catalog.version == version
+
+    (tmp_path / "broken.json").write_text('{"id": "fixed"}', encoding="utf-8")
+    touch_later(tmp_path / "broken.json")
+    assert sorted(v["id"] for v in catalog.values()) == ["fixed", "good"]
+    assert reads == ["broken.json"]
+
+def test_cold_catalog_only_scans_once(tmp_path):
+    write_json(tmp_path, "a.json", {"id": "a"})
+    catalog = JsonDirectoryCatalog(str(tmp_path), "model", cold=True)
+    assert len(catalog.values()) == 1
+
+    write_json(tmp_path, "b.json", {"id": "b"})
+    assert len(catalog.values()) == 1
+
+    catalog.reload_file("b.json")
+    assert len(catalog.values()) == 2
+
+def test_workflow_catalog_ignores_malformed_workflows(tmp_path):
+    locale_dir = tmp_path / "locale"
+    workflows_dir = tmp_path / "workflows"
+    workflows_dir.mkdir()
+    write_json(workflows_dir, "wf.json", {
+        "1": {"class_type": "AIHubWorkflowController", "inputs": {"id": "wf", "label": "Workflow"}},
+        "2": {"class_type": "AIHubExposeInteger", "inputs": {"id": "steps", "value": 20}},
+    })
+    (workflows_dir / "broken.json").write_text("[", encoding="utf-8")
+    catalog = WorkflowCatalog(str(workflows_dir), str(locale_dir))
+
+    assert list(catalog.get_summaries().keys()) == ["wf"]
+    assert catalog.get_plan("wf")["bindings"] == {"steps": ["2"]}
+    assert len(catalog.valid_workflows()) == 1
+    assert len(catalog.values()) == 1
+
+def test_rescans_are_throttled(tmp_path, monkeypatch):
+    write_json(tmp_path, "a.json", {"id": "a"})
+    catalog = JsonDirectoryCatalog(str(tmp_path), "model", rescan_interval=60)
+    assert len(catalog.values()) == 1
+
+    write_json(tmp_path, "b.json", {"id": "b"})
+    assert len(catalog.values()) == 1
+
+    monkeypatch.setattr(catalog, "scanned_at", catalog.scanned_at - 61)
+    assert len(catalog.values()) == 2
+
+def test_workflow_lookup_only_checks_its_own_file(tmp_path, monkeypatch):
+    write_json(tmp_path, "wf.json", {
+        "1": {"class_type": "AIHubWorkflowController", "inputs": {"id": "wf"}},
+        "2": {"class_type": "AIHubExposeInteger", "inputs": {"id": "steps", "value": 20}},
+    })
+    catalog = WorkflowCatalog(str(tmp_path), str(tmp_path / "locale"), rescan_interval=60)
+    assert catalog.get_entry("wf") is not None
+
+    def listdir(directory):
+        raise AssertionError("the directory must not be scanned")
+
+    monkeypatch.setattr(catalog_module, "listdir", listdir)
+    write_json(tmp_path, "wf.json", {
+        "1": {"class_type": "AIHubWorkflowController", "inputs": {"id": "wf"}},
+        "2": {"class_type": "AIHubExposeInteger", "inputs": {"id": "seed", "value": 1}},
+    })
+    touch_later(tmp_path / "wf.json")
+
+    assert catalog.get_plan("wf")["bindings"] == {"seed": ["2"]}
+    # unknown ids wait for the next scan
+    assert catalog.get_entry("other") is None
+
+    os.remove(tmp_path / "wf.json")
+    assert catalog.get_entry("wf") is None
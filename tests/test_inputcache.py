@@ -0,0 +1,118 @@
+import hashlib
+import os
+
+import pytest
+
+from aihub.inputcache import DecodedCache, FINGERPRINT_SAMPLE_SIZE, get_stat_key, file_fingerprint, local_file_fingerprint
+
+class FakeTensor:
+    """
+    What the cache needs from a tensor, with a list as the storage so copies can be told apart
+    """
+
+    def __init__(self, values, element_size=4):
+        self.values = list(values)
+        self.size = element_size
+
+    def numel(self):
+        return len(self.values)
+
+    def element_size(self):
+        return self.size
+
+    def clone(self):
+        return FakeTensor(self.values, self.size)
+
+def test_hit_and_miss():
+    cache = DecodedCache(1000)
+    assert cache.get("a") is None
+    cache.put("a", (FakeTensor([1, 2]), None))
+    image, mask = cache.get("a")
+
+    assert image.values == [1, 2]
+    assert mask is None
+    metrics = cache.get_metrics()
+    assert (metrics["hits"], metrics["misses"], metrics["total_bytes"]) == (1, 1, 8)
+
+def test_returned_tensors_are_copies():
+    cache = DecodedCache(1000)
+    cached = FakeTensor([1, 2])
+    cache.put("a", (cached,))
+
+    first, = cache.get("a")
+    first.values[0] = 99
+    second, = cache.get("a")
+
+    assert first is not cached and second is not cached and first is not second
+    assert second.values == [1, 2]
+
+def test_least_recently_used_are_evicted():
+    cache = DecodedCache(100)
+    cache.put("a", (FakeTensor([0] * 10),))
+    cache.put("b", (FakeTensor([0] * 10),))
+    cache.get("a")
+    cache.put("c", (FakeTensor([0] * 10),))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.get_metrics()["total_bytes"] == 80
+
+def test_too_large_entries_are_not_kept():
+    cache = DecodedCache(10)
+    cache.put("a", (FakeTensor([0] * 10),))
+    assert cache.get("a") is None
+    assert cache.get_metrics()["entries"] == 0
+
+def test_replacing_an_entry_keeps_the_size_right():
+    cache = DecodedCache(100)
+    cache.put("a", (FakeTensor([0] * 10),))
+    cache.put("a", (FakeTensor([0] * 5),))
+    assert cache.get_metrics()["total_bytes"] == 20
+
+def test_with_torch_tensors():
+    torch = pytest.importorskip("torch")
+    cache = DecodedCache(1024 * 1024)
+    image = torch.zeros((1, 8, 8, 3))
+    cache.put("a", (image, None))
+
+    cached, _ = cache.get("a")
+    cached.add_(1)
+    assert cache.get("a")[0].sum().item() == 0
+
+def test_stat_key_changes_with_the_file_but_not_with_links(tmp_path):
+    file_path = tmp_path / "a.png"
+    file_path.write_bytes(b"one")
+    key = get_stat_key(str(file_path))
+
+    os.link(file_path, tmp_path / "linked.png")
+    assert get_stat_key(str(tmp_path / "linked.png")) == key
+
+    (tmp_path / "new.png").write_bytes(b"two!")
+    os.replace(tmp_path / "new.png", file_path)
+    assert get_stat_key(str(file_path)) != key
+    assert file_fingerprint(str(file_path)) == hashlib.sha256(b"two!").hexdigest()
+
+def rewrite(file_path, data):
+    file_path.with_suffix(".new").write_bytes(data)
+    os.replace(file_path.with_suffix(".new"), file_path)
+
+def test_fingerprint_stays_the_same_when_the_same_content_is_written_again(tmp_path):
+    file_path = tmp_path / "large.png"
+    data = os.urandom(4 * FINGERPRINT_SAMPLE_SIZE)
+    file_path.write_bytes(data)
+    assert local_file_fingerprint(str(file_path)).startswith("sampled:")
+
+    fingerprints = []
+    for _ in range(3):
+        rewrite(file_path, data)
+        fingerprints.append(local_file_fingerprint(str(file_path)))
+    assert fingerprints == [hashlib.sha256(data).hexdigest()] * 3
+
+    # a change between the samples is found by the full hash
+    changed = bytearray(data)
+    changed[FINGERPRINT_SAMPLE_SIZE + 1] ^= 1
+    rewrite(file_path, bytes(changed))
+    assert local_file_fingerprint(str(file_path)) == hashlib.sha256(changed).hexdigest()
+    rewrite(file_path, bytes(changed))
+    assert local_file_fingerprint(str(file_path)) == hashlib.sha256(changed).hexdigest()
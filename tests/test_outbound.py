@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from aihub.outbound import ClientConnection
+
+class FakeWebSocket:
+    """
+    Records what is sent, sending blocks while the client is paused
+    """
+
+    def __init__(self, loop):
+        self.sent = []
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.closed = False
+
+    async def send_str(self, payload):
+        await self.resumed.wait()
+        self.sent.append(payload)
+
+    async def send_bytes(self, payload):
+        await self.resumed.wait()
+        self.sent.append(bytes(payload))
+
+    async def close(self):
+        self.closed = True
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+
+    async def cancel_writers():
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    asyncio.run_coroutine_threadsafe(cancel_writers(), loop).result(timeout=5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=5)
+    loop.close()
+
+def on_loop(loop, fn):
+    async def call():
+        return fn()
+    return asyncio.run_coroutine_threadsafe(call(), loop).result(timeout=5)
+
+def connect(loop, max_queued_bytes, budget_timeout=None):
+    ws = on_loop(loop, lambda: FakeWebSocket(loop))
+    connection = ClientConnection(ws, loop, max_queued_bytes, budget_timeout)
+    on_loop(loop, connection.start)
+    return ws, connection
+
+def test_messages_are_sent_in_order(loop):
+    ws, connection = connect(loop, 1024)
+    futures = [connection.send_sync({"n": i}, b"data") for i in range(3)]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert ws.sent == ['{"n": 0}', b"data", '{"n": 1}', b"data", '{"n": 2}', b"data"]
+    metrics = connection.get_metrics()
+    assert metrics["queued_bytes"] == 0
+    assert metrics["sent_messages"] == 6
+
+def test_producers_wait_for_the_budget(loop):
+    ws, connection = connect(loop, 100)
+    on_loop(loop, ws.resumed.clear)
+    first = connection.send_sync(b"x" * 80)
+
+    done = threading.Event()
+    def produce():
+        connection.send_sync(b"y" * 80)
+        done.set()
+    threading.Thread(target=produce, daemon=True).start()
+
+    assert not done.wait(0.2)
+    assert connection.get_metrics()["waiting_producers"] == 1
+
+    on_loop(loop, ws.resumed.set)
+    assert done.wait(5)
+    first.result(timeout=5)
+    assert connection.get_metrics()["total_wait_count"] == 1
+
+def test_a_message_larger_than_the_budget_is_sent_alone(loop):
+    ws, connection = connect(loop, 10)
+    connection.send_sync(b"z" * 100).result(timeout=5)
+    assert ws.sent == [b"z" * 100]
+
+def test_close_releases_the_waiting_producers(loop):
+    ws, connection = connect(loop, 100)
+    on_loop(loop, ws.resumed.clear)
+    in_flight = connection.send_sync(b"x" * 80)
+    queued = connection.send_sync(b"q" * 10)
+
+    results = []
+    def produce():
+        try:
+            connection.send_sync(b"y" * 80).result(timeout=5)
+        except Exception as e:
+            results.append(e)
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    time.sleep(0.1)
+
+    connection.close()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert isinstance(results[0], ConnectionResetError)
+
+    # what the writer was already sending finishes, the rest is dropped
+    on_loop(loop, ws.resumed.set)
+    in_flight.result(timeout=5)
+    with pytest.raises(ConnectionResetError):
+        queued.result(timeout=5)
+    assert ws.sent == [b"x" * 80]
+
+def test_enqueue_after_close_fails(loop):
+    ws, connection = connect(loop, 100)
+    connection.close()
+    with pytest.raises(ConnectionResetError):
+        connection.send_sync({"late": True}).result(timeout=5)
+    assert ws.sent == []
+    assert connection.get_metrics()["queued_bytes"] == 0
+
+def test_enqueue_racing_close_never_hangs(loop):
+    ws, connection = connect(loop, 1024 * 1024)
+    futures = []
+    def produce():
+        for i in range(200):
+            futures.append(connection.send_sync({"n": i}))
+    thread = threading.Thread(target=produce)
+    thread.start()
+    connection.close()
+    thread.join(timeout=5)
+
+    for future in futures:
+        # either sent or failed, but always done
+        try:
+            future.result(timeout=5)
+        except ConnectionResetError:
+            pass
+    assert connection.get_metrics()["queued_bytes"] == 0
+
+def test_a_client_that_receives_nothing_is_closed(loop):
+    ws, connection = connect(loop, 100, budget_timeout=0.2)
+    on_loop(loop, ws.resumed.clear)
+    connection.send_sync(b"x" * 80)
+
+    started = time.monotonic()
+    with pytest.raises(ConnectionResetError):
+        connection.send_sync(b"y" * 80).result(timeout=5)
+    assert time.monotonic() - started < 5
+    assert connection.closed
+    time.sleep(0.1)
+    assert ws.closed
@@ -0,0 +1,104 @@
+from aihub.scheduler import WorkflowScheduler, RunRegistry, parse_priority, MAX_PRIORITY, MIN_PRIORITY
+
+def make_run(run_id, client=None):
+    return {"id": run_id, "ws": client}
+
+def pop_all(scheduler):
+    ids = []
+    while True:
+        run = scheduler.pop()
+        if run is None:
+            return ids
+        ids.append(run["id"])
+
+def test_parse_priority():
+    assert parse_priority(None) == 0
+    assert parse_priority(3) == 3
+    assert parse_priority(1000) == MAX_PRIORITY
+    assert parse_priority(-1000) == MIN_PRIORITY
+    assert parse_priority(True) is None
+    assert parse_priority("1") is None
+    assert parse_priority(1.5) is None
+
+def test_clients_take_turns():
+    scheduler = WorkflowScheduler()
+    a, b, c = object(), object(), object()
+    for i in range(3):
+        scheduler.push(make_run(f"a{i}"), a)
+    scheduler.push(make_run("b0"), b)
+    scheduler.push(make_run("b1"), b)
+    scheduler.push(make_run("c0"), c)
+
+    expected = ["a0", "b0", "c0", "a1", "b1", "a2"]
+    assert [run["id"] for run in scheduler.ordered()] == expected
+    assert pop_all(scheduler) == expected
+    assert len(scheduler) == 0
+
+def test_higher_priority_goes_first():
+    scheduler = WorkflowScheduler()
+    a, b = object(), object()
+    scheduler.push(make_run("a0"), a)
+    scheduler.push(make_run("b0"), b, priority=5)
+    scheduler.push(make_run("a1"), a, priority=5)
+    scheduler.push(make_run("b1"), b, priority=-1)
+
+    assert pop_all(scheduler) == ["b0", "a1", "a0", "b1"]
+
+def test_new_client_waits_for_the_ones_in_line():
+    scheduler = WorkflowScheduler()
+    a, b = object(), object()
+    scheduler.push(make_run("a0"), a)
+    scheduler.push(make_run("a1"), a)
+    assert scheduler.pop()["id"] == "a0"
+    scheduler.push(make_run("b0"), b)
+
+    assert pop_all(scheduler) == ["a1", "b0"]
+
+def test_cancel_keeps_the_order_of_the_rest():
+    scheduler = WorkflowScheduler()
+    a, b = object(), object()
+    for i in range(3):
+        scheduler.push(make_run(f"a{i}"), a)
+        scheduler.push(make_run(f"b{i}"), b)
+
+    assert scheduler.cancel("a1")["id"] == "a1"
+    assert scheduler.cancel("a1") is None
+    # only the owner can cancel
+    assert scheduler.cancel("b1", client=a) is None
+
+    expected = ["a0", "b0", "a2", "b1", "b2"]
+    assert [run["id"] for run in scheduler.ordered()] == expected
+    assert len(scheduler) == 5
+    assert pop_all(scheduler) == expected
+
+def test_cancelling_all_the_runs_of_a_client_skips_its_turn():
+    scheduler = WorkflowScheduler()
+    a, b = object(), object()
+    scheduler.push(make_run("a0"), a)
+    scheduler.push(make_run("b0"), b)
+    scheduler.cancel("a0")
+
+    assert pop_all(scheduler) == ["b0"]
+    assert scheduler.levels == {}
+
+def test_remove_client():
+    scheduler = WorkflowScheduler()
+    a, b = object(), object()
+    scheduler.push(make_run("a0"), a)
+    scheduler.push(make_run("a1"), a, priority=2)
+    scheduler.push(make_run("b0"), b)
+
+    assert sorted(run["id"] for run in scheduler.remove_client(a)) == ["a0", "a1"]
+    assert pop_all(scheduler) == ["b0"]
+
+def test_registry_removes_once():
+    registry = RunRegistry()
+    a, b = object(), object()
+    registry.add(make_run("p1", a))
+    registry.add(make_run("p2", b))
+
+    assert [run["id"] for run in registry.for_client(a)] == ["p1"]
+    assert registry.get(None) is None
+    assert registry.remove("p1")["id"] == "p1"
+    assert registry.remove("p1") is None
+    assert len(registry) == 1
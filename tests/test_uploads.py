@@ -0,0 +1,148 @@
+import hashlib
+import os
+import struct
+
+import pytest
+
+from aihub.uploads import ChunkedUpload, UploadOffsetError, UploadHashError, UPLOAD_CHUNK_OFFSET, get_partial_path, write_file_atomic
+
+DATA = bytes(range(256)) * 40
+DATA_HASH = hashlib.sha256(DATA).hexdigest()
+
+def upload_until(upload, data, stop):
+    offset = upload.received
+    while offset < stop:
+        chunk = data[offset:min(offset + 1000, stop)]
+        upload.write(offset, chunk)
+        offset += len(chunk)
+
+def test_chunk_offset_format():
+    assert UPLOAD_CHUNK_OFFSET.pack(5) == struct.pack("<Q", 5)
+
+def test_write_file_atomic(tmp_path):
+    full_path = str(tmp_path / "file.bin")
+    write_file_atomic(full_path, b"abc")
+    assert open(full_path, "rb").read() == b"abc"
+    assert not os.path.exists(full_path + ".partial")
+
+def test_upload_in_chunks(tmp_path):
+    full_path = str(tmp_path / "file.bin")
+    upload = ChunkedUpload(full_path, len(DATA))
+    assert upload.open() == 0
+    upload_until(upload, DATA, len(DATA) - 1)
+    assert not os.path.exists(full_path)
+    assert upload.write(len(DATA) - 1, DATA[-1:])
+    assert open(full_path, "rb").read() == DATA
+
+def test_chunk_at_the_wrong_offset(tmp_path):
+    upload = ChunkedUpload(str(tmp_path / "file.bin"), len(DATA))
+    upload.open()
+    upload.write(0, DATA[:100])
+    with pytest.raises(UploadOffsetError) as e:
+        upload.write(200, DATA[200:300])
+    assert e.value.expected_offset == 100
+    with pytest.raises(ValueError):
+        upload.write(100, DATA[100:] + b"extra")
+
+def test_resume_with_the_same_upload_id(tmp_path):
+    full_path = str(tmp_path / "file.bin")
+    partial_path = get_partial_path(full_path, len(DATA), "abc")
+    upload = ChunkedUpload(full_path, len(DATA), partial_path)
+    upload.open()
+    upload_until(upload, DATA, 3000)
+    upload.close()
+
+    upload = ChunkedUpload(full_path, len(DATA), get_partial_path(full_path, len(DATA), "abc"))
+    assert upload.open() == 3000
+    upload_until(upload, DATA, len(DATA))
+    assert upload.complete
+    assert open(full_path, "rb").read() == DATA
+
+def test_another_file_with_the_same_name_does_not_resume(tmp_path):
+    full_path = str(tmp_path / "file.bin")
+    upload = ChunkedUpload(full_path, len(DATA), get_partial_path(full_path, len(DATA), "first"))
+    upload.open()
+    upload_until(upload, DATA, 3000)
+    upload.close()
+
+    other = b"x" * len(DATA)
+    for partial_path in (get_partial_path(full_path, len(DATA), "second"), get_partial_path(full_path, len(DATA) + 1, "first")):
+        upload = ChunkedUpload(full_path, len(DATA), partial_path)
+        assert upload.open() == 0
+        upload.close()
+
+    # without an upload id nothing is resumed
+    upload = ChunkedUpload(full_path, len(other), get_partial_path(full_path, len(other)), resumable=False)
+    assert upload.open() == 0
+    upload_until(upload, other, len(other))
+    assert open(full_path, "rb").read() == other
+
+def test_restart(tmp_path):
+    full_path = str(tmp_path / "file.bin")
+    partial_path = get_partial_path(full_path, len(DATA), "abc")
+    upload = ChunkedUpload(full_path, len(DATA), partial_path)
+    upload.open()
+    upload_until(upload, b"y" * len(DATA), 3000)
+    upload.close()
+
+    # asked by the header
+    upload = ChunkedUpload(full_path, len(DATA), partial_path, resumable=False)
+    assert upload.open() == 0
+    upload_until(upload, b"y" * len(DATA), 3000)
+    upload.close()
+
+    # or by a chunk at offset 0
+    upload = ChunkedUpload(full_path, len(DATA), partial_path)
+    assert upload.open() == 3000
+    assert not upload.write(0, DATA[:1000])
+    assert upload.received == 1000
+    upload_until(upload, DATA, len(DATA))
+    assert open(full_path, "rb").read() == DATA
+
+def test_hash_is_verified(tmp_path):
+    full_path = str(tmp_path / "file.bin")
+    partial_path = str(tmp_path / "blob.partial")
+    upload = ChunkedUpload(full_path, len(DATA), partial_path, file_hash=DATA_HASH)
+    upload.open()
+    upload_until(upload, DATA, 1000)
+    with pytest.raises(UploadHashError):
+        upload_until(upload, b"z" * len(DATA), len(DATA))
+    assert not os.path.exists(full_path)
+    assert not os.path.exists(partial_path)
+
+def test_complete_partial_is_used_only_if_it_matches(tmp_path):
+    full_path = str(tmp_path / "file.bin")
+    partial_path = str(tmp_path / "blob.partial")
+
+    with open(partial_path, "wb") as f:
+        f.write(b"s" * len(DATA))
+    upload = ChunkedUpload(full_path, len(DATA), partial_path, file_hash=DATA_HASH)
+    assert upload.open() == 0
+    assert not upload.complete
+    upload.close()
+
+    with open(partial_path, "wb") as f:
+        f.write(DATA)
+    upload = ChunkedUpload(full_path, len(DATA), partial_path, file_hash=DATA_HASH)
+    assert upload.open() == len(DATA)
+    assert upload.complete
+    assert open(full_path, "rb").read() == DATA
+
+def test_complete_partial_without_hash_is_received_again(tmp_path):
+    full_path = str(tmp_path / "file.bin")
+    partial_path = get_partial_path(full_path, len(DATA), "abc")
+    with open(partial_path, "wb") as f:
+        f.write(b"s" * len(DATA))
+
+    upload = ChunkedUpload(full_path, len(DATA), partial_path)
+    assert upload.open() == 0
+    assert not upload.complete
+    upload.discard()
+    assert not os.path.exists(partial_path)
+
+def test_empty_upload(tmp_path):
+    full_path = str(tmp_path / "empty.bin")
+    upload = ChunkedUpload(full_path, 0, file_hash=hashlib.sha256(b"").hexdigest())
+    assert upload.open() == 0
+    assert upload.complete
+    assert open(full_path, "rb").read() == b""
@@ -0,0 +1,153 @@
+import hashlib
+import struct
+from os import path, replace, remove
+
+from .blobs import hash_file
+
+# every binary message of a chunked upload starts with the offset of the chunk in the file
+UPLOAD_CHUNK_OFFSET = struct.Struct("<Q")
+
+# what is received of an upload is written here until it is complete
+PARTIAL_SUFFIX = ".partial"
+
+def get_partial_path(full_path, total_size, upload_id=None):
+    """
+    Where what is received of an upload is kept, only an upload with the same file name, total size
+    and upload id finds the same partial file; without an upload id the partial file is not keyed
+    and the upload cannot be resumed
+    """
+    if upload_id is None:
+        return full_path + PARTIAL_SUFFIX
+    key = hashlib.sha256(f"{total_size}:{upload_id}".encode("utf-8")).hexdigest()[:16]
+    return f"{full_path}.{key}{PARTIAL_SUFFIX}"
+
+def write_file_atomic(full_path, data):
+    """
+    Writes a whole file at once, the file only appears with its name once it is complete
+    """
+    partial_path = full_path + PARTIAL_SUFFIX
+    with open(partial_path, "wb") as f:
+        f.write(data)
+    replace(partial_path, full_path)
+
+class UploadOffsetError(Exception):
+    """
+    A chunk did not start where the upload is at, the client must continue from expected_offset
+    """
+    def __init__(self, expected_offset):
+        super().__init__(f"Chunk is not at the offset of the upload, expected {expected_offset}")
+        self.expected_offset = expected_offset
+
+class UploadHashError(Exception):
+    """
+    The received file does not have the hash the client gave for it, it was discarded
+    """
+
+class ChunkedUpload:
+    """
+    A file that arrives in many binary messages, the chunks are appended to a partial file
+    that is renamed into place once complete so a workflow never sees a half written file
+
+    When the upload is resumable the partial file is kept if the upload is left unfinished,
+    so a new upload of the same file continues where the previous one stopped; the partial
+    file must then be keyed to the file, see get_partial_path, or be in the blob store under
+    the hash of the file so it outlives the session; a chunk at offset 0 starts over
+
+    With a hash the file is verified before it is put in place, and a partial file that is
+    already complete is only used if it matches
+
+    All the methods do blocking file operations, they are meant to run through fsio.run_io
+    """
+
+    def __init__(self, full_path, total_size, partial_path=None, file_hash=None, resumable=True):
+        self.full_path = full_path
+        self.partial_path = partial_path if partial_path is not None else full_path + PARTIAL_SUFFIX
+        self.total_size = total_size
+        self.file_hash = file_hash
+        self.resumable = resumable
+        self.received = 0
+        self.complete = False
+        self.file = None
+
+    def open(self):
+        """
+        Opens the partial file, provides the offset the client must continue from
+        """
+        received = 0
+        if self.resumable and path.isfile(self.partial_path):
+            received = path.getsize(self.partial_path)
+            if received > self.total_size:
+                # that was a different file
+                received = 0
+        if received == 0:
+            self.restart()
+        else:
+            self.file = open(self.partial_path, "r+b")
+            self.file.seek(received)
+            self.received = received
+
+        if self.received == self.total_size:
+            if self.received > 0 and (self.file_hash is None or not self.partial_matches()):
+                # nothing tells these are the bytes of this file, they are received again
+                self.restart()
+            else:
+                self.finish(verified=self.received > 0)
+        return self.received
+
+    def restart(self):
+        """
+        Drops what was received and starts from the beginning
+        """
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.partial_path, "wb")
+        self.received = 0
+
+    def partial_matches(self):
+        self.file.flush()
+        return hash_file(self.partial_path) == self.file_hash
+
+    def write(self, offset, data):
+        """
+        Writes a chunk at the given offset, provides True once the upload is complete
+        """
+        if offset == 0 and self.received > 0:
+            # the client starts over
+            self.restart()
+        if offset != self.received:
+            raise UploadOffsetError(self.received)
+        if self.received + len(data) > self.total_size:
+            raise ValueError(f"Upload is larger than its total size of {self.total_size} bytes")
+        self.file.write(data)
+        self.received += len(data)
+        if self.received == self.total_size:
+            self.finish()
+        return self.complete
+
+    def finish(self, verified=False):
+        """
+        Puts the file in place, raises UploadHashError if it does not match its hash
+        """
+        self.file.close()
+        self.file = None
+        if self.file_hash is not None and not verified and hash_file(self.partial_path) != self.file_hash:
+            remove(self.partial_path)
+            raise UploadHashError(f"The uploaded file does not match its hash {self.file_hash}")
+        replace(self.partial_path, self.full_path)
+        self.complete = True
+
+    def close(self):
+        """
+        Leaves the upload unfinished, what was received stays in the partial file
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        """
+        Leaves the upload unfinished and removes what was received
+        """
+        self.close()
+        if path.exists(self.partial_path):
+            remove(self.partial_path)
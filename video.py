@@ -1,8 +1,101 @@
 from comfy_api.latest._util import VideoContainer, VideoCodec, VideoComponents
 from fractions import Fraction
 from typing import Optional
+from os import environ, cpu_count
 import av
 import json
+import torch
+
+# the threads libx264 uses to encode, by default as many as there are cpus up to 16
+# since beyond that more threads make the quality worse without making it much faster
+AIHUB_VIDEO_ENCODE_THREADS = int(environ.get("AIHUB_VIDEO_ENCODE_THREADS", 0)) or min(16, cpu_count() or 1)
+
+# how many frames are converted and copied to the cpu at once
+VIDEO_CONVERSION_CHUNK_SIZE = 16
+
+# how many encoder frames of audio are given to the encoder at once
+AUDIO_FRAMES_PER_CHUNK = 64
+
+# the channel layouts the aac encoder supports by the amount of channels, in the channel
+# order comfyui audio has, other amounts of channels are downmixed to stereo by the encoder
+AAC_CHANNEL_LAYOUTS = {
+    1: "mono",
+    2: "stereo",
+    3: "3.0",
+    4: "4.0",
+    5: "5.0(back)",
+    6: "5.1(back)",
+    8: "7.1(wide)",
+}
+
+# the size of the chunks a streamed video is sent in
+VIDEO_STREAM_CHUNK_SIZE = 1024 * 1024
+
+class ChunkWriter:
+    """
+    A write only file object that gives what is written to it in chunks of a fixed size,
+    it cannot seek so the muxer must produce a format that does not need to go back
+    such as a fragmented mp4
+
+    on_chunk(chunk, chunk_index, final) is called for every chunk, the last call has
+    final set and may be empty
+    """
+
+    def __init__(self, on_chunk, chunk_size=VIDEO_STREAM_CHUNK_SIZE):
+        self.on_chunk = on_chunk
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.chunk_index = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            chunk = bytes(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+            self.emit(chunk, False)
+        return len(data)
+
+    def emit(self, chunk, final):
+        self.on_chunk(chunk, self.chunk_index, final)
+        self.chunk_index += 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.emit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+
+def frames_to_yuv420p(frames):
+    """
+    Converts a batch of frames (N, H, W, 3) with values from 0 to 1 into planar yuv420p
+    as uint8 (N, H * 3 / 2, W), which is the layout av.VideoFrame.from_ndarray expects, the
+    conversion happens on the device of the frames
+
+    It uses BT.601 limited range and averages each 2x2 block for the chroma, which is what
+    swscale does by default for yuv420p, the height and the width must be even
+    """
+    with torch.no_grad():
+        rgb = frames[..., :3].float().clamp(0, 1)
+        count, height, width, _ = rgb.shape
+        r, g, b = rgb.unbind(-1)
+        y = 16.0 + 65.481 * r + 128.553 * g + 24.966 * b
+
+        rgb_half = rgb.reshape(count, height // 2, 2, width // 2, 2, 3).mean(dim=(2, 4))
+        r, g, b = rgb_half.unbind(-1)
+        u = 128.0 - 37.797 * r - 74.203 * g + 112.0 * b
+        v = 128.0 + 112.0 * r - 93.786 * g - 18.214 * b
+
+        planes = torch.cat((y.reshape(count, -1), u.reshape(count, -1), v.reshape(count, -1)), dim=1)
+        return planes.round_().clamp_(0, 255).to(torch.uint8).reshape(count, height * 3 // 2, width)
+
+def frames_to_rgb24(frames):
+    """
+    Converts a batch of frames (N, H, W, 3) with values from 0 to 1 into uint8 on their device
+    """
+    with torch.no_grad():
+        return (frames[..., :3] * 255).clamp_(0, 255).to(torch.uint8)
 
 # patched up version of comfyui save video function
 def video_save_to(
@@ -11,13 +104,28 @@ def video_save_to(
     format: VideoContainer = VideoContainer.AUTO,
     codec: VideoCodec = VideoCodec.AUTO,
     crf: int = 23,
-    metadata: Optional[dict] = None
+    metadata: Optional[dict] = None,
+    fragmented: bool = False,
+    color_conversion: str = "tensor",
+    threads: Optional[int] = None,
 ):
+    """
+    Saves the video as mp4 into a path or a file object, when fragmented the mp4 is written
+    as a sequence of fragments with the header first so the file object does not need to
+    be seekable and what is written can be played before the encoding is done
+
+    The color conversion to yuv420p is done for many frames at once on the device of the frames
+    with "tensor", or frame by frame by swscale with "swscale", which is also used when the size
+    of the video is odd
+    """
     if format != VideoContainer.AUTO and format != VideoContainer.MP4:
         raise ValueError("Only MP4 format is supported for now")
     if codec != VideoCodec.AUTO and codec != VideoCodec.H264:
         raise ValueError("Only H264 codec is supported for now")
-    with av.open(buffer_or_path, mode='w', format="mp4", options={'movflags': 'use_metadata_tags'}) as output:
+    movflags = 'use_metadata_tags'
+    if fragmented:
+        movflags += '+frag_keyframe+empty_moov+default_base_moof'
+    with av.open(buffer_or_path, mode='w', format="mp4", options={'movflags': movflags}) as output:
         # Add metadata before writing any streams
         if metadata is not None:
             for key, value in metadata.items():
@@ -32,48 +140,83 @@ def video_save_to(
         video_stream.height = self__components.images.shape[1]
         video_stream.pix_fmt = 'yuv420p'
         video_stream.options = {'crf': str(crf)}
+        # libx264 is single threaded unless it is told otherwise, frame threading is the one that scales
+        video_stream.codec_context.thread_type = 'FRAME'
+        video_stream.codec_context.thread_count = threads if threads is not None else AIHUB_VIDEO_ENCODE_THREADS
 
         # Create an audio stream
         audio_sample_rate = 1
         audio_stream: Optional[av.AudioStream] = None
+        audio_samples = None
+        audio_frame_layout = None
         if self__components.audio:
             audio_sample_rate = int(self__components.audio['sample_rate'])
+            # the waveform is (batch, channels, samples), it is made planar float on the cpu only once
+            audio_samples = self__components.audio['waveform'][0].float().contiguous().cpu().numpy()
+            audio_channels = audio_samples.shape[0]
+            audio_frame_layout = AAC_CHANNEL_LAYOUTS.get(audio_channels, audio_channels)
             audio_stream = output.add_stream('aac', rate=audio_sample_rate)
             audio_stream.sample_rate = audio_sample_rate
             audio_stream.format = 'fltp'
+            audio_stream.layout = AAC_CHANNEL_LAYOUTS.get(audio_channels, "stereo")
+
+        audio_encoded_samples = 0
 
-        # Encode video
-        for i, frame in enumerate(self__components.images):
-            img = (frame * 255).clamp(0, 255).byte().cpu().numpy() # shape: (H, W, 3)
-            frame = av.VideoFrame.from_ndarray(img, format='rgb24')
-            frame = frame.reformat(format='yuv420p')  # Convert to YUV420P as required by h264
-            packet = video_stream.encode(frame)
-            output.mux(packet)
+        def encode_audio_until(end_sample):
+            """
+            Encodes the audio up to the given sample in large chunks that are a multiple
+            of the frame size of the encoder, so the audio is interleaved with the video
+            """
+            nonlocal audio_encoded_samples
+            frame_size = audio_stream.codec_context.frame_size or 1024
+            chunk_size = frame_size * AUDIO_FRAMES_PER_CHUNK
+            end_sample = min(end_sample, audio_samples.shape[1])
+            while audio_encoded_samples < end_sample:
+                start = audio_encoded_samples
+                end = min(start + chunk_size, end_sample)
+                audio_frame = av.AudioFrame.from_ndarray(audio_samples[:, start:end], format='fltp', layout=audio_frame_layout)
+                audio_frame.sample_rate = audio_sample_rate
+                # the pts is counted in samples, as in audio_save_to
+                audio_frame.time_base = Fraction(1, audio_sample_rate)
+                audio_frame.pts = start
+                for packet in audio_stream.encode(audio_frame):
+                    output.mux(packet)
+                audio_encoded_samples = end
+
+        # Encode video, the frames are converted in chunks so only a chunk at a time is copied to the cpu
+        images = self__components.images
+        use_tensor_conversion = color_conversion == "tensor" and images.shape[1] % 2 == 0 and images.shape[2] % 2 == 0
+        for chunk_start in range(0, images.shape[0], VIDEO_CONVERSION_CHUNK_SIZE):
+            chunk = images[chunk_start:chunk_start + VIDEO_CONVERSION_CHUNK_SIZE]
+            if use_tensor_conversion:
+                converted = frames_to_yuv420p(chunk).cpu().numpy() # shape: (N, H * 3 / 2, W)
+            else:
+                converted = frames_to_rgb24(chunk).cpu().numpy() # shape: (N, H, W, 3)
+
+            for img in converted:
+                if use_tensor_conversion:
+                    frame = av.VideoFrame.from_ndarray(img, format='yuv420p')
+                else:
+                    frame = av.VideoFrame.from_ndarray(img, format='rgb24')
+                    frame = frame.reformat(format='yuv420p')  # Convert to YUV420P as required by h264
+                packet = video_stream.encode(frame)
+                output.mux(packet)
+
+            if audio_stream is not None:
+                # the audio that goes along with the frames encoded so far, in whole encoder frames
+                frames_done = chunk_start + chunk.shape[0]
+                audio_until = int(frames_done * audio_sample_rate / frame_rate)
+                frame_size = audio_stream.codec_context.frame_size or 1024
+                encode_audio_until(audio_until - audio_until % frame_size)
 
         # Flush video
         packet = video_stream.encode(None)
         output.mux(packet)
 
-        if audio_stream and self__components.audio:
-            # Encode audio
-            samples_per_frame = int(audio_sample_rate / frame_rate)
-            num_frames = self__components.audio['waveform'].shape[2] // samples_per_frame
-            for i in range(num_frames):
-                start = i * samples_per_frame
-                end = start + samples_per_frame
-                # TODO(Feature) - Add support for stereo audio
-                chunk = (
-                    self__components.audio["waveform"][0, 0, start:end]
-                    .unsqueeze(0)
-                    .contiguous()
-                    .numpy()
-                )
-                audio_frame = av.AudioFrame.from_ndarray(chunk, format='fltp', layout='mono')
-                audio_frame.sample_rate = audio_sample_rate
-                audio_frame.pts = i * samples_per_frame
-                for packet in audio_stream.encode(audio_frame):
-                    output.mux(packet)
+        if audio_stream is not None:
+            # Encode the rest of the audio
+            encode_audio_until(audio_samples.shape[1])
 
             # Flush audio
             for packet in audio_stream.encode(None):
-                output.mux(packet)
\ No newline at end of file
+                output.mux(packet)